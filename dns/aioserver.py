@@ -0,0 +1,373 @@
+#!/usr/bin/env python3
+
+"""An asyncio engine for the DNS server
+
+Instead of a socket thread and a pool of blocking handler threads, this engine
+runs everything on one event loop. A single DatagramProtocol receives client
+queries and upstream responses. The resolution and request handling coroutines
+of Resolver and RequestHandler are driven by asyncio tasks, so thousands of
+recursions can be in flight without a thread each.
+"""
+
+
+import asyncio
+import random
+import socket
+import struct
+import time
+
+from dns import metrics
+from dns.classes import Class
+from dns.message import EDNS_SIZE, Message
+from dns.resolver import Resolver
+from dns.rtypes import Type
+from dns.server import RequestHandler, Server
+from dns.socketWrapper import local_ip
+from dns.tcp import StreamConnection, query_tcp_async
+from dns.transactions import random_id, random_ports
+
+
+class ServerProtocol(asyncio.DatagramProtocol):
+    """Datagram endpoint for client queries and upstream responses"""
+
+    def __init__(self, server):
+        """Initialize the protocol
+
+        Args:
+            server (AsyncServer): server handling the client queries
+        """
+        self.server = server
+        self.transport = None
+        self.pending = {}
+        self.unmatched = 0
+        self.malformed = 0
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        if self.server.limiter is not None:
+            allowed, reply = self.server.limiter.check(data, addr[0])
+            if not allowed:
+                if reply is not None:
+                    self.transport.sendto(reply, addr)
+                return
+        if self.server.packets is not None:
+            reply = self.server.packets.lookup(data)
+            if reply is not None:
+                self.transport.sendto(reply, addr)
+                return
+        if len(data) < 12:
+            self.malformed += 1
+            return
+        if data[2] & 0x80:
+            # only responses somebody waits for are decoded
+            future = self.pending.get((struct.unpack_from("!H", data)[0], addr[0]))
+            if future is None or future.done():
+                self.unmatched += 1
+                return
+        try:
+            msg = Message.from_bytes(data)
+        except (ValueError, IndexError, UnicodeDecodeError, struct.error):
+            self.malformed += 1
+            return
+        if msg.header.qr:
+            future.set_result(msg)
+        else:
+            self.server.admit(msg, addr)
+
+    async def exchange(self, query, addr, timeout):
+        """Send a query to a name server and wait for its response
+
+        Args:
+            query (Message): the query
+            addr (str): IP address of the name server
+            timeout (float): seconds to wait for the response
+
+        Returns:
+            Message: the response, None on timeout
+        """
+        while (query.header.ident, addr) in self.pending:
+            query.header.ident = random_id()
+        key = (query.header.ident, addr)
+        future = asyncio.get_running_loop().create_future()
+        self.pending[key] = future
+        try:
+            self.transport.sendto(query.to_bytes(), (addr, 53))
+            return await asyncio.wait_for(future, timeout)
+        except asyncio.TimeoutError:
+            return None
+        finally:
+            del self.pending[key]
+
+    def send(self, msg):
+        """Send a message, same interface as SocketWrapper.send
+
+        Args:
+            msg ((Message, str, int)): message (or its encoding), ip and port
+        """
+        mess, ip, port = msg
+        data = mess if isinstance(mess, bytes) else mess.to_bytes()
+        self.transport.sendto(data, (ip, port))
+
+
+class AsyncResolver(Resolver):
+    """Resolver driving the resolution coroutine on the event loop"""
+
+    def __init__(self, timeout, caching, ttl, protocol, cache, flights=None,
+                 edns_size=EDNS_SIZE, attempt_timeout=0.8, retries=2, ports=None,
+                 hints=None, server_timeout=1.6):
+        """Initialize the resolver
+
+        Args:
+            protocol (ServerProtocol): endpoint used to query name servers
+            ports ([ServerProtocol]): endpoints on random source ports to use
+                instead of protocol
+        """
+        super().__init__(timeout, caching, ttl, protocol, cache, flights, edns_size,
+                         attempt_timeout, retries, ports, hints, server_timeout)
+
+    async def gethostbyname(self, hostname, refresh=False):
+        """Translate a host name to IPv4 address, see Resolver.gethostbyname"""
+        if self.flights is not None and not refresh:
+            return await self.flights.do_async(self.flight_key(hostname),
+                                               lambda: self._gethostbyname(hostname))
+        return await self._gethostbyname(hostname, refresh)
+
+    async def _gethostbyname(self, hostname, refresh=False):
+        return await self.drive(self.resolve(hostname, refresh))
+
+    async def prime(self):
+        """See Resolver.prime"""
+        return await self.drive(self.priming())
+
+    async def drive(self, steps):
+        """See Resolver.drive"""
+        deadline = time.monotonic() + self.timeout
+        try:
+            query, addr = next(steps)
+            while True:
+                query, addr = steps.send(await self.exchange(query, addr, deadline))
+        except StopIteration as stop:
+            return stop.value
+
+    async def exchange(self, query, addr, deadline=None):
+        """See Resolver.exchange"""
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+        for timeout in self.attempts(deadline):
+            query.header.ident = random_id()
+            protocol = random.choice(self.ports) if self.ports else self.sock
+            response = await protocol.exchange(query, addr, timeout)
+            if response is not None:
+                break
+        else:
+            return None
+        left = deadline - time.monotonic()
+        if response.header.tc:
+            return await query_tcp_async(query, addr, left) if left > 0 else None
+        return response
+
+
+class AsyncServer(Server):
+    """A recursive DNS server running on an asyncio event loop"""
+
+    def start(self, threads, queue_size):
+        """The endpoint is created by serve on the event loop"""
+        self.loop = None
+        self.protocol = None
+        self.resolver = None
+        self.tasks = set()
+        self.writing = False
+        self.streams = set()
+        if self.max_pending <= 0:
+            self.max_pending = 4096
+
+    def serve(self):
+        """Start serving requests"""
+        asyncio.run(self._serve())
+
+    async def _serve(self):
+        self.loop = asyncio.get_running_loop()
+        self.stopped = asyncio.Event()
+        transport, self.protocol = await self.loop.create_datagram_endpoint(
+            lambda: ServerProtocol(self), local_addr=(local_ip(), self.port),
+            reuse_port=self.reuse_port or None)
+        ports = []
+        for sock in random_ports(self.bind_port, self.source_ports):
+            port_transport, protocol = await self.loop.create_datagram_endpoint(
+                lambda: ServerProtocol(self), sock=sock)
+            ports.append(protocol)
+        self.resolver = AsyncResolver(5, self.caching, self.ttl, self.protocol, self.cache,
+                                      self.flights, self.edns_size, ports=ports)
+        if self.prime_roots:
+            self.spawn(self.resolver.prime())
+        tcp = await asyncio.start_server(self.serve_stream, local_ip(), self.port,
+                                         reuse_port=self.reuse_port or None)
+        try:
+            if not self.done:
+                await self.stopped.wait()
+        finally:
+            transport.close()
+            for protocol in ports:
+                protocol.transport.close()
+            tcp.close()
+            for writer in self.streams:
+                writer.close()
+
+    @staticmethod
+    def bind_port(port):
+        """UDP socket bound to a source port of the resolver"""
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            sock.bind((local_ip(), port))
+        except OSError:
+            sock.close()
+            raise
+        return sock
+
+    async def serve_stream(self, reader, writer):
+        """Read the pipelined queries of a TCP connection until it is closed or idle
+
+        A timeout in the middle of a message closes the connection.
+        """
+        if len(self.streams) >= self.tcp_connections:
+            writer.close()
+            return
+        self.streams.add(writer)
+        conn = StreamConnection(writer)
+        addr = writer.get_extra_info("peername")
+        try:
+            while True:
+                try:
+                    length = await asyncio.wait_for(reader.readexactly(2), self.tcp_idle_timeout)
+                except asyncio.TimeoutError:
+                    if conn.pending > 0:
+                        continue
+                    break
+                try:
+                    data = await asyncio.wait_for(
+                        reader.readexactly(struct.unpack("!H", length)[0]),
+                        self.tcp_idle_timeout)
+                except asyncio.TimeoutError:
+                    break
+                try:
+                    msg = Message.from_bytes(data)
+                except (ValueError, IndexError, UnicodeDecodeError, struct.error):
+                    break
+                if not msg.header.qr:
+                    conn.pending += 1
+                    self.admit(msg, addr, conn)
+        except (OSError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            self.streams.discard(writer)
+            writer.close()
+
+    def register_metrics(self):
+        """Export the counters and queue depths kept by the components"""
+        registry = metrics.REGISTRY
+        registry.gauge("dns_pending_requests", "Request and prefetch tasks running",
+                       lambda: len(self.tasks))
+        registry.gauge("dns_tcp_connections", "Open TCP connections",
+                       lambda: len(self.streams))
+        registry.gauge("dns_malformed_total", "Received datagrams that are not DNS messages",
+                       lambda: self.protocol.malformed if self.protocol else 0, "counter")
+        registry.gauge("dns_unmatched_responses_total",
+                       "Responses of name servers that no query waited for",
+                       lambda: self.protocol.unmatched if self.protocol else 0, "counter")
+        self.register_common_metrics()
+
+    def admit(self, mess, addr, conn=None):
+        """Handle a request as task or shed it when overloaded"""
+        if self.admission(mess, len(self.tasks))[0]:
+            self.spawn(self.handle(mess, addr, conn))
+        else:
+            self.shed(mess, addr, conn)
+            if conn is not None:
+                conn.done()
+
+    def reply(self, msg):
+        self.protocol.send(msg)
+
+    def spawn(self, coro):
+        """Run a coroutine as task that is kept alive until it is done"""
+        task = self.loop.create_task(coro)
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def handle(self, mess, addr, conn=None):
+        """Handle a client query
+
+        Args:
+            conn (StreamConnection): connection the query came in on, None for UDP
+        """
+        try:
+            await self._handle(mess, addr, conn)
+        finally:
+            if conn is not None:
+                conn.done()
+
+    async def _handle(self, mess, addr, conn):
+        if conn is None:
+            handler = RequestHandler(mess, addr, self.catalog, self.protocol, self.caching,
+                                     self.cache, self.ttl, resolver=self.resolver,
+                                     packets=self.packets, edns_size=self.edns_size)
+        else:
+            handler = RequestHandler(mess, addr, self.catalog, conn, self.caching,
+                                     self.cache, self.ttl, resolver=self.resolver,
+                                     packets=self.packets, max_size=65535,
+                                     edns_size=self.edns_size)
+        steps = handler.answer()
+        try:
+            name = next(steps)
+            while True:
+                name = steps.send(await self.resolve(name))
+        except StopIteration as stop:
+            mess = stop.value
+        handler.sock.send((handler.encode(mess), addr[0], addr[1]))
+        if not self.cache.journal and not self.writing:
+            self.writing = True
+            await self.loop.run_in_executor(None, self.cache.write_cache_file)
+            self.writing = False
+
+    async def resolve(self, name):
+        """Resolve name, falling back to stale data (RFC 8767)
+
+        See RequestHandler.resolve.
+        """
+        if self.stale_deadline <= 0 or self.cache.stale_window <= 0:
+            return await self.resolver.gethostbyname(name)
+        task = self.loop.create_task(self.resolver.gethostbyname(name))
+        try:
+            result = await asyncio.wait_for(asyncio.shield(task), self.stale_deadline)
+            if result[2] or self.cache.lookup_negative(name, Type.A, Class.IN):
+                return result
+        except asyncio.TimeoutError:
+            pass
+        stale = self.cache.lookup_stale(name, Type.A, Class.IN)
+        if stale:
+            return name, [], stale
+        return await task
+
+    def prefetch(self, name, type_, class_):
+        """Refresh a popular cached record set in the background"""
+        if type_ != Type.A or class_ != Class.IN or not self.caching or self.loop is None:
+            self.cache.prefetch_done(name, type_, class_)
+            return
+        async def refresh():
+            try:
+                await self.resolver.gethostbyname(name, refresh=True)
+            finally:
+                self.cache.prefetch_done(name, type_, class_)
+        self.spawn(refresh())
+
+    def shutdown(self):
+        """Shut the server down"""
+        self.cache.write_cache_file() #just to be sure
+        self.cache.close()
+        self.done = True
+        if self.metrics is not None:
+            self.metrics.shutdown()
+        if self.loop is not None and not self.loop.is_closed():
+            self.loop.call_soon_threadsafe(self.stopped.set)
@@ -9,56 +9,613 @@ It is highly recommended to use these.
 """
 
 
+import heapq
 import json
+import os
 import time
+from collections import OrderedDict
+from dns.classes import Class
 from dns.name import Name
 import threading
 
+from dns import metrics
+from dns.journal import CacheJournal
 from dns.resource import ResourceRecord
+from dns.rtypes import Type
+from dns.snapshot import Snapshot, is_snapshot, write_snapshot as write_binary_snapshot
+
+
+def cache_key(dname, type_, class_):
+    """Canonical index key for a record set
+
+    Args:
+        dname (str/Name): domain name
+        type_ (Type): type
+        class_ (Class): class
+    """
+    if not isinstance(dname, Name):
+        dname = Name(dname)
+    return (str(dname).lower(), int(type_), int(class_))
+
+
+ENTRY_OVERHEAD = 200 # rough memory cost of an entry besides name and rdata
+STALE_TTL = 30 # TTL of stale records in answers, see section 4 of RFC 8767
+
+
+class CacheEntry:
+    """A decoded ResourceRecord together with the time it was cached"""
+    __slots__ = ("record", "timestamp", "ttl", "size", "hits")
+
+    def __init__(self, record, timestamp, ttl):
+        """Initialize the entry
+
+        Args:
+            record (ResourceRecord): the cached record
+            timestamp (float): time the record was added
+            ttl (int): lifetime of the entry in seconds
+        """
+        self.record = record
+        self.timestamp = timestamp
+        self.ttl = ttl
+        self.size = ENTRY_OVERHEAD + len(str(record.name)) + len(str(record.rdata.to_dict()))
+        self.hits = 0
+
+    @property
+    def expires(self):
+        """Absolute expiry time of the entry"""
+        return self.timestamp + self.ttl
+
+    def to_dict(self):
+        """Convert the entry to the dict stored in the cache file"""
+        dct = self.record.to_dict()
+        dct["ttl"] = self.ttl
+        dct["timestamp"] = self.timestamp
+        return dct
+
+    @classmethod
+    def from_dict(cls, dct):
+        """Create an entry from a dict stored in the cache file"""
+        return cls(ResourceRecord.from_dict(dct), dct["timestamp"], dct["ttl"])
+
+
+def split_limit(limit, parts):
+    """Divide a limit into parts that add up to it, 0 (no limit) stays 0"""
+    share, rest = divmod(limit, parts)
+    return [share + (i < rest) for i in range(parts)]
+
+
+def with_ttl(record, ttl):
+    """Copy of a record with another TTL, cached records are shared"""
+    return ResourceRecord(record.name, record.type_, record.class_, ttl, record.rdata)
+
+
+class _TrieNode:
+    __slots__ = ("children", "cut")
+
+    def __init__(self):
+        self.children = {}
+        self.cut = False
+
+
+class DelegationTrie:
+    """Index of the owner names of cached NS record sets
+
+    Names are stored label by label from the root down, so the deepest known
+    zone cut above a name is found by walking its labels once.
+    """
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.roots = {}
+
+    @staticmethod
+    def _labels(name):
+        return [l for l in reversed(name.split(".")) if l]
+
+    def add(self, key):
+        """Mark the owner of an NS record set as zone cut
+
+        Args:
+            key ((str, int, int)): canonical key of the NS record set
+        """
+        name, _, class_ = key
+        with self.lock:
+            node = self.roots.setdefault(class_, _TrieNode())
+            for label in self._labels(name):
+                child = node.children.get(label)
+                if child is None:
+                    child = node.children[label] = _TrieNode()
+                node = child
+            node.cut = True
+
+    def cuts(self, name, class_):
+        """Owner names of the zone cuts above name, deepest first
+
+        The root itself is never returned.
+
+        Args:
+            name (str): canonical (lowercased) domain name
+            class_ (int): class
+        """
+        labels = self._labels(name)
+        result = []
+        with self.lock:
+            node = self.roots.get(class_)
+            for depth, label in enumerate(labels):
+                if node is None:
+                    break
+                node = node.children.get(label)
+                if node is not None and node.cut:
+                    result.append(".".join(reversed(labels[:depth + 1])) + ".")
+        result.reverse()
+        return result
+
+    def clear(self):
+        with self.lock:
+            self.roots = {}
+
+    def remove(self, name, class_):
+        """Unmark a zone cut whose NS record set is gone, pruning empty nodes"""
+        labels = self._labels(name)
+        with self.lock:
+            path = [self.roots.get(class_)]
+            for label in labels:
+                if path[-1] is None:
+                    return
+                path.append(path[-1].children.get(label))
+            if path[-1] is None:
+                return
+            path[-1].cut = False
+            for depth in range(len(labels), 0, -1):
+                node = path[depth]
+                if node.cut or node.children:
+                    break
+                del path[depth - 1].children[labels[depth - 1]]
+
+
+class _Shard:
+    """A part of the RecordCache with its own index and lock
+
+    Records are kept decoded in a dict from (name, type, class) to the list of
+    entries of that record set, so a lookup only touches the records it
+    returns. The dict is ordered by last use so the least recently used record
+    sets can be evicted when the shard grows beyond its limits. Expired
+    entries are dropped lazily using a heap ordered by expiry time.
+
+    All methods expect the caller to hold self.lock.
+    """
+
+    def __init__(self, max_entries, max_bytes, prefetch_hits, prefetch_fraction,
+                 stale_window, delegations):
+        self.lock = threading.Lock()
+        self.delegations = delegations
+        self.stale_window = stale_window
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.prefetch_hits = prefetch_hits
+        self.prefetch_fraction = prefetch_fraction
+        self.snapshot = None
+        self.clear()
+
+    def clear(self):
+        self.index = OrderedDict()
+        self.expiry = []
+        self.size = 0
+        self.nbytes = 0
+        self._seq = 0
+        self._faulted = set()
+        self.negatives = OrderedDict()
+        self.refreshing = set()
+
+    def lookup(self, key, now):
+        """Live records of a record set
+
+        Returns:
+            ([ResourceRecord], bool): copies of the records with the TTL they
+                have left, and whether the record set is popular and close
+                enough to expiry to be refreshed
+        """
+        self._expire(now)
+        if self.snapshot is not None and key not in self._faulted:
+            self._fault(key)
+            self.evict()
+        entries = self.index.get(key)
+        if not entries:
+            return [], False
+        self.index.move_to_end(key)
+        records = []
+        prefetch = False
+        for e in entries:
+            if now < e.expires:
+                e.hits += 1
+                records.append(with_ttl(e.record, int(e.expires - now)))
+                if (self.prefetch_hits > 0 and e.hits >= self.prefetch_hits and
+                        e.expires - now <= self.prefetch_fraction * e.ttl):
+                    prefetch = True
+        if prefetch:
+            if key in self.refreshing:
+                prefetch = False
+            else:
+                self.refreshing.add(key)
+        return records, prefetch
+
+    def prune(self, key, now):
+        """Remove a zone cut from the delegations if its NS records are gone,
+        live or stale"""
+        self._expire(now)
+        if self.snapshot is not None and key not in self._faulted:
+            self._fault(key)
+        if not self.index.get(key):
+            self.delegations.remove(key[0], key[2])
+
+    def lookup_stale(self, key, now):
+        """Expired records of a record set that are still within the stale window"""
+        self._expire(now)
+        return [e.record for e in self.index.get(key, ()) if e.expires <= now]
+
+    def contains(self, key, now):
+        """Whether a live record set or negative answer is cached, without
+        counting a hit"""
+        if self.snapshot is not None and key not in self._faulted:
+            self._fault(key)
+            self.evict()
+        if any(now < e.expires for e in self.index.get(key, ())):
+            return True
+        negative = self.negatives.get(key)
+        return negative is not None and now < negative[0]
+
+    def lookup_negative(self, key, now):
+        negative = self.negatives.get(key)
+        if negative is None:
+            return None
+        expires, rcode, soa = negative
+        if now >= expires:
+            del self.negatives[key]
+            return None
+        self.negatives.move_to_end(key)
+        return rcode, with_ttl(soa, int(expires - now))
+
+    def add(self, key, entry):
+        self._expire(entry.timestamp)
+        self.insert(key, entry)
+        self.evict()
+
+    def add_negative(self, key, expires, rcode, soa):
+        self.negatives[key] = (expires, rcode, soa)
+        self.negatives.move_to_end(key)
+        while self.max_entries > 0 and len(self.negatives) > self.max_entries:
+            self.negatives.popitem(last=False)
+
+    def replace(self, key, entries):
+        """Replace a record set, keeping its popularity"""
+        if self.snapshot is not None:
+            self._faulted.add(key) # the snapshot records are replaced too
+        hits = max([e.hits for e in self.index.get(key, ())] + [0])
+        for old in self.index.pop(key, ()):
+            self.size -= 1
+            self.nbytes -= old.size
+        for entry in entries:
+            entry.hits = hits
+            self.insert(key, entry)
+        self.refreshing.discard(key)
+        self.evict()
+
+    def insert(self, key, entry):
+        """Put an entry in the index, replacing one with equal rdata"""
+        if self.snapshot is not None and key not in self._faulted:
+            self._fault(key)
+        self.negatives.pop(key, None)
+        if key[1] == Type.NS:
+            self.delegations.add(key)
+        rdata = entry.record.rdata.to_dict()
+        entries = self.index.get(key)
+        if entries is None:
+            entries = self.index[key] = []
+        else:
+            self.index.move_to_end(key)
+        for i, old in enumerate(entries):
+            if old.record.rdata.to_dict() == rdata:
+                entries[i] = entry
+                self.nbytes += entry.size - old.size
+                break
+        else:
+            entries.append(entry)
+            self.size += 1
+            self.nbytes += entry.size
+        self._seq += 1
+        heapq.heappush(self.expiry, (entry.expires, self._seq, key, entry))
+
+    def _fault(self, key):
+        """Decode the live snapshot records of a record set into the index"""
+        dcts = self.snapshot.lookup(key)
+        if not dcts:
+            return
+        self._faulted.add(key)
+        now = time.time()
+        for dct in dcts:
+            if (now - dct["timestamp"]) < dct["ttl"]:
+                self.insert(key, CacheEntry.from_dict(dct))
+
+    def faulted(self, key):
+        return key in self._faulted
+
+    def _remove(self, key, entry):
+        """Remove a single entry from the index if it is still cached"""
+        entries = self.index.get(key)
+        if not entries:
+            return
+        for i, e in enumerate(entries):
+            if e is entry:
+                del entries[i]
+                self.size -= 1
+                self.nbytes -= entry.size
+                break
+        if not entries:
+            del self.index[key]
+
+    def _expire(self, now):
+        """Drop all entries that expired before now, minus the stale window"""
+        expiry = self.expiry
+        now -= self.stale_window
+        while expiry and expiry[0][0] <= now:
+            _, _, key, entry = heapq.heappop(expiry)
+            self._remove(key, entry)
+        # replaced entries leave stale heap items behind, rebuild once they dominate
+        if len(expiry) > 2 * self.size + 64:
+            self.expiry = [item for item in expiry if self._cached(item[2], item[3])]
+            heapq.heapify(self.expiry)
+
+    def _cached(self, key, entry):
+        return any(e is entry for e in self.index.get(key, ()))
+
+    def evict(self):
+        """Evict least recently used record sets until the limits are met"""
+        while self.index and ((self.max_entries > 0 and self.size > self.max_entries) or
+                              (self.max_bytes > 0 and self.nbytes > self.max_bytes)):
+            _, entries = self.index.popitem(last=False)
+            self.size -= len(entries)
+            self.nbytes -= sum(e.size for e in entries)
+
+    def dump(self, now):
+        return [e.to_dict() for entries in self.index.values()
+                for e in entries if now < e.expires]
 
 
 class RecordCache:
-    """Cache for ResourceRecords"""
-    addLock = threading.Lock()
-    writeLock = threading.Lock()
-    def __init__(self, ttl, cachefile = "cache"):
+    """Cache for ResourceRecords
+
+    The cache is split into shards by a hash of the owner name. Every shard has
+    its own index and lock, so handler threads working on different names
+    rarely wait for each other. Size limits are divided over the shards so the
+    shard limits add up to the limit of the cache, which is never exceeded.
+    Each shard evicts on its own, so eviction is only approximately least
+    recently used for the whole cache and may start before the cache is full
+    when the names hash unevenly.
+
+    Negative answers (NXDOMAIN and NODATA, see RFC 2308) are kept together
+    with the SOA record that determines their lifetime.
+
+    With a stale window, expired records are kept that much longer so they can
+    still be served by lookup_stale when fresh data cannot be obtained in time
+    (RFC 8767).
+
+    If the cache file is a binary snapshot it is memory-mapped, and the records
+    of a record set are only decoded into the index when it is first used.
+
+    Lookups count hits per entry. When a record set that was hit at least
+    prefetch_hits times is looked up within the last prefetch_fraction of its
+    lifetime, the prefetcher is called once so it can refresh the record set
+    with replace_records before it expires.
+    """
+    def __init__(self, ttl, cachefile = "cache", max_entries=0, max_bytes=0,
+                 journal=False, binary=False, shards=1, prefetch_hits=0,
+                 prefetch_fraction=0.1, stale_window=0):
         """Initialize the RecordCache
 
         Args:
             ttl (int): TTL of cached entries (if > 0)
             cachefile (basestring): name of file to be used as cache - default:cache
+            max_entries (int): maximum number of cached records (if > 0)
+            max_bytes (int): approximate memory budget in bytes (if > 0)
+            journal (bool): persist changes through an append-only journal
+            binary (bool): write the cache file as binary snapshot instead of JSON
+            shards (int): number of independently locked parts of the cache,
+                at most max_entries
+            prefetch_hits (int): hits after which entries are refreshed (if > 0)
+            prefetch_fraction (float): fraction of the TTL in which entries are refreshed
+            stale_window (int): seconds expired entries can still be served stale
         """
-        self.records = []
         self.ttl = ttl
         self.cachefile = cachefile
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.binary = binary
+        self.stale_window = stale_window
+        self.writeLock = threading.Lock()
+        self.delegations = DelegationTrie()
+        if max_entries > 0:
+            shards = min(shards, max_entries) # a shard limit of 0 is no limit
+        self.shards = [_Shard(entries, nbytes, prefetch_hits, prefetch_fraction,
+                              stale_window, self.delegations)
+                       for entries, nbytes in zip(split_limit(max_entries, shards),
+                                                  split_limit(max_bytes, shards))]
+        self.prefetcher = None
+        self.journal = CacheJournal(self) if journal else None
+        self.snapshot = None
+        # records were added since the cache file was written
+        self.dirty = False
         self.read_cache_file()
+        if self.journal:
+            self.journal.start()
+
+    def __len__(self):
+        return sum(shard.size for shard in self.shards)
+
+    @property
+    def nbytes(self):
+        return sum(shard.nbytes for shard in self.shards)
+
+    def _shard(self, key):
+        return self.shards[hash(key[0]) % len(self.shards)]
 
     def lookup(self, dname, type_, class_):
         """Lookup resource records in cache
 
         Lookup for the resource records for a domain name with a specific type
-        and class.
+        and class. The records carry the TTL they have left, so answers built
+        from them (and the packet cache) never outlive the cache entries.
 
         Args:
             dname (str): domain name
             type_ (Type): type
             class_ (Class): class
         """
-        dname = Name(dname)
-        rrs = [ResourceRecord.from_dict(r) for r in self.records if (time.time() - r["timestamp"]) <r["ttl"]]
-        rs = [r for r in rrs if r.name == dname and r.class_ == class_ and r.type_ == type_]
-        return rs
+        key = cache_key(dname, type_, class_)
+        shard = self._shard(key)
+        with shard.lock:
+            records, prefetch = shard.lookup(key, time.time())
+        if records:
+            metrics.CACHE_HITS.inc()
+        else:
+            metrics.CACHE_MISSES.inc()
+        if prefetch:
+            if self.prefetcher is None:
+                self.prefetch_done(dname, type_, class_)
+            else:
+                self.prefetcher(str(dname), type_, class_)
+        return records
 
-    def matchByLabel(self, dname, type_, class_):
+    def lookup_stale(self, dname, type_, class_):
+        """Lookup expired resource records within the stale window
+
+        The records are copies with a TTL of STALE_TTL.
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+        """
+        key = cache_key(dname, type_, class_)
+        shard = self._shard(key)
+        with shard.lock:
+            records = shard.lookup_stale(key, time.time())
+        return [with_ttl(r, STALE_TTL) for r in records]
+
+    def replace_records(self, dname, type_, class_, records):
+        """Atomically replace a cached record set
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+            records ([ResourceRecord]): the new records of the set
+        """
+        key = cache_key(dname, type_, class_)
+        now = time.time()
+        entries = []
+        for record in records:
+            record = with_ttl(record, self.ttl if self.ttl > 0 else record.ttl)
+            entries.append(CacheEntry(record, now, record.ttl))
+        shard = self._shard(key)
+        with shard.lock:
+            shard.replace(key, entries)
+        self.dirty = True
+        if self.journal:
+            self.journal.append_replace(key, entries)
+
+    def prefetch_done(self, dname, type_, class_):
+        """Allow the next refresh of a record set after a failed refresh"""
+        key = cache_key(dname, type_, class_)
+        shard = self._shard(key)
+        with shard.lock:
+            shard.refreshing.discard(key)
+
+    def contains(self, dname, type_, class_):
+        """Check whether a lookup would be answered from the cache
+
+        Unlike lookup this neither counts as hit nor triggers a prefetch.
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+
+        Returns:
+            bool: True if live records or a negative answer are cached
+        """
+        key = cache_key(dname, type_, class_)
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.contains(key, time.time())
+
+    def lookup_negative(self, dname, type_, class_):
+        """Lookup a cached negative answer
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+
+        Returns:
+            (RCode, ResourceRecord): rcode and SOA record of the negative
+                answer, its TTL is the time the answer has left (at most the
+                SOA MINIMUM, section 3 of RFC 2308), or None if there is none
         """
+        key = cache_key(dname, type_, class_)
+        shard = self._shard(key)
+        with shard.lock:
+            return shard.lookup_negative(key, time.time())
+
+    def add_negative(self, dname, type_, class_, rcode, soa):
+        """Cache a negative answer
+
+        The answer lives for the minimum of the TTL of the SOA record and its
+        MINIMUM field (section 5 of RFC 2308).
+
+        Args:
+            dname (str): domain name
+            type_ (Type): type
+            class_ (Class): class
+            rcode (RCode): NXDomain for NXDOMAIN or NoError for NODATA
+            soa (ResourceRecord): SOA record from the authority section
+        """
+        ttl = min(soa.ttl, soa.rdata.minimum)
+        if ttl <= 0:
+            return
+        key = cache_key(dname, type_, class_)
+        shard = self._shard(key)
+        with shard.lock:
+            shard.add_negative(key, time.time() + ttl, rcode, soa)
+
+    def matchByLabel(self, dname, type_, class_):
+        """Find the record set for the longest cached suffix of dname
+
+        NS record sets are found through the delegation trie. Cuts whose
+        records expired are removed from the trie on the way.
+
         Args:
             dname (Name): domain name
             type_ (Type): type
             class_ (Class): class
         """
+        if type_ == Type.NS:
+            name = cache_key(dname, type_, class_)[0]
+            for cut in self.delegations.cuts(name, class_):
+                rrs = self.lookup(cut, type_, class_)
+                if rrs:
+                    return rrs
+                # checked again under the shard lock, NS records may have
+                # been added for the cut since the lookup
+                key = cache_key(cut, type_, class_)
+                shard = self._shard(key)
+                with shard.lock:
+                    shard.prune(key, time.time())
+            if self.snapshot is None:
+                return []
+            # NS record sets still only in the snapshot are not in the trie yet
         dname = Name(dname)
         while dname.labels:
-            rrs = self.lookup(str(dname), type_, class_)
+            rrs = self.lookup(dname, type_, class_)
             if rrs:
                 return rrs
             dname.labels = dname.labels[1:]
@@ -68,33 +625,123 @@ class RecordCache:
     def add_record(self, record):
         """Add a new Record to the cache
 
+        A record with the same data as a cached one replaces it, which renews
+        its timestamp.
+
         Args:
             record (ResourceRecord): the record added to the cache
         """
-        dic = record.to_dict()
-        with self.addLock:
-            if dic not in self.records:
-                if self.ttl > 0:
-                    dic["ttl"] = self.ttl
-                dic["timestamp"] = time.time()
-                self.records.append(dic)
-        
+        # the caller keeps using its record, e.g. to encode a response
+        record = with_ttl(record, self.ttl if self.ttl > 0 else record.ttl)
+        entry = CacheEntry(record, time.time(), record.ttl)
+        key = cache_key(record.name, record.type_, record.class_)
+        shard = self._shard(key)
+        with shard.lock:
+            shard.add(key, entry)
+        self.dirty = True
+        if self.journal:
+            self.journal.append(entry)
 
     def read_cache_file(self):
-        """Read the cache file from disk"""
+        """Read the cache file from disk
+
+        In journal mode the journal is replayed on top of the cache file.
+        """
         dcts = []
+        snapshot = None
         try:
-            with open(self.cachefile, "r") as file_:
-                dcts = json.load(file_)
+            if is_snapshot(self.cachefile):
+                snapshot = Snapshot(self.cachefile)
+            else:
+                with open(self.cachefile, "r") as file_:
+                    dcts = json.load(file_)
         except:
             print("could not read cache")
-        self.records = [dct for dct in dcts if (time.time() - dct["timestamp"]) < dct["ttl"]]
+        if self.journal:
+            dcts += self.journal.replay()
+        for shard in self.shards:
+            shard.lock.acquire()
+        try:
+            self.delegations.clear()
+            for shard in self.shards:
+                shard.clear()
+                shard.snapshot = snapshot
+            if self.snapshot is not None:
+                self.snapshot.close()
+            self.snapshot = snapshot
+            now = time.time()
+            for dct in dcts:
+                if "replace" in dct:
+                    key = tuple(dct["replace"])
+                    self._shard(key).replace(key, [])
+                elif (now - dct["timestamp"]) < dct["ttl"]:
+                    entry = CacheEntry.from_dict(dct)
+                    record = entry.record
+                    key = cache_key(record.name, record.type_, record.class_)
+                    self._shard(key).insert(key, entry)
+            for shard in self.shards:
+                shard.evict()
+            # a file in the other format is migrated on the next write
+            self.dirty = (snapshot is None) == self.binary
+        finally:
+            for shard in self.shards:
+                shard.lock.release()
 
-    def write_cache_file(self):
-        """Write the cache file to disk"""
+    def dump(self):
+        """Dicts of all live entries, as stored in the cache file"""
+        now = time.time()
+        dcts = []
+        for shard in self.shards:
+            with shard.lock:
+                dcts += shard.dump(now)
+        if self.snapshot is not None:
+            for dct in self.snapshot:
+                key = cache_key(dct["name"], Type[dct["type"]], Class[dct["class"]])
+                shard = self._shard(key)
+                with shard.lock:
+                    faulted = shard.faulted(key)
+                if not faulted and (now - dct["timestamp"]) < dct["ttl"]:
+                    dcts.append(dct)
+        return dcts
+
+    def write_snapshot(self, dcts):
+        """Atomically replace the cache file
+
+        Args:
+            dcts ([dict]): entry dicts to write
+
+        Returns:
+            bool: True if the file was written
+        """
+        tmpfile = self.cachefile + ".tmp"
         try:
             with self.writeLock:
-                with open(self.cachefile, "w") as file_:
-                    json.dump(self.records, file_, indent=2)
+                if self.binary:
+                    write_binary_snapshot(tmpfile, dcts)
+                else:
+                    with open(tmpfile, "w") as file_:
+                        json.dump(dcts, file_, indent=None if self.journal else 2)
+                os.replace(tmpfile, self.cachefile)
+            return True
         except:
             print("could not write cache")
+            return False
+
+    def write_cache_file(self):
+        """Write the cache file to disk
+
+        In journal mode this compacts the journal into a new cache file.
+        Otherwise the file is only rewritten if records were added since it
+        was last written, so answering from the cache costs no I/O.
+        """
+        if self.journal:
+            self.journal.compact()
+        elif self.dirty:
+            self.dirty = False
+            if not self.write_snapshot(self.dump()):
+                self.dirty = True
+
+    def close(self):
+        """Flush the journal and stop its thread"""
+        if self.journal:
+            self.journal.shutdown()
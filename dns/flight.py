@@ -0,0 +1,73 @@
+#!/usr/bin/env python3
+
+"""Coalescing of identical resolutions
+
+When a popular name expires, many clients ask for it at the same time. With a
+SingleFlight table only the first request resolves the name, the requests
+arriving while that resolution is in flight wait for its result instead of
+querying the name servers again.
+"""
+
+
+import asyncio
+from concurrent.futures import Future
+import threading
+
+
+class SingleFlight:
+    """Table of resolutions in flight"""
+
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.calls = {}
+        self.tasks = {}
+        self.coalesced = 0
+
+    def do(self, key, fn):
+        """Call fn, or wait for the call with the same key that is in flight
+
+        Args:
+            key: key of the call, e.g. (qname, qtype, qclass)
+            fn (callable): function computing the result
+
+        Returns:
+            the result of fn, its exceptions are raised in all waiting threads
+        """
+        with self.lock:
+            future = self.calls.get(key)
+            if future is not None:
+                self.coalesced += 1
+                leader = False
+            else:
+                future = self.calls[key] = Future()
+                leader = True
+        if not leader:
+            return future.result()
+        try:
+            result = fn()
+        except BaseException as e:
+            future.set_exception(e)
+            raise
+        else:
+            future.set_result(result)
+            return result
+        finally:
+            with self.lock:
+                del self.calls[key]
+
+    async def do_async(self, key, fn):
+        """Await fn(), or the call with the same key that is in flight
+
+        Must be used from a single event loop.
+
+        Args:
+            key: key of the call, e.g. (qname, qtype, qclass)
+            fn (callable): function returning the coroutine computing the result
+        """
+        task = self.tasks.get(key)
+        if task is not None:
+            self.coalesced += 1
+            return await asyncio.shield(task)
+        task = self.tasks[key] = asyncio.get_running_loop().create_task(fn())
+        task.add_done_callback(lambda _: self.tasks.pop(key, None))
+        return await asyncio.shield(task)
@@ -0,0 +1,158 @@
+#!/usr/bin/env python3
+
+"""Append-only journal for the record cache
+
+Instead of rewriting the whole cache file after every change, new and changed
+cache entries are appended to a journal next to the cache file. A flush thread
+writes them out in batches and periodically compacts the cache into a fresh
+snapshot, after which the journal is truncated. On startup the snapshot is read
+first and the journal is replayed on top of it.
+
+A replaced record set is journaled as a replace line for its key followed by
+the new entries, so the replay drops the records that were replaced.
+"""
+
+
+import json
+import threading
+import time
+
+
+class _Replace:
+    """Journal line that empties a record set before its new entries"""
+
+    def __init__(self, key):
+        self.key = key
+
+    def to_dict(self):
+        return {"replace": list(self.key)}
+
+
+class CacheJournal(threading.Thread):
+    """Flush thread writing cache entries to an append-only journal"""
+
+    def __init__(self, cache, flush_interval=1.0, flush_size=256,
+                 compact_interval=300.0, compact_size=100000):
+        """Initialize the journal
+
+        Args:
+            cache (RecordCache): the cache whose entries are journaled
+            flush_interval (float): max seconds before pending entries are written
+            flush_size (int): number of pending entries that triggers a write
+            compact_interval (float): seconds between snapshots
+            compact_size (int): number of journaled entries that triggers a snapshot
+        """
+        super().__init__()
+        self.daemon = True
+        self.cache = cache
+        self.filename = cache.cachefile + ".journal"
+        self.flush_interval = flush_interval
+        self.flush_size = flush_size
+        self.compact_interval = compact_interval
+        self.compact_size = compact_size
+        self.pending = []
+        self.journaled = 0
+        self.last_compaction = time.time()
+        self.cond = threading.Condition()
+        self.io_lock = threading.Lock()
+        self.close = False
+
+    def append(self, entry):
+        """Queue a new or changed entry for the journal
+
+        Args:
+            entry (CacheEntry): the entry
+        """
+        with self.cond:
+            self.pending.append(entry)
+            if len(self.pending) >= self.flush_size:
+                self.cond.notify()
+
+    def append_replace(self, key, entries):
+        """Queue the new entries of a replaced record set
+
+        Args:
+            key ((str, int, int)): canonical key of the record set
+            entries ([CacheEntry]): its new entries
+        """
+        with self.cond:
+            self.pending.append(_Replace(key))
+            self.pending += entries
+            if len(self.pending) >= self.flush_size:
+                self.cond.notify()
+
+    def replay(self):
+        """Read the entry dicts in the journal, oldest first
+
+        Replace lines are dicts with the key of the record set as "replace".
+        """
+        dcts = []
+        try:
+            with open(self.filename, "r") as file_:
+                for line in file_:
+                    try:
+                        dcts.append(json.loads(line))
+                    except ValueError:
+                        break # torn write at the end of the journal
+        except OSError:
+            pass
+        self.journaled = len(dcts)
+        return dcts
+
+    def run(self):
+        while True:
+            with self.cond:
+                if not self.close and len(self.pending) < self.flush_size:
+                    self.cond.wait(self.flush_interval)
+                close = self.close
+            self.flush()
+            if (self.journaled >= self.compact_size or
+                    time.time() - self.last_compaction >= self.compact_interval):
+                self.compact()
+            if close:
+                return
+
+    def flush(self):
+        """Write all pending entries to the journal"""
+        with self.io_lock:
+            with self.cond:
+                pending, self.pending = self.pending, []
+            if not pending:
+                return
+            lines = "".join(json.dumps(e.to_dict()) + "\n" for e in pending)
+            try:
+                with open(self.filename, "a") as file_:
+                    file_.write(lines)
+                self.journaled += len(pending)
+            except OSError:
+                print("could not write cache journal")
+
+    def compact(self):
+        """Write a snapshot of the cache and truncate the journal
+
+        Flushes are excluded meanwhile, so nothing is appended to the journal
+        between taking the snapshot and truncating it. The pending entries are
+        dropped before the cache is dumped, so appends only wait for that and
+        not for the dump. Entries added meanwhile stay pending, those that end
+        up in the snapshot as well are harmless on replay.
+        """
+        with self.io_lock:
+            with self.cond:
+                self.pending = []
+            dcts = self.cache.dump()
+            if self.cache.write_snapshot(dcts):
+                try:
+                    open(self.filename, "w").close()
+                    self.journaled = 0
+                except OSError:
+                    print("could not truncate cache journal")
+            self.last_compaction = time.time()
+
+    def shutdown(self):
+        """Flush pending entries, write a final snapshot and stop the thread"""
+        with self.cond:
+            self.close = True
+            self.cond.notify()
+        if self.is_alive():
+            self.join()
+        self.compact()
@@ -11,10 +11,13 @@ import struct
 
 from dns.classes import Class
 from dns.name import Name
-from dns.resource import ResourceRecord
+from dns.resource import ResourceRecord, OPTRecordData
 from dns.rtypes import Type
 
 
+EDNS_SIZE = 1232
+
+
 class Message:
     """DNS message."""
 
@@ -49,6 +52,23 @@ class Message:
         """Getter for all resource records."""
         return self.answers + self.authorities + self.additionals
 
+    def opt(self):
+        """Get the OPT record of EDNS(0), None if the message has none."""
+        for additional in self.additionals:
+            if additional.type_ == Type.OPT:
+                return additional
+        return None
+
+    def add_opt(self, payload_size=EDNS_SIZE):
+        """Add an OPT record advertising the UDP payload size we accept.
+
+        Args:
+            payload_size (int): largest UDP payload the sender can receive.
+        """
+        self.additionals.append(ResourceRecord(Name([]), Type.OPT, payload_size, 0,
+                                               OPTRecordData()))
+        self.header.ar_count = len(self.additionals)
+
     def to_bytes(self):
         """Convert Message to bytes."""
         compress = {}
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+"""Server metrics
+
+Counters, gauges and fixed-bucket histograms that are exported in the
+Prometheus text format over HTTP on localhost.
+
+Recording is on the hot path of every query, so it takes no lock: every thread
+updates its own cell of a metric and the cells are only summed up when the
+metrics are scraped. The cell of a thread is folded into a total when the
+thread exits, so short-lived threads do not pile up cells. The metrics of the
+server components are defined here at module level, so they can be recorded
+without passing a registry around.
+"""
+
+
+from bisect import bisect_left
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+import threading
+import weakref
+
+
+class _Cells:
+    """Cells of a metric, one list of numbers per thread"""
+
+    def __init__(self, size):
+        self.size = size
+        self.local = threading.local()
+        self.live = {}
+        self.total = [0] * size
+        self.lock = threading.Lock()
+
+    def get(self):
+        """The cell of the calling thread"""
+        try:
+            return self.local.cell
+        except AttributeError:
+            pass
+        cell = [0] * self.size
+        with self.lock:
+            self.live[id(cell)] = cell
+        self.local.cell = cell
+        # the thread-local storage is dropped when the thread exits
+        self.local.owner = owner = _Owner()
+        weakref.finalize(owner, self._retire, cell)
+        return cell
+
+    def _retire(self, cell):
+        with self.lock:
+            del self.live[id(cell)]
+            for i, value in enumerate(cell):
+                self.total[i] += value
+
+    def sum(self):
+        """Sum of the cells of all threads"""
+        with self.lock:
+            sums = list(self.total)
+            cells = list(self.live.values())
+        for cell in cells:
+            for i, value in enumerate(cell):
+                sums[i] += value
+        return sums
+
+
+class _Owner:
+    pass
+
+
+class Counter:
+    """Monotonic counter, optionally with labels"""
+
+    def __init__(self, name, help_, labels=()):
+        self.name = name
+        self.help = help_
+        self.label_names = labels
+        self.cells = _Cells(1)
+        self.children = {}
+
+    def inc(self, n=1):
+        """Add n to the counter"""
+        self.cells.get()[0] += n
+
+    def labels(self, *values):
+        """The counter of a combination of label values"""
+        child = self.children.get(values)
+        if child is None:
+            child = self.children.setdefault(values, Counter(self.name, self.help))
+        return child
+
+    @property
+    def value(self):
+        return self.cells.sum()[0]
+
+    def render(self):
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} counter".format(self.name)]
+        if not self.label_names:
+            lines.append("{} {}".format(self.name, self.value))
+        for values, child in sorted(self.children.items()):
+            lines.append("{}{{{}}} {}".format(
+                self.name, _labels(self.label_names, values), child.value))
+        return lines
+
+
+class Gauge:
+    """Value read from a callback when the metrics are scraped"""
+
+    def __init__(self, name, help_, read, type_="gauge"):
+        """Create the gauge
+
+        Args:
+            read (callable): returns the current value
+            type_ (str): "counter" for values that only grow, like counters
+                kept by other objects
+        """
+        self.name = name
+        self.help = help_
+        self.read = read
+        self.type = type_
+
+    def render(self):
+        return ["# HELP {} {}".format(self.name, self.help),
+                "# TYPE {} {}".format(self.name, self.type),
+                "{} {}".format(self.name, self.read())]
+
+
+class Histogram:
+    """Distribution of observations over fixed buckets"""
+
+    def __init__(self, name, help_, buckets):
+        """Create the histogram
+
+        Args:
+            buckets ([float]): sorted upper bounds of the buckets, an infinite
+                bucket is added
+        """
+        self.name = name
+        self.help = help_
+        self.buckets = list(buckets)
+        # counts of the buckets and the sum of the observations
+        self.cells = _Cells(len(self.buckets) + 2)
+
+    def observe(self, value):
+        """Record an observation"""
+        cell = self.cells.get()
+        cell[bisect_left(self.buckets, value)] += 1
+        cell[-1] += value
+
+    def render(self):
+        sums = self.cells.sum()
+        counts, total = sums[:-1], sums[-1]
+        lines = ["# HELP {} {}".format(self.name, self.help),
+                 "# TYPE {} histogram".format(self.name)]
+        cumulative = 0
+        for bound, count in zip(self.buckets + ["+Inf"], counts):
+            cumulative += count
+            lines.append('{}_bucket{{le="{}"}} {}'.format(self.name, bound, cumulative))
+        lines.append("{}_sum {}".format(self.name, total))
+        lines.append("{}_count {}".format(self.name, cumulative))
+        return lines
+
+
+def _labels(names, values):
+    return ",".join('{}="{}"'.format(n, v) for n, v in zip(names, values))
+
+
+class Registry:
+    """Collection of metrics rendered together"""
+
+    def __init__(self):
+        self.metrics = {}
+
+    def register(self, metric):
+        """Add a metric, replacing one with the same name"""
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, help_, labels=()):
+        return self.register(Counter(name, help_, labels))
+
+    def gauge(self, name, help_, read, type_="gauge"):
+        return self.register(Gauge(name, help_, read, type_))
+
+    def histogram(self, name, help_, buckets):
+        return self.register(Histogram(name, help_, buckets))
+
+    def render(self):
+        """The metrics in the Prometheus text format"""
+        lines = []
+        for metric in list(self.metrics.values()):
+            lines += metric.render()
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+RESPONSES = REGISTRY.counter("dns_responses_total",
+                             "Responses sent to clients by rcode", ("rcode",))
+REQUEST_DURATION = REGISTRY.histogram(
+    "dns_request_duration_seconds", "Time from handling a request to its response",
+    [0.0005, 0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5])
+CACHE_HITS = REGISTRY.counter("dns_cache_hits_total", "Record cache lookups with live records")
+CACHE_MISSES = REGISTRY.counter("dns_cache_misses_total", "Record cache lookups without records")
+PACKET_CACHE_HITS = REGISTRY.counter("dns_packet_cache_hits_total",
+                                     "Queries answered from the packet cache")
+UPSTREAM_QUERIES = REGISTRY.counter("dns_upstream_queries_total",
+                                    "Queries sent to name servers")
+UPSTREAM_TIMEOUTS = REGISTRY.counter("dns_upstream_timeouts_total",
+                                     "Queries to name servers that got no response")
+SHED = REGISTRY.counter("dns_shed_total", "Requests shed because the server was overloaded")
+
+
+class MetricsServer(threading.Thread):
+    """HTTP listener serving the metrics of a registry at /metrics"""
+
+    def __init__(self, port, registry=REGISTRY, ip="127.0.0.1"):
+        """Bind the listener
+
+        Args:
+            port (int): port to listen on
+            registry (Registry): metrics to serve
+            ip (str): address to bind, localhost by default
+        """
+        super().__init__()
+        self.daemon = True
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(self):
+                if self.path.split("?")[0] != "/metrics":
+                    self.send_error(404)
+                    return
+                body = registry.render().encode()
+                self.send_response(200)
+                self.send_header("Content-Type", "text/plain; version=0.0.4")
+                self.send_header("Content-Length", str(len(body)))
+                self.end_headers()
+                self.wfile.write(body)
+
+            def log_message(self, format, *args):
+                pass
+        self.httpd = ThreadingHTTPServer((ip, port), Handler)
+        self.httpd.daemon_threads = True
+        self.port = self.httpd.server_address[1]
+
+    def run(self):
+        self.httpd.serve_forever()
+
+    def shutdown(self):
+        self.httpd.shutdown()
+        self.httpd.server_close()
@@ -61,9 +61,14 @@ class Name:
 
     @classmethod
     def from_bytes(cls, packet, offset):
-        """Create Name from bytes."""
+        """Create Name from bytes.
+
+        Compression pointers must point before the labels they follow, so a
+        looping name raises ValueError instead of being followed forever.
+        """
         labels = []
         hops = 0
+        limit = offset
         while True:
             label_length = struct.unpack_from("!B", packet, offset)[0]
             if label_length < 64:
@@ -78,6 +83,9 @@ class Name:
                     break
             elif label_length >= 192:
                 pointer = struct.unpack_from("!H", packet, offset)[0] - (3 << 14)
+                if pointer >= limit:
+                    raise ValueError("compression pointer does not point backwards")
+                limit = pointer
                 if hops == 0:
                     next_offset = offset + 2
                 hops += 1
@@ -0,0 +1,212 @@
+#!/usr/bin/env python3
+
+"""Cache of encoded responses
+
+For repeated queries the server can skip decoding the query into a Message,
+looking up the records and encoding the response again. Responses are cached
+as bytes, keyed on the normalized question of the query. A hit only needs the
+transaction ID, the question (whose case the client may have randomized) and
+the TTLs patched before the bytes are sent.
+"""
+
+
+from collections import OrderedDict
+import struct
+import threading
+import time
+
+from dns import metrics
+from dns.rcodes import RCode
+
+
+# opcode, RD and CD change the response, the other query flags do not
+KEY_FLAGS = 0x7800 | 0x0100 | 0x0010
+EDNS = b"E"
+
+
+def question_end(packet, offset=12):
+    """Offset after the name at offset, None if it is malformed or compressed"""
+    end = len(packet)
+    while offset < end:
+        length = packet[offset]
+        if length == 0:
+            return offset + 1
+        if length >= 64:
+            return None
+        offset += 1 + length
+    return None
+
+
+def question_key(packet):
+    """Key of the first question of a message
+
+    Returns:
+        (bytes, int): the key and the offset after the question, or None if
+            the packet has no (uncompressed) question
+    """
+    if len(packet) < 12 or not struct.unpack_from("!H", packet, 4)[0]:
+        return None
+    end = question_end(packet)
+    if end is None or end + 4 > len(packet):
+        return None
+    end += 4
+    flags = struct.unpack_from("!H", packet, 2)[0]
+    return struct.pack("!H", flags & KEY_FLAGS) + packet[12:end].lower(), end
+
+
+def query_key(packet):
+    """Key of a query with a single question, None if it is no plain query
+
+    The only additional record allowed is the OPT record of EDNS(0), queries
+    with and without one are answered differently and get different keys.
+    """
+    if len(packet) < 12:
+        return None
+    flags, qd_count, an_count, ns_count, ar_count = struct.unpack_from("!5H", packet, 2)
+    if flags & 0x8000 or qd_count != 1 or an_count or ns_count or ar_count > 1:
+        return None
+    key = question_key(packet)
+    if key is None or not ar_count:
+        return key
+    key, end = key
+    if packet[end:end+3] != b"\x00\x00\x29" or len(packet) < end + 11:
+        return None
+    return key + EDNS, end
+
+
+def ttl_offsets(packet):
+    """Offsets of the TTL fields of all resource records in a response
+
+    The TTL field of the OPT record holds flags and is left out.
+
+    Returns:
+        ([int], int, bool): offsets, the offset after the question section and
+            whether the response has an OPT record
+    """
+    qd_count, an_count, ns_count, ar_count = struct.unpack_from("!4H", packet, 4)
+    offset = 12
+    for _ in range(qd_count):
+        offset = _skip_name(packet, offset) + 4
+    qend = offset
+    offsets = []
+    edns = False
+    for _ in range(an_count + ns_count + ar_count):
+        offset = _skip_name(packet, offset)
+        type_, _, _, rdlength = struct.unpack_from("!HHiH", packet, offset)
+        if type_ == 41:
+            edns = True
+        else:
+            offsets.append(offset + 4)
+        offset += 10 + rdlength
+    if offset > len(packet):
+        raise ValueError("truncated response")
+    return offsets, qend, edns
+
+
+def _skip_name(packet, offset):
+    while True:
+        length = packet[offset]
+        if length >= 192:
+            return offset + 2
+        if length == 0:
+            return offset + 1
+        offset += 1 + length
+
+
+class _Response:
+    __slots__ = ("data", "ttls", "stored", "expires")
+
+    def __init__(self, data, ttls, stored, expires):
+        self.data = data
+        self.ttls = ttls
+        self.stored = stored
+        self.expires = expires
+
+
+class PacketCache:
+    """LRU cache of encoded responses"""
+
+    def __init__(self, max_entries=10000, lifetime=1.0):
+        """Initialize the cache
+
+        Args:
+            max_entries (int): maximum number of cached responses
+            lifetime (float): fraction of the shortest TTL a response is
+                cached, lower it to let the record cache see queries again
+                before the records expire (e.g. for prefetching)
+        """
+        self.max_entries = max_entries
+        self.lifetime = lifetime
+        self.responses = OrderedDict()
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def lookup(self, query):
+        """Build the response to a query from the cache
+
+        Args:
+            query (bytes): the raw query
+
+        Returns:
+            bytes: the response, or None on a miss
+        """
+        key = query_key(query)
+        if key is None:
+            return None
+        key, qend = key
+        now = time.time()
+        with self.lock:
+            response = self.responses.get(key)
+            if response is None or now >= response.expires:
+                if response is not None:
+                    del self.responses[key]
+                self.misses += 1
+                return None
+            self.responses.move_to_end(key)
+            self.hits += 1
+        metrics.PACKET_CACHE_HITS.inc()
+        metrics.RESPONSES.labels(RCode(response.data[3] & 0xf)).inc()
+        data = bytearray(response.data)
+        data[0:2] = query[0:2]
+        data[12:qend] = query[12:qend]
+        elapsed = int(now - response.stored)
+        for offset, ttl in response.ttls:
+            struct.pack_into("!i", data, offset, max(ttl - elapsed, 0))
+        return bytes(data)
+
+    def store(self, response):
+        """Cache a response for the lifetime fraction of its shortest TTL
+
+        Only successful and NXDOMAIN responses with at least one record that
+        are not truncated are cached. The key is taken from the first question
+        of the response.
+
+        Args:
+            response (bytes): the encoded response
+        """
+        key = question_key(response)
+        if key is None:
+            return
+        key = key[0]
+        flags = struct.unpack_from("!H", response, 2)[0]
+        if flags & 0x0200 or (flags & 0xf) not in (0, 3):
+            return
+        try:
+            offsets, _, edns = ttl_offsets(response)
+        except (IndexError, ValueError, struct.error):
+            return
+        if not offsets:
+            return
+        if edns:
+            key += EDNS
+        ttls = [(offset, struct.unpack_from("!i", response, offset)[0]) for offset in offsets]
+        lifetime = min(ttl for _, ttl in ttls) * self.lifetime
+        if lifetime <= 0:
+            return
+        now = time.time()
+        with self.lock:
+            self.responses[key] = _Response(bytes(response), ttls, now, now + lifetime)
+            self.responses.move_to_end(key)
+            while len(self.responses) > self.max_entries:
+                self.responses.popitem(last=False)
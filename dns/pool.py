@@ -0,0 +1,110 @@
+#!/usr/bin/env python3
+
+"""A fixed-size pool of worker threads
+
+The server hands requests to a pool of long-lived worker threads through a
+bounded queue instead of starting a thread per datagram. Every worker keeps its
+own Resolver, so resolver state is reused across requests. Urgent jobs, like
+requests answered from the cache, are taken before the others.
+"""
+
+
+import itertools
+import queue
+import threading
+import time
+
+
+class WorkerPool:
+    """Worker threads taking jobs from a bounded queue"""
+
+    def __init__(self, size, queue_size, make_resolver):
+        """Start the workers
+
+        Args:
+            size (int): number of worker threads
+            queue_size (int): maximum number of queued jobs
+            make_resolver (callable): creates the Resolver of a worker
+        """
+        self.size = size
+        self.queue = queue.PriorityQueue(queue_size)
+        self.order = itertools.count()
+        self.lock = threading.Lock()
+        self.busy = 0
+        self.busy_time = 0.0
+        self.completed = 0
+        self.rejected = 0
+        self.started = time.time()
+        self.workers = []
+        for i in range(size):
+            worker = threading.Thread(target=self._work, args=(make_resolver(),),
+                                      name="worker-{}".format(i))
+            worker.daemon = True
+            worker.start()
+            self.workers.append(worker)
+
+    def submit(self, job, urgent=False):
+        """Queue a job without blocking
+
+        Args:
+            job (callable): called with the Resolver of the worker
+            urgent (bool): run the job before the non-urgent queued jobs
+
+        Returns:
+            bool: False if the queue is full and the job was rejected
+        """
+        try:
+            self.queue.put_nowait((0 if urgent else 1, next(self.order), job))
+            return True
+        except queue.Full:
+            with self.lock:
+                self.rejected += 1
+            return False
+
+    def _work(self, resolver):
+        while True:
+            _, _, job = self.queue.get()
+            if job is None:
+                return
+            with self.lock:
+                self.busy += 1
+            t = time.time()
+            try:
+                job(resolver)
+            except Exception as e:
+                print("worker failed to handle request:", e)
+            finally:
+                with self.lock:
+                    self.busy -= 1
+                    self.busy_time += time.time() - t
+                    self.completed += 1
+
+    def stats(self):
+        """Counters for sizing the pool
+
+        Returns:
+            dict: queue depth, busy workers, worker utilization since start
+                (0 to 1) and numbers of completed and rejected jobs
+        """
+        with self.lock:
+            elapsed = max(time.time() - self.started, 1e-9)
+            return {"workers": self.size,
+                    "queue_depth": self.queue.qsize(),
+                    "queue_size": self.queue.maxsize,
+                    "busy": self.busy,
+                    "utilization": self.busy_time / (elapsed * self.size),
+                    "completed": self.completed,
+                    "rejected": self.rejected}
+
+    def shutdown(self):
+        """Stop the workers once they finished their current job"""
+        for _ in self.workers:
+            while True:
+                try:
+                    self.queue.put((2, next(self.order), None), timeout=0.1)
+                    break
+                except queue.Full:
+                    try:
+                        self.queue.get_nowait()
+                    except queue.Empty:
+                        pass
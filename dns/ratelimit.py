@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+
+"""Response rate limiting
+
+Clients are grouped by address prefix and each prefix gets a token bucket that
+is refilled with the allowed responses per second. Queries from a prefix with
+an empty bucket are dropped, except every slip-th limited query of the prefix,
+which is answered with an empty truncated response so a legitimate client
+behind a spoofed or noisy prefix can still get its answer over TCP.
+
+The limiter works on the raw datagram, it runs before the query is decoded.
+"""
+
+
+from collections import OrderedDict
+import socket
+import struct
+import threading
+import time
+
+from dns.packetcache import question_end
+
+
+class _Bucket:
+    __slots__ = ("tokens", "last", "limited")
+
+    def __init__(self, tokens, last):
+        self.tokens = tokens
+        self.last = last
+        self.limited = 0
+
+
+def truncated_reply(query):
+    """Empty response with the TC flag set, None if the query is malformed"""
+    end = question_end(query)
+    if end is None or end + 4 > len(query):
+        return None
+    flags = struct.unpack_from("!H", query, 2)[0]
+    flags = 0x8000 | 0x0200 | (flags & (0x7800 | 0x0100 | 0x0010))
+    return query[:2] + struct.pack("!5H", flags, 1, 0, 0, 0) + query[12:end + 4]
+
+
+class RateLimiter:
+    """Token buckets per client prefix"""
+
+    def __init__(self, rate, burst=0, slip=2, ipv4_prefix=24, ipv6_prefix=56,
+                 max_entries=10000):
+        """Initialize the limiter
+
+        Args:
+            rate (float): responses per second allowed per prefix
+            burst (float): size of the buckets, defaults to rate
+            slip (int): answer every slip-th limited query with a truncated
+                response (if > 0), drop the others
+            ipv4_prefix (int): length of the IPv4 prefixes, multiple of 8
+            ipv6_prefix (int): length of the IPv6 prefixes, multiple of 8
+            max_entries (int): maximum number of tracked prefixes
+        """
+        self.rate = rate
+        self.burst = burst if burst > 0 else rate
+        self.slip = slip
+        self.ipv4_bytes = ipv4_prefix // 8
+        self.ipv6_bytes = ipv6_prefix // 8
+        self.max_entries = max_entries
+        # a bucket that is refilled completely is the same as a new one
+        self.window = self.burst / self.rate
+        self.buckets = OrderedDict()
+        self.lock = threading.Lock()
+        self.dropped = 0
+        self.slipped = 0
+
+    def prefix(self, ip):
+        """Key of the prefix of an address"""
+        if ":" in ip:
+            return socket.inet_pton(socket.AF_INET6, ip)[:self.ipv6_bytes]
+        return socket.inet_aton(ip)[:self.ipv4_bytes]
+
+    def check(self, data, ip):
+        """Take a token for a datagram
+
+        Responses (QR set) are not limited, those are answers of name servers
+        to our own queries.
+
+        Args:
+            data (bytes): the raw datagram
+            ip (str): address of the sender
+
+        Returns:
+            (bool, bytes): whether the datagram may be handled, and the reply
+                to send instead if it may not (None to drop it)
+        """
+        if len(data) < 3 or data[2] & 0x80:
+            return True, None
+        try:
+            key = self.prefix(ip)
+        except OSError:
+            return True, None
+        now = time.monotonic()
+        with self.lock:
+            bucket = self.buckets.get(key)
+            if bucket is None:
+                bucket = self.buckets[key] = _Bucket(self.burst, now)
+            else:
+                bucket.tokens = min(self.burst, bucket.tokens + (now - bucket.last) * self.rate)
+                bucket.last = now
+                self.buckets.move_to_end(key)
+            self._expire(now)
+            if bucket.tokens >= 1:
+                bucket.tokens -= 1
+                return True, None
+            bucket.limited += 1
+            slip = self.slip > 0 and bucket.limited % self.slip == 0
+            if slip:
+                self.slipped += 1
+            else:
+                self.dropped += 1
+        return False, truncated_reply(data) if slip else None
+
+    def _expire(self, now):
+        while self.buckets:
+            key, bucket = next(iter(self.buckets.items()))
+            if len(self.buckets) <= self.max_entries and bucket.last + self.window > now:
+                break
+            del self.buckets[key]
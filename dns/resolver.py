@@ -8,48 +8,72 @@ DNS server, but with a different list of servers.
 """
 
 
+import random
 import socket
 import time
 
+from dns import metrics
 from dns.classes import Class
-from dns.message import Message, Question, Header
+from dns.message import EDNS_SIZE, Message, Question, Header
 from dns.name import Name
+from dns.rcodes import RCode
 from dns.rtypes import Type
 from dns.cache import RecordCache
-from dns.zone import Zone
+from dns.roothints import root_hints
 from dns.socketWrapper import SocketWrapper
+from dns.tcp import query_tcp
+from dns.transactions import attempts, random_id
 import time
 
 class Resolver:
     """DNS resolver"""
 
-    def __init__(self, timeout, caching, ttl, sock = None,cache = None):
+    def __init__(self, timeout, caching, ttl, sock = None,cache = None, flights = None,
+                 edns_size = EDNS_SIZE, attempt_timeout = 0.8, retries = 2, ports = None,
+                 hints = None, server_timeout = 1.6):
         """Initialize the resolver
 
         Args:
+            timeout (float): seconds a resolution may take, it gives up
+                after that
             caching (bool): caching is enabled if True
             ttl (int): ttl of cache entries (if > 0)
+            flights (SingleFlight): table to coalesce concurrent resolutions
+                of the same name in
+            edns_size (int): UDP payload size advertised to name servers with
+                EDNS(0) (0 disables EDNS)
+            attempt_timeout (float): seconds to wait for a response before
+                the query is sent again, doubled on every retransmission
+            retries (int): retransmissions of a query to a name server before
+                the next one is tried
+            server_timeout (float): seconds the attempts to one name server
+                may take together before the next one is tried (if > 0)
+            ports ([SocketWrapper]): sockets on random source ports to send
+                queries from instead of sock, one is picked per attempt
+            hints (RootHints): root name servers, those of the process by
+                default
         """
         self.timeout = timeout
+        self.attempt_timeout = attempt_timeout
+        self.retries = retries
+        self.server_timeout = server_timeout
+        self.ports = ports
+        self.flights = flights
+        self.edns_size = edns_size
         self.caching = caching
         self.rc = cache
         self.ttl = ttl
         if self.rc == None:
             self.rc = RecordCache(self.ttl)
-        self.zone = Zone()
+        self.hints = hints
+        if self.hints is None:
+            self.hints = root_hints()
         self.sock = sock
         if self.sock is None:
-            self.sock = SocketWrapper(53)
+            self.sock = SocketWrapper(53, bufsize=max(self.edns_size, 512))
             self.sock.start()
 
-    def _make_id(self):
-        gm = time.gmtime()
-        mss = str(time.time()).split(".")[1][0:3] 
-        gms = str(gm.tm_sec)
-        id = int(gms + mss)
-        return id 
-
-    def gethostbyname(self, hostname):
+    def gethostbyname(self, hostname, refresh=False):
         """Translate a host name to IPv4 address.
 
         Currently this method contains an example. You will have to replace
@@ -57,19 +81,104 @@ class Resolver:
 
         Args:
             hostname (str): the hostname to resolve
+            refresh (bool): ignore cached answers for hostname and replace
+                them with the result
 
         Returns:
             (str, [str], [str]): (hostname, aliaslist, ipaddrlist)
         """
+        if self.flights is not None and not refresh:
+            return self.flights.do(self.flight_key(hostname),
+                                   lambda: self._gethostbyname(hostname))
+        return self._gethostbyname(hostname, refresh)
+
+    def flight_key(self, hostname):
+        """Key of a resolution in the table of resolutions in flight"""
+        return str(Name(hostname)).lower(), Type.A, Class.IN
+
+    def _gethostbyname(self, hostname, refresh=False):
+        return self.drive(self.resolve(hostname, refresh))
+
+    def prime(self):
+        """Refresh the root hints with a priming query (RFC 8109)
+
+        Returns:
+            bool: whether a root server answered and the hints were replaced
+        """
+        return self.drive(self.priming())
+
+    def drive(self, steps):
+        """Run a coroutine like resolve, exchanging its queries with name servers"""
+        deadline = time.monotonic() + self.timeout
+        try:
+            query, addr = next(steps)
+            while True:
+                query, addr = steps.send(self.exchange(query, addr, deadline))
+        except StopIteration as stop:
+            return stop.value
+
+    def exchange(self, query, addr, deadline=None):
+        """Send a query to a name server and wait for its response
+
+        The query is retransmitted with exponential backoff, every
+        transmission with a new random ID. A truncated response is retried
+        over TCP. Once the deadline has passed, None is returned at once, so
+        the resolution ends without querying further.
+
+        Args:
+            query (Message): the query
+            addr (str): IP address of the name server
+            deadline (float): time.monotonic() at which the resolution gives
+                up, timeout seconds from now by default
+
+        Returns:
+            Message: the response, None if there was none within the timeout
+        """
+        if deadline is None:
+            deadline = time.monotonic() + self.timeout
+        for timeout in self.attempts(deadline):
+            query.header.ident = random_id()
+            sock = random.choice(self.ports) if self.ports else self.sock
+            response = sock.exchange(query, addr, timeout)
+            if response is not None:
+                break
+        else:
+            return None
+        left = deadline - time.monotonic()
+        if response.header.tc:
+            return query_tcp(query, addr, left) if left > 0 else None
+        return response
+
+    def attempts(self, deadline):
+        """Timeouts of the attempts to send a query, see transactions.attempts"""
+        return attempts(self.attempt_timeout, self.retries, deadline, self.server_timeout)
+
+    def resolve(self, hostname, refresh=False):
+        """The resolution algorithm as coroutine
+
+        The generator yields (query, addr) pairs of queries that have to be
+        sent to name servers and expects the response (or None if there was
+        none) to be sent back in. Its return value is the result of
+        gethostbyname. This way the same algorithm runs on top of blocking
+        sockets and on top of an event loop.
+
+        Args:
+            hostname (str): the hostname to resolve
+            refresh (bool): ignore cached answers for hostname and replace
+                them with the result
+        """
         alias_list = []
         a_list = []
         slist = []        
         found = False
 
-        acs = self.getRecordsFromCache(hostname,Type.A, Class.IN) 
-        if acs:
-            a_list += acs
-            return hostname, alias_list, a_list
+        if not refresh:
+            acs = self.getRecordsFromCache(hostname,Type.A, Class.IN) 
+            if acs:
+                a_list += acs
+                return hostname, alias_list, a_list
+            if self.getNegativeFromCache(hostname, Type.A, Class.IN):
+                return hostname, alias_list, a_list
 
         nscs = self.matchByLabel(hostname, Type.NS, Class.IN)
         for ns in nscs:
@@ -80,21 +189,17 @@ class Resolver:
                 slist += [ns]
 
 
-        id = self._make_id()
-
         # Create and send query
         question = Question(Name(hostname), Type.A, Class.IN)
-        header = Header(id, 0, 1, 0, 0, 0)
+        header = Header(random_id(), 0, 1, 0, 0, 0)
         header.qr = 0  # 0 for query
         header.opcode = 0 # standad query
         header.rd = 0 # not recursive
         query = Message(header, [question])
+        if self.edns_size > 0:
+            query.add_opt(self.edns_size)
 
-        self.zone.read_master_file('dns/root.zone')
-
-        sbelt = []
-        for root in list(self.zone.records.values()):
-            sbelt += [r for r in root if r.type_ == Type.A]
+        sbelt = list(self.hints.servers)
 
 
 
@@ -103,32 +208,40 @@ class Resolver:
                 rr = slist.pop()
                 if rr.type_ == Type.A:
                     addr = rr.rdata.address
-                    self.sock.send((query,addr, 53))
                 elif rr.type_ == Type.NS:
                     fqdn = str(rr.rdata.nsdname)
-                    _, _, a_rrs = self.gethostbyname(fqdn)
+                    _, _, a_rrs = yield from self.resolve(fqdn)
                     slist += a_rrs 
                     continue
                 elif rr.type_ == Type.CNAME:
                     fqdn = str(rr.rdata.cname)
-                    _, cname_rrs, a_rrs = self.gethostbyname(fqdn)
+                    _, cname_rrs, a_rrs = yield from self.resolve(fqdn)
                     a_list += a_rrs
                     alias_list += cname_rrs
                     break
+                else:
+                    continue
 
             elif sbelt:
                 rr = sbelt.pop()
                 addr = rr.rdata.address
-                self.sock.send((query,addr, 53))
             else:
                 break
 
-            # Receive response
-            data = None
-            while not data:
-                data = self.sock.msgThere(id)
-            response,_ = data[0]
-            #response = Message.from_bytes(data)
+            metrics.UPSTREAM_QUERIES.inc()
+            response = yield query, addr
+            if response is None:
+                metrics.UPSTREAM_TIMEOUTS.inc()
+                continue
+
+            # NXDOMAIN or NODATA, see section 2 of RFC 2308
+            soas = [auth for auth in response.authorities if auth.type_ == Type.SOA]
+            if not response.answers and (response.header.rcode == RCode.NXDomain or
+                                         (response.header.rcode == RCode.NoError and soas)):
+                if soas:
+                    self.addNegativeToCache(hostname, Type.A, Class.IN,
+                                            RCode(response.header.rcode), soas[0])
+                break
 
             for answer in response.answers:                
                 if answer.type_ == Type.A:
@@ -161,13 +274,38 @@ class Resolver:
                 else:
                     slist += [ns] 
 
+        if refresh and self.caching:
+            rrs = [rr for rr in a_list if rr.name == Name(hostname)]
+            if rrs:
+                self.rc.replace_records(hostname, Type.A, Class.IN, rrs)
 
         return hostname, alias_list, a_list
 
+    def priming(self):
+        """The priming of the root hints as coroutine, see resolve"""
+        for rr in reversed(self.hints.servers):
+            query = self.hints.priming_query()
+            if self.edns_size > 0:
+                query.add_opt(self.edns_size)
+            response = yield query, rr.rdata.address
+            if response is not None and self.hints.update(response):
+                return True
+        return False
+
     def addRecordToCache(self, record):
         if self.caching:
             self.rc.add_record(record)
 
+    def addNegativeToCache(self, dname, t, c, rcode, soa):
+        if self.caching:
+            self.rc.add_negative(dname, t, c, rcode, soa)
+
+    def getNegativeFromCache(self, dname, t=Type.A, c=Class.IN):
+        if self.caching:
+            return self.rc.lookup_negative(dname, t, c)
+        else:
+            return None
+
     def getRecordsFromCache(self, dname, t=Type.A, c=Class.IN):
         if self.caching:
             return self.rc.lookup(dname,t,c)
@@ -50,10 +50,12 @@ class ResourceRecord(object):
             type_ = Type(struct.unpack_from("!H", packet, offset)[0])
         except ValueError:
             type_ = Type.OTHER
-        try:
-            class_ = Class(struct.unpack_from("!H", packet, offset + 2)[0])
-        except ValueError:
-            class_ = Class.IN
+        class_ = struct.unpack_from("!H", packet, offset + 2)[0]
+        if type_ != Type.OPT:  # the class of OPT is the UDP payload size
+            try:
+                class_ = Class(class_)
+            except ValueError:
+                class_ = Class.IN
         ttl, rdlength = struct.unpack_from("!iH", packet, offset + 4)
         offset += 10
         rdata = RecordData.create_from_bytes(type_, packet, offset, rdlength)
@@ -94,7 +96,8 @@ class RecordData:
             Type.A: ARecordData,
             Type.CNAME: CNAMERecordData,
             Type.NS: NSRecordData,
-            Type.SOA: SOARecordData
+            Type.SOA: SOARecordData,
+            Type.OPT: OPTRecordData
         }
         if type_ in classdict:
             return classdict[type_].from_bytes(packet, offset, rdlength)
@@ -108,7 +111,8 @@ class RecordData:
             Type.A: ARecordData,
             Type.CNAME: CNAMERecordData,
             Type.NS: NSRecordData,
-            Type.SOA: SOARecordData
+            Type.SOA: SOARecordData,
+            Type.OPT: OPTRecordData
         }
         if type_ in classdict:
             return classdict[type_].from_dict(dct)
@@ -279,12 +283,13 @@ class SOARecordData(RecordData):
             compress (dict): dict from domain names to pointers.
         """
         data = self.mname.to_bytes(offset, compress)
-        data += self.rname.to_bytes(len(data), compress)
+        data += self.rname.to_bytes(offset + len(data), compress)
         data += struct.pack("!I", self.serial)
         data += struct.pack("!i", self.refresh)
         data += struct.pack("!i", self.retry)
         data += struct.pack("!i", self.expire)
         data += struct.pack("!I", self.minimum)
+        return data
 
     @classmethod
     def from_bytes(cls, packet, offset, rdlength):
@@ -302,7 +307,7 @@ class SOARecordData(RecordData):
         retry = struct.unpack_from("!i", packet, offset + 8)[0]
         expire = struct.unpack_from("!i", packet, offset + 12)[0]
         minimum = struct.unpack_from("!I", packet, offset + 16)[0]
-        return cls(mname, rname, serial, refresh, retry, expire, minimum), offset + 20
+        return cls(mname, rname, serial, refresh, retry, expire, minimum)
 
     def to_dict(self):
         """Convert to dict."""
@@ -318,6 +323,54 @@ class SOARecordData(RecordData):
                    dct["refresh"], dct["retry"], dct["expire"], dct["minimum"])
 
 
+class OPTRecordData(RecordData):
+    """Record data for the OPT pseudo-RR of EDNS(0), see RFC 6891."""
+
+    def __init__(self, options=None):
+        """Create RecordData for OPT type.
+
+        Args:
+            options ([(int, bytes)]): option codes and data.
+        """
+        self.options = options if options is not None else []
+
+    def to_bytes(self, offset, compress):
+        """Convert to bytes.
+
+        Args:
+            offset (int): offset in packet.
+            compress (dict): dict from domain names to pointers.
+        """
+        return b"".join(struct.pack("!HH", code, len(data)) + data
+                        for code, data in self.options)
+
+    @classmethod
+    def from_bytes(cls, packet, offset, rdlength):
+        """Create a RecordData object from bytes.
+
+        Args:
+            packet (bytes): packet.
+            offset (int): offset in message.
+            rdlength (int): length of rdata.
+        """
+        options = []
+        end = offset + rdlength
+        while offset + 4 <= end:
+            code, length = struct.unpack_from("!HH", packet, offset)
+            options.append((code, packet[offset+4:offset+4+length]))
+            offset += 4 + length
+        return cls(options)
+
+    def to_dict(self):
+        """Convert to dict."""
+        return {"options" : [[code, data.hex()] for code, data in self.options]}
+
+    @classmethod
+    def from_dict(cls, dct):
+        """Create a RecordData object from dict."""
+        return cls([(code, bytes.fromhex(data)) for code, data in dct["options"]])
+
+
 class GenericRecordData(RecordData):
     """Generic Record Data (for other types)."""
 
@@ -0,0 +1,85 @@
+#!/usr/bin/env python3
+
+"""Root hints
+
+The addresses of the root name servers, where a resolution starts when the
+cache knows no name servers closer to the name (the SBELT of section 5.3.3 of
+RFC 1034). The hints file is read once per process and shared read-only by all
+resolvers. A priming query (RFC 8109) asks a root server for the current root
+name servers and replaces the hints with the answer.
+"""
+
+
+import os
+import threading
+
+from dns.classes import Class
+from dns.message import Header, Message, Question
+from dns.name import Name
+from dns.rcodes import RCode
+from dns.rtypes import Type
+from dns.transactions import random_id
+from dns.zone import Zone
+
+
+ROOT_ZONE = os.path.join(os.path.dirname(os.path.abspath(__file__)), "root.zone")
+
+
+class RootHints:
+    """Addresses of the root name servers"""
+
+    def __init__(self, servers=()):
+        """Initialize the hints
+
+        Args:
+            servers ([ResourceRecord]): A records of the root name servers
+        """
+        # replaced as a whole, so readers never see a partial update
+        self.servers = tuple(servers)
+        self.primed = False
+
+    @classmethod
+    def from_file(cls, filename=ROOT_ZONE):
+        """Read the hints from a master file like root.zone"""
+        zone = Zone().read_master_file(filename)
+        return cls(rr for rrs in zone.records.values() for rr in rrs if rr.type_ == Type.A)
+
+    def priming_query(self):
+        """Query for the NS records of the root"""
+        header = Header(random_id(), 0, 1, 0, 0, 0)
+        return Message(header, [Question(Name([]), Type.NS, Class.IN)])
+
+    def update(self, response):
+        """Replace the hints with the answer to a priming query
+
+        Only root name servers with an address in the additional section are
+        taken over, the hints are kept if there are none.
+
+        Returns:
+            bool: whether the hints were replaced
+        """
+        if response.header.rcode != RCode.NoError:
+            return False
+        names = [rr.rdata.nsdname for rr in response.answers
+                 if rr.type_ == Type.NS and rr.name == Name([])]
+        servers = [rr for rr in response.additionals
+                   if rr.type_ == Type.A and rr.name in names]
+        if not servers:
+            return False
+        self.servers = tuple(servers)
+        self.primed = True
+        return True
+
+
+_hints = None
+_lock = threading.Lock()
+
+
+def root_hints():
+    """The root hints of this process, read from ROOT_ZONE on first use"""
+    global _hints
+    if _hints is None:
+        with _lock:
+            if _hints is None:
+                _hints = RootHints.from_file()
+    return _hints
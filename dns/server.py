@@ -7,37 +7,93 @@ server using the algorithm described in section 4.3.2 of RFC 1034.
 """
 
 
-from threading import Thread
+from threading import Event, Lock
 import socket
+import time
+from dns import metrics
 from dns.zone import *
 from dns.message import *
 from dns.cache import RecordCache
+from dns.flight import SingleFlight
+from dns.packetcache import PacketCache
+from dns.pool import WorkerPool
+from dns.rcodes import RCode
+from dns.ratelimit import RateLimiter
 from dns.resolver import Resolver
 from dns.socketWrapper import SocketWrapper
+from dns.tcp import TCPListener, UDP_SIZE
+from dns.transactions import random_ports
 from dns.resource import ResourceRecord
 from dns.cache import RecordCache
 
 
-class RequestHandler(Thread):
+class RequestHandler:
     """A handler for requests to the DNS server"""
 
-    def __init__(self, data, addr, catalog, sock, caching, cache, ttl=0):
-        """Initialize the handler thread"""
-        super().__init__()
-        self.daemon = True
+    def __init__(self, data, addr, catalog, sock, caching, cache, ttl=0,
+                 stale_deadline=0, resolver=None, packets=None, max_size=UDP_SIZE,
+                 edns_size=0, pool=None):
+        """Initialize the handler
+
+        Args:
+            stale_deadline (float): seconds after which a recursion is answered
+                from stale cache data, if the cache keeps any
+            resolver (Resolver): resolver to use instead of a new one
+            packets (PacketCache): cache the encoded response is stored in
+            max_size (int): size of the largest response the client accepts,
+                larger responses are truncated
+            edns_size (int): largest UDP payload the server sends to clients
+                that advertise a larger size with EDNS(0) (if > 0)
+            pool (WorkerPool): pool running the recursions that may be
+                answered stale after the stale deadline
+        """
         self.data = data
         self.addr = addr
         self.catalog = catalog
         self.cache = cache
-        self.resolver = Resolver(5, caching, ttl, sock, self.cache)
+        self.resolver = resolver
+        if self.resolver is None:
+            self.resolver = Resolver(5, caching, ttl, sock, self.cache)
         self.sock = sock
+        self.stale_deadline = stale_deadline
+        self.packets = packets
+        self.max_size = max_size
+        self.edns_size = edns_size
+        self.pool = pool
+        self.started = time.perf_counter()
 
     def run(self):
-        """ Run the handler thread"""
+        """Handle the request and send the response"""
+        steps = self.answer()
+        try:
+            name = next(steps)
+            while True:
+                name = steps.send(self.resolve(name))
+        except StopIteration as stop:
+            mess = stop.value
+
+        msg = (self.encode(mess), self.addr[0], self.addr[1])
+        self.sock.send(msg)
+        if not self.cache.journal:
+            self.cache.write_cache_file()#write the cached records so they dont get lost
+
+    def answer(self):
+        """Build the response as coroutine
+
+        The generator yields the names that need a recursive resolution and
+        expects the result of gethostbyname to be sent back in. It returns the
+        response message. This way the threaded and the asyncio engine share
+        the same request handling.
+        """
         mess = self.data
         rd = mess.header.rd
         questions = mess.questions
-        
+        opt = mess.opt()
+        if opt is not None:
+            mess.additionals.remove(opt)
+            if self.edns_size > 0:
+                self.max_size = max(self.max_size, min(opt.class_, self.edns_size))
+
 
         for q in questions:
             name = q.qname
@@ -65,9 +121,14 @@ class RequestHandler(Thread):
                 continue
             elif cached_cname and type_ != Type.CNAME:
                 for rr in cached_cname:
-                    mess.answer.append(rr)
+                    mess.answers.append(rr)
                     questions.append(Question( rr.rdata.cname , type_, class_))
                 continue
+
+            negative = self.lookupNegative(str(name), type_, class_)
+            if negative:
+                self.addNegative(mess, negative)
+                continue
             elif not rd:
                 matched = self.cache.matchByLabel(str(name), Type.NS, class_)
                 mess.authorities += matched
@@ -77,23 +138,114 @@ class RequestHandler(Thread):
                 continue
 
             if rd:
-                hostname, aliaslist, ipaddrlist = self.resolver.gethostbyname(str(name))
+                hostname, aliaslist, ipaddrlist = yield str(name)
                 mess.answers += aliaslist
                 mess.answers += ipaddrlist
                 mess.header.ra = 1            
+                if not aliaslist and not ipaddrlist:
+                    negative = self.lookupNegative(str(name), type_, class_)
+                    if negative:
+                        self.addNegative(mess, negative)
                 continue
 
         
+        if opt is not None and self.edns_size > 0:
+            mess.add_opt(max(self.edns_size, UDP_SIZE))
+
         # adjust header
         mess.header.qr = 1
         mess.header.qd_count = len(mess.questions)
         mess.header.an_count = len(mess.answers)
         mess.header.ns_count = len(mess.authorities)
         mess.header.ar_count = len(mess.additionals)
+        return mess
 
-        msg = (mess, self.addr[0], self.addr[1])
-        self.sock.send(msg)
-        self.cache.write_cache_file()#write the cached records so they dont get lost
+    def encode(self, mess):
+        """Encode the response and put it into the packet cache
+
+        A response that is too large for the client is replaced by an empty
+        one with the TC flag set, so the client retries over TCP.
+        """
+        data = mess.to_bytes()
+        if len(data) > self.max_size:
+            mess.header.tc = 1
+            mess.answers, mess.authorities = [], []
+            mess.additionals = [rr for rr in mess.additionals if rr.type_ == Type.OPT]
+            mess.header.an_count = mess.header.ns_count = 0
+            mess.header.ar_count = len(mess.additionals)
+            data = mess.to_bytes()
+        if self.packets is not None and len(data) <= UDP_SIZE:
+            self.packets.store(data)
+        metrics.RESPONSES.labels(RCode(mess.header.rcode)).inc()
+        metrics.REQUEST_DURATION.observe(time.perf_counter() - self.started)
+        return data
+
+    def resolve(self, name):
+        """Resolve name, falling back to stale data (RFC 8767)
+
+        The resolution runs as urgent job on the worker pool. If it takes
+        longer than the stale deadline or fails, stale records from the cache
+        are used for the answer, and the job continues to refresh the cache.
+        A resolution that ends with a cached NXDOMAIN or NODATA answer did not
+        fail, the name is gone and is not answered stale. Without a pool, or
+        when it is full, the resolution runs on the resolver of the handler
+        and only a failed one is answered stale.
+        """
+        if self.stale_deadline <= 0 or self.cache.stale_window <= 0:
+            return self.resolver.gethostbyname(name)
+
+        result = []
+        done = Event()
+        claim = Lock()
+        def work(resolver):
+            if not claim.acquire(blocking=False):
+                return # the handler resolved the name itself
+            try:
+                result.append(resolver.gethostbyname(name))
+            finally:
+                done.set()
+        if self.pool is None or not self.pool.submit(work, urgent=True):
+            work(self.resolver)
+
+        done.wait(self.stale_deadline)
+        if result and (result[0][2] or self.cache.lookup_negative(name, Type.A, Class.IN)):
+            return result[0]
+        stale = self.cache.lookup_stale(name, Type.A, Class.IN)
+        if stale:
+            return name, [], stale
+        if claim.acquire(blocking=False):
+            # no worker took the job yet, do not wait for one
+            return self.resolver.gethostbyname(name)
+        done.wait()
+        return result[0] if result else (name, [], [])
+
+    def lookupNegative(self, name, type_, class_):
+        """Lookup a cached negative answer for a question
+
+        The resolver only queries for A records, so negative answers are
+        cached for type A. An NXDOMAIN answer holds for every type of the
+        name, a NODATA answer only for A.
+
+        Returns:
+            (RCode, ResourceRecord): rcode and SOA record, or None
+        """
+        negative = self.cache.lookup_negative(name, type_, class_)
+        if negative is None and type_ != Type.A:
+            negative = self.cache.lookup_negative(name, Type.A, class_)
+            if negative is not None and negative[0] != RCode.NXDomain:
+                return None
+        return negative
+
+    def addNegative(self, mess, negative):
+        """Answer with a cached negative answer
+
+        Args:
+            mess (Message): the response
+            negative ((RCode, ResourceRecord)): rcode and SOA record
+        """
+        rcode, soa = negative
+        mess.header.rcode = rcode
+        mess.authorities.append(soa)
 
     def resolveZone(self, name, type_, class_):
         name = Name(name)
@@ -142,6 +294,10 @@ class RequestHandler(Thread):
             
 
 
+# fraction of the pending request limit above which the server is overloaded
+OVERLOAD = 0.75
+
+
 class Server:
     """A recursive DNS server"""
 
@@ -152,37 +308,338 @@ class Server:
     send an authoritative response.
     """
 
-    def __init__(self, port, caching, ttl):
+    def __init__(self, port, caching, ttl, cache_size=0, cache_bytes=0,
+                 journal=False, binary_cache=False, cache_shards=16,
+                 prefetch_hits=0, prefetch_fraction=0.1, serve_stale=0,
+                 stale_deadline=1.8, threads=16, queue_size=256,
+                 reuse_port=False, cache=None, cachefile="cache",
+                 packet_cache=10000, tcp_connections=128, tcp_idle_timeout=10,
+                 edns_size=EDNS_SIZE, rate_limit=0, rate_slip=2, max_pending=0,
+                 shed="refused", metrics_port=0, source_ports=0, prime_roots=False):
         """Initialize the server
 
         Args:
             port (int): port that server is listening on
             caching (bool): server uses resolver with caching if true
             ttl (int): ttl for records (if > 0) of cache
+            cache_size (int): maximum number of cached records (if > 0)
+            cache_bytes (int): approximate memory budget of the cache (if > 0)
+            journal (bool): persist the cache through an append-only journal
+            binary_cache (bool): write the cache file as memory-mappable snapshot
+            cache_shards (int): number of independently locked cache shards
+            prefetch_hits (int): hits after which popular records are
+                refreshed before they expire (if > 0)
+            prefetch_fraction (float): fraction of the TTL in which popular
+                records are refreshed
+            serve_stale (int): seconds expired records are kept to answer
+                from when resolution is slow or failing (if > 0)
+            stale_deadline (float): seconds to wait for a resolution before
+                answering with stale records
+            threads (int): number of worker threads handling requests
+            queue_size (int): maximum number of requests waiting for a worker
+            reuse_port (bool): bind the port with SO_REUSEPORT so several
+                server processes can share it
+            cache (RecordCache): cache to use instead of creating one, the
+                cache options are ignored then
+            cachefile (str): file of the cache created by the server
+            packet_cache (int): number of encoded responses cached to answer
+                repeated queries without decoding them (if > 0 and caching)
+            tcp_connections (int): maximum number of open TCP connections
+            tcp_idle_timeout (float): seconds after which an idle TCP
+                connection is closed
+            edns_size (int): UDP payload size advertised with EDNS(0) to
+                clients and name servers (0 disables EDNS)
+            rate_limit (float): responses per second allowed to a client
+                prefix over UDP (if > 0)
+            rate_slip (int): answer every rate_slip-th rate limited query with
+                a truncated response instead of dropping it (if > 0)
+            max_pending (int): maximum number of requests being handled, the
+                worker threads plus the queue by default (4096 tasks for the
+                asyncio engine); above OVERLOAD of it only requests answered
+                from the cache are accepted
+            shed (str): answer to requests that are not accepted, "refused",
+                "servfail" or "drop" (over TCP drop answers SERVFAIL)
+            metrics_port (int): port on localhost serving the metrics in the
+                Prometheus text format at /metrics (if > 0)
+            source_ports (int): number of sockets on random ports that
+                queries to name servers are sent from, instead of the
+                server port (if > 0)
+            prime_roots (bool): refresh the root hints with a priming query
+                at startup
         """
         self.caching = caching
         self.ttl = ttl
         self.port = port
         self.done = False
+        self.reuse_port = reuse_port
+        self.tcp_connections = tcp_connections
+        self.tcp_idle_timeout = tcp_idle_timeout
+        self.edns_size = edns_size
+        self.source_ports = source_ports
+        self.prime_roots = prime_roots
         self.catalog = Catalog()
-        self.sock = SocketWrapper(self.port)
+        self.cache = cache
+        if self.cache is None:
+            self.cache = RecordCache(self.ttl, cachefile, max_entries=cache_size,
+                                     max_bytes=cache_bytes, journal=journal,
+                                     binary=binary_cache, shards=cache_shards,
+                                     prefetch_hits=prefetch_hits,
+                                     prefetch_fraction=prefetch_fraction,
+                                     stale_window=serve_stale)
+        self.stale_deadline = stale_deadline
+        self.cache.prefetcher = self.prefetch
+        self.flights = SingleFlight()
+        self.max_pending = max_pending
+        self.shed_rcode = {"refused": RCode.Refused, "servfail": RCode.ServFail,
+                           "drop": None}[shed]
+        self.pending = 0
+        self.shed_count = 0
+        self.lock = Lock()
+        self.limiter = None
+        if rate_limit > 0:
+            self.limiter = RateLimiter(rate_limit, slip=rate_slip)
+        self.packets = None
+        if caching and packet_cache > 0:
+            # leave the prefetch window to the record cache
+            self.packets = PacketCache(packet_cache,
+                                       1 - prefetch_fraction if prefetch_hits > 0 else 1.0)
+        self.start(threads, queue_size)
+        self.metrics = None
+        if metrics_port > 0:
+            self.register_metrics()
+            self.metrics = metrics.MetricsServer(metrics_port)
+            self.metrics.start()
+
+    def start(self, threads, queue_size):
+        """Start the socket thread, the TCP listener and the worker pool"""
+        if self.max_pending <= 0:
+            self.max_pending = threads + queue_size
+        bufsize = max(self.edns_size, UDP_SIZE)
+        self.sock = SocketWrapper(self.port, reuse_port=self.reuse_port, bufsize=bufsize)
+        if self.packets is not None:
+            self.sock.fast_path = self.packets.lookup
+        self.sock.limiter = self.limiter
         self.sock.start()
-        self.cache = RecordCache(self.ttl)
+        self.ports = random_ports(lambda port: SocketWrapper(port, self.sock.ip, bufsize=bufsize),
+                                  self.source_ports)
+        for sock in self.ports:
+            sock.start()
+        self.pool = WorkerPool(threads, queue_size,
+                               lambda: Resolver(5, self.caching, self.ttl, self.sock, self.cache,
+                                                self.flights, self.edns_size, ports=self.ports))
+        if self.prime_roots:
+            self.pool.submit(lambda resolver: resolver.prime())
+        self.tcp = TCPListener(self.sock.ip, self.port, self.handle_tcp,
+                               self.tcp_connections, self.tcp_idle_timeout, self.reuse_port)
+        self.tcp.start()
+
+    def register_metrics(self):
+        """Export the counters and queue depths kept by the components"""
+        registry = metrics.REGISTRY
+        registry.gauge("dns_pending_requests", "Requests being handled",
+                       lambda: self.pending)
+        registry.gauge("dns_worker_queue_depth", "Requests waiting for a worker",
+                       lambda: self.pool.queue.qsize())
+        registry.gauge("dns_workers_busy", "Workers handling a request",
+                       lambda: self.pool.busy)
+        registry.gauge("dns_query_queue_depth", "Received queries waiting to be admitted",
+                       lambda: self.sock.queries.qsize())
+        registry.gauge("dns_send_queue_depth", "Datagrams waiting to be sent",
+                       lambda: self.sock.q.qsize())
+        registry.gauge("dns_send_queue_overflows_total", "Datagrams dropped on a full send queue",
+                       lambda: self.sock.overflows, "counter")
+        registry.gauge("dns_query_queue_dropped_total", "Queries dropped on a full query queue",
+                       lambda: self.sock.dropped, "counter")
+        registry.gauge("dns_query_queue_expired_total", "Queries that waited too long to be handled",
+                       lambda: self.sock.expired, "counter")
+        registry.gauge("dns_malformed_total", "Received datagrams that are not DNS messages",
+                       lambda: self.sock.malformed, "counter")
+        registry.gauge("dns_unmatched_responses_total",
+                       "Responses of name servers that no query waited for",
+                       lambda: self.sock.unmatched, "counter")
+        registry.gauge("dns_tcp_refused_total", "TCP connections closed at the connection limit",
+                       lambda: self.tcp.refused, "counter")
+        self.register_common_metrics()
+
+    def register_common_metrics(self):
+        registry = metrics.REGISTRY
+        registry.gauge("dns_cache_records", "Records in the record cache",
+                       lambda: len(self.cache) if hasattr(self.cache, "__len__") else 0)
+        registry.gauge("dns_coalesced_total", "Resolutions that waited for an identical one",
+                       lambda: self.flights.coalesced, "counter")
+        if self.packets is not None:
+            registry.gauge("dns_packet_cache_responses", "Responses in the packet cache",
+                           lambda: len(self.packets.responses))
+        if self.limiter is not None:
+            registry.gauge("dns_rate_limit_dropped_total", "Queries dropped by rate limiting",
+                           lambda: self.limiter.dropped, "counter")
+            registry.gauge("dns_rate_limit_slipped_total",
+                           "Rate limited queries answered truncated",
+                           lambda: self.limiter.slipped, "counter")
 
     def serve(self):
         """Start serving requests"""
         while not self.done:
-            data = None
-            while not data:
-                msgs = self.sock.msgThere(-1)
-                for m in msgs:
-                    data,addr = m
-                    re = RequestHandler(data, addr, self.catalog, self.sock, self.caching, self.cache,self.ttl)
-                    re.start()
+            query = self.sock.next_query(0.2)
+            if query is not None:
+                data, addr = query
+                self.admit(data, addr)
+
+    def handle_tcp(self, data, addr, conn):
+        """Queue a request received over TCP"""
+        self.admit(data, addr, conn)
+
+    def admit(self, data, addr, conn=None):
+        """Queue a request on the pool or shed it when overloaded
+
+        Args:
+            data (bytes or Message): the request, a received datagram is
+                decoded by the worker unless admission has to look into it
+        """
+        pending = self.pending
+        if isinstance(data, bytes) and pending >= self.max_pending * OVERLOAD:
+            data = self.sock.decode(data)
+            if data is None:
+                if conn is not None:
+                    conn.done()
+                return
+        accepted, cheap = self.admission(data, pending)
+        if accepted:
+            with self.lock:
+                self.pending += 1
+            def job(resolver):
+                try:
+                    self.handle(data, addr, resolver, conn)
+                finally:
+                    with self.lock:
+                        self.pending -= 1
+                    if conn is not None:
+                        conn.done()
+            if not self.pool.submit(job, cheap):
+                with self.lock:
+                    self.pending -= 1
+                accepted = False
+        if not accepted:
+            try:
+                self.shed(data, addr, conn)
+            finally:
+                if conn is not None:
+                    conn.done()
+
+    def admission(self, mess, pending):
+        """Decide whether to accept a request
+
+        Below OVERLOAD of the pending limit every request is accepted. Above it
+        only requests that need no recursion are, so answers from the cache
+        keep flowing while new recursions are shed.
+
+        Args:
+            mess (Message): the request
+            pending (int): number of requests being handled
 
+        Returns:
+            (bool, bool): whether the request is accepted and whether it is
+                cheap and should be handled before other requests
+        """
+        if pending >= self.max_pending:
+            return False, False
+        if pending < self.max_pending * OVERLOAD:
+            return True, False
+        cheap = self.cheap(mess)
+        return cheap, cheap
+
+    def cheap(self, mess):
+        """Whether a request can be answered without recursion"""
+        if not mess.header.rd or not self.caching:
+            return not mess.header.rd
+        for q in mess.questions:
+            name = str(q.qname)
+            if not (self.cache.contains(name, q.qtype, q.qclass) or
+                    self.cache.contains(name, Type.CNAME, q.qclass) or
+                    self.authoritative(name)):
+                return False
+        return True
+
+    def authoritative(self, name):
+        labels = Name(name).labels[-2:]
+        return ".".join(labels) in self.catalog.zones
+
+    def shed(self, mess, addr, conn=None):
+        """Answer a request that was not accepted with the shed rcode
+
+        Args:
+            mess (Message or bytes): the request
+            addr ((str, int)): address of the client
+            conn (TCPConnection): connection of the request, None for UDP
+        """
+        with self.lock:
+            self.shed_count += 1
+        metrics.SHED.inc()
+        rcode = self.shed_rcode
+        if rcode is None:
+            if conn is None:
+                return
+            rcode = RCode.ServFail
+        if isinstance(mess, bytes):
+            mess = self.sock.decode(mess)
+            if mess is None:
+                return
+        mess.header.qr = 1
+        mess.header.rcode = rcode
+        mess.answers, mess.authorities, mess.additionals = [], [], []
+        mess.header.an_count = mess.header.ns_count = mess.header.ar_count = 0
+        metrics.RESPONSES.labels(rcode).inc()
+        if conn is None:
+            self.reply((mess, addr[0], addr[1]))
+        else:
+            conn.send((mess, addr[0], addr[1]))
+
+    def reply(self, msg):
+        """Send a UDP response, msg is a (message, ip, port) tuple"""
+        self.sock.send(msg)
+
+    def handle(self, data, addr, resolver, conn=None):
+        """Handle a request on a worker of the pool
+
+        Args:
+            conn (TCPConnection): connection the request came in on, None for UDP
+        """
+        if isinstance(data, bytes):
+            data = self.sock.decode(data)
+            if data is None:
+                return
+        if conn is None:
+            re = RequestHandler(data, addr, self.catalog, self.sock, self.caching, self.cache,self.ttl,
+                                self.stale_deadline, resolver, self.packets,
+                                edns_size=self.edns_size, pool=self.pool)
+        else:
+            re = RequestHandler(data, addr, self.catalog, conn, self.caching, self.cache,self.ttl,
+                                self.stale_deadline, resolver, self.packets, 65535,
+                                self.edns_size, self.pool)
+        re.run()
+
+    def prefetch(self, name, type_, class_):
+        """Refresh a popular cached record set in the background"""
+        if type_ != Type.A or class_ != Class.IN or not self.caching:
+            self.cache.prefetch_done(name, type_, class_)
+            return
+        def refresh(resolver):
+            try:
+                resolver.gethostbyname(name, refresh=True)
+            finally:
+                self.cache.prefetch_done(name, type_, class_)
+        if not self.pool.submit(refresh):
+            self.cache.prefetch_done(name, type_, class_)
 
     def shutdown(self):
         """Shut the server down"""
         self.cache.write_cache_file() #just to be sure
+        self.cache.close()
         self.done = True
+        if self.metrics is not None:
+            self.metrics.shutdown()
+        self.pool.shutdown()
+        self.tcp.shutdown()
         self.sock.shutdown()
+        for sock in self.ports:
+            sock.shutdown()
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+
+"""Binary snapshot of the record cache
+
+A snapshot is a read-only file which is memory-mapped and queried in place, so
+opening a cache with millions of records costs no more than opening a small
+one. Records are only decoded when a lookup touches them.
+
+Layout (all integers in network byte order):
+    header      magic "DNSC", version, reserved, record count, bucket count
+    buckets     bucket count + 1 record indices; the records of bucket i are
+                the records from buckets[i] up to buckets[i + 1]
+    records     fixed-size headers (see RECORD), grouped by bucket
+    strings     owner names and JSON encoded rdata referenced by the records
+
+The bucket of a record is the CRC32 of its canonical key, so the layout does
+not depend on the hash seed of the process which wrote it.
+"""
+
+
+import json
+import mmap
+import os
+import struct
+import zlib
+
+from dns.classes import Class
+from dns.name import Name
+from dns.rtypes import Type
+
+
+MAGIC = b"DNSC"
+VERSION = 1
+HEADER = struct.Struct("!4sHHII")
+BUCKET = struct.Struct("!I")
+# name offset, name length, type, class, ttl, timestamp, rdata offset, rdata length
+RECORD = struct.Struct("!IHHHidII")
+
+
+def _bucket(name, type_, class_, nbuckets):
+    """Bucket of a record with the lowercased owner name name"""
+    key = name + struct.pack("!HH", type_, class_)
+    return zlib.crc32(key) & (nbuckets - 1)
+
+
+def is_snapshot(filename):
+    """Check whether filename holds a binary snapshot"""
+    try:
+        with open(filename, "rb") as file_:
+            return file_.read(len(MAGIC)) == MAGIC
+    except OSError:
+        return False
+
+
+def write_snapshot(filename, dcts):
+    """Write cache entry dicts to a binary snapshot
+
+    Owner names are written fully qualified, like the names of the keys
+    lookups are made with, whether or not the dicts end them with a dot.
+
+    Args:
+        filename (str): the file to write
+        dcts ([dict]): entries in the format of the JSON cache file
+    """
+    nbuckets = 1
+    while nbuckets < len(dcts):
+        nbuckets <<= 1
+
+    records = [[] for _ in range(nbuckets)]
+    for dct in dcts:
+        name = str(Name(dct["name"])).encode("utf-8")
+        type_ = Type[dct["type"]]
+        class_ = Class[dct["class"]]
+        rdata = json.dumps(dct["rdata"]).encode("utf-8")
+        b = _bucket(name.lower(), type_, class_, nbuckets)
+        records[b].append((name, type_, class_, dct["ttl"], dct["timestamp"], rdata))
+
+    strings_start = (HEADER.size + BUCKET.size * (nbuckets + 1) +
+                     RECORD.size * len(dcts))
+    buckets = bytearray()
+    headers = bytearray()
+    strings = bytearray()
+    index = 0
+    for bucket in records:
+        buckets += BUCKET.pack(index)
+        for name, type_, class_, ttl, timestamp, rdata in bucket:
+            name_off = strings_start + len(strings)
+            strings += name
+            rdata_off = strings_start + len(strings)
+            strings += rdata
+            headers += RECORD.pack(name_off, len(name), type_, class_, ttl,
+                                   timestamp, rdata_off, len(rdata))
+            index += 1
+    buckets += BUCKET.pack(index)
+
+    with open(filename, "wb") as file_:
+        file_.write(HEADER.pack(MAGIC, VERSION, 0, len(dcts), nbuckets))
+        file_.write(buckets)
+        file_.write(headers)
+        file_.write(strings)
+
+
+class Snapshot:
+    """A memory-mapped binary snapshot"""
+
+    def __init__(self, filename):
+        """Map a snapshot file
+
+        Args:
+            filename (str): the snapshot file
+
+        Raises:
+            ValueError: if the file is not a snapshot of a supported version
+        """
+        with open(filename, "rb") as file_:
+            size = os.fstat(file_.fileno()).st_size
+            if size < HEADER.size:
+                raise ValueError("snapshot is too short")
+            self.mm = mmap.mmap(file_.fileno(), 0, access=mmap.ACCESS_READ)
+        magic, version, _, self.count, self.nbuckets = HEADER.unpack_from(self.mm)
+        if magic != MAGIC:
+            self.mm.close()
+            raise ValueError("not a cache snapshot")
+        if version != VERSION:
+            self.mm.close()
+            raise ValueError("unsupported snapshot version {}".format(version))
+        self.records_start = HEADER.size + BUCKET.size * (self.nbuckets + 1)
+
+    def __len__(self):
+        return self.count
+
+    def _dict(self, i):
+        """Decode record i to a cache entry dict"""
+        (name_off, name_len, type_, class_, ttl, timestamp, rdata_off,
+         rdata_len) = RECORD.unpack_from(self.mm, self.records_start + i * RECORD.size)
+        return {"name": self.mm[name_off:name_off + name_len].decode("utf-8"),
+                "type": str(Type(type_)),
+                "class": str(Class(class_)),
+                "ttl": ttl,
+                "timestamp": timestamp,
+                "rdata": json.loads(self.mm[rdata_off:rdata_off + rdata_len].decode("utf-8"))}
+
+    def lookup(self, key):
+        """Find the entry dicts of a record set
+
+        Args:
+            key ((str, int, int)): canonical key as built by cache.cache_key
+        """
+        name, type_, class_ = key
+        name = name.encode("utf-8")
+        if not self.count:
+            return []
+        b = _bucket(name, type_, class_, self.nbuckets)
+        start, end = struct.unpack_from("!II", self.mm, HEADER.size + b * BUCKET.size)
+        result = []
+        for i in range(start, end):
+            off = self.records_start + i * RECORD.size
+            name_off, name_len, rtype, rclass = struct.unpack_from("!IHHH", self.mm, off)
+            if (rtype == type_ and rclass == class_ and name_len == len(name) and
+                    self.mm[name_off:name_off + name_len].lower() == name):
+                result.append(self._dict(i))
+        return result
+
+    def __iter__(self):
+        for i in range(self.count):
+            yield self._dict(i)
+
+    def close(self):
+        self.mm.close()
+
+
+def json_to_snapshot(jsonfile, filename):
+    """Convert a JSON cache file to a binary snapshot"""
+    with open(jsonfile, "r") as file_:
+        write_snapshot(filename, json.load(file_))
+
+
+def snapshot_to_json(filename, jsonfile):
+    """Convert a binary snapshot to a JSON cache file"""
+    snapshot = Snapshot(filename)
+    try:
+        with open(jsonfile, "w") as file_:
+            json.dump(list(snapshot), file_, indent=2)
+    finally:
+        snapshot.close()
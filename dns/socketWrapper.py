@@ -1,81 +1,276 @@
+from concurrent.futures import Future, TimeoutError
 from threading import Lock
 import socket
 from dns import message
+from dns.transactions import random_id
 import queue
 import select
+import struct
 import threading
+import time
+
+
+def local_ip():
+    """The IP address of this host that the sockets are bound to"""
+    return (([ip for ip in socket.gethostbyname_ex(socket.gethostname())[2] if not ip.startswith("127.")] or [[(s.connect(("8.8.8.8", 53)), s.getsockname()[0], s.close()) for s in [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)]][0][1]]) + ["no IP found"])[0]
 
 
 class SocketWrapper(threading.Thread):
-    readlock = Lock()
-    msgs = {}
-    q = queue.Queue(42)
+    """UDP socket of a server or resolver
+
+    Received datagrams are split by the QR flag: queries of clients go to a
+    FIFO read with next_query(), responses of name servers complete the
+    exchange() waiting for their transaction ID and are dropped otherwise.
+    The socket thread only peeks at the header, datagrams are decoded by the
+    thread that takes them.
+    """
 
-    def __init__(self, port, ip=None):
+    def __init__(self, port, ip=None, reuse_port=False, bufsize=1232, send_queue=1024,
+                 batch=64, query_queue=1024, query_age=2.0):
+        """Bind the socket
+
+        Args:
+            port (int): port to bind
+            ip (str): address to bind, defaults to local_ip()
+            reuse_port (bool): let other processes bind the same port, the
+                kernel then balances datagrams over the sockets
+            bufsize (int): size of the largest datagram received, the UDP
+                payload size advertised with EDNS(0)
+            send_queue (int): maximum number of datagrams waiting to be sent,
+                more are dropped and counted as overflows
+            batch (int): maximum number of datagrams read per wakeup before
+                the send queue is flushed
+            query_queue (int): maximum number of received queries waiting
+                for the server, more are dropped
+            query_age (float): seconds after which a waiting query is dropped,
+                its client has given up or retried by then
+        """
         threading.Thread.__init__(self)
 
         if ip is None:
-            self.ip = (([ip for ip in socket.gethostbyname_ex(socket.gethostname())[2] if not ip.startswith("127.")] or [[(s.connect(("8.8.8.8", 53)), s.getsockname()[0], s.close()) for s in [socket.socket(socket.AF_INET, socket.SOCK_DGRAM)]][0][1]]) + ["no IP found"])[0]
+            self.ip = local_ip()
         else:
             self.ip = ip
         self.port = port
+        self.bufsize = bufsize
         self.sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        if reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
         self.sock.bind((self.ip, self.port))
-        self.sock.settimeout(1)
+        self.sock.setblocking(False)
         self.close = False
+        self.fast_path = None
+        self.limiter = None
+        self.q = queue.Queue(send_queue)
+        self.overflows = 0
+        self.batch = batch
+        self.unsent = None
+        # queries (QR not set) for the server
+        self.queries = queue.Queue(query_queue)
+        self.query_age = query_age
+        self.dropped = 0
+        self.expired = 0
+        # responses without a waiter: late, duplicated or spoofed
+        self.unmatched = 0
+        # datagrams that are not DNS messages
+        self.malformed = 0
+        # futures of the responses that exchange() waits for
+        self.waiters = {}
+        self.waiters_lock = Lock()
+        # send() writes a byte to wake the loop up from select
+        self.wakeup, self.waker = socket.socketpair()
+        self.wakeup.setblocking(False)
+        self.waker.setblocking(False)
 
     def run(self):
         while not self.close:
             self.listen()
             self.flush_send()
+        self.sock.close()
+        self.wakeup.close()
+        self.waker.close()
 
     def listen(self):
+        """Wait until datagrams arrive or sends are queued, then read a batch"""
         if self.close:
-            self.sock.close()
             return
-        r, _, _ = select.select([self.sock], [], [], 0.2)
-        if r:
+        wlist = [self.sock] if self.unsent is not None else []
+        try:
+            r, _, _ = select.select([self.sock, self.wakeup], wlist, [], 0.2)
+        except (OSError, ValueError):
+            return
+        if self.wakeup in r:
             try:
-                if not self.close:
-                    data, addr = self.sock.recvfrom(1024)
-                    msg = message.Message.from_bytes(data)
-                    id = msg.header.ident
-                    with self.readlock:
-                        if id in self.msgs:
-                            self.msgs[id].append((msg,addr))
-                        else:
-                            self.msgs[id] = [(msg,addr)]
-            except:
-                print("minor issue in socket handling",self.close)
+                self.wakeup.recv(4096)
+            except OSError:
+                pass
+        if self.sock in r:
+            self.drain()
+
+    def drain(self):
+        """Read the pending datagrams without blocking, at most batch of them"""
+        for _ in range(self.batch):
+            try:
+                data, addr = self.sock.recvfrom(self.bufsize)
+            except (BlockingIOError, InterruptedError):
+                return
+            except ConnectionRefusedError:
+                continue # ICMP error of an earlier send
+            except OSError:
+                return
+            self.receive(data, addr)
+
+    def receive(self, data, addr):
+        """Route a datagram by its header, it is not decoded here"""
+        if len(data) < 12:
+            self.malformed += 1
+            return
+        try:
+            if self.limiter is not None:
+                allowed, reply = self.limiter.check(data, addr[0])
+                if not allowed:
+                    if reply is not None:
+                        self.sock.sendto(reply, addr)
+                    return
+            if self.fast_path is not None:
+                reply = self.fast_path(data)
+                if reply is not None:
+                    self.sock.sendto(reply, addr)
+                    return
+        except OSError:
+            return
+        if not data[2] & 0x80:
+            try:
+                self.queries.put_nowait((data, addr, time.monotonic()))
+            except queue.Full:
+                self.dropped += 1
+            return
+        id = struct.unpack_from("!H", data)[0]
+        with self.waiters_lock:
+            future = self.waiters.get((id, addr[0]))
+        if future is None or future.done():
+            self.unmatched += 1
+        else:
+            future.set_result(data)
+
+    def decode(self, data):
+        """Decode a received datagram, None (counted as malformed) if it fails"""
+        try:
+            return message.Message.from_bytes(data)
+        except (ValueError, IndexError, UnicodeDecodeError, struct.error):
+            self.malformed += 1
+            return None
 
     def flush_send(self):
-        while not self.q.empty():
-            i = self.q.get()
-            self.sock.sendto(i[0].to_bytes(), (i[1], i[2]))
-            
-
-    def msgThere(self, id):
-        idMsgs = []
-        with self.readlock:
-            if id in self.msgs:
-                idMsgs = self.msgs[id]
-                self.msgs[id] = []
-            if id==-1:
-                for k,ms in self.msgs.items():
-                    for m in ms:
-                        if not m[0].header.qr:
-                            idMsgs += [m]
-                        self.msgs[k] = [n for n in self.msgs[k] if n not in idMsgs]
-        return idMsgs
+        """Send the queued datagrams until the socket buffer is full"""
+        while True:
+            if self.unsent is None:
+                try:
+                    i = self.q.get_nowait()
+                except queue.Empty:
+                    return
+                data = i[0] if isinstance(i[0], bytes) else i[0].to_bytes()
+                self.unsent = (data, (i[1], i[2]))
+            try:
+                self.sock.sendto(*self.unsent)
+            except (BlockingIOError, InterruptedError):
+                return # select tells when there is room again
+            except OSError:
+                if self.close:
+                    return
+            self.unsent = None
+
+
+    def next_query(self, timeout=None):
+        """Wait for the next query of a client
+
+        Args:
+            timeout (float): seconds to wait, forever if None
+
+        Queries that waited longer than query_age are skipped. The query is
+        returned as received, see decode().
+
+        Returns:
+            (bytes, (str, int)): the query and the address of the client, or
+                None if there was none within the timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        while True:
+            try:
+                if deadline is None:
+                    data, addr, received = self.queries.get()
+                else:
+                    data, addr, received = self.queries.get(
+                        timeout=max(0, deadline - time.monotonic()))
+            except queue.Empty:
+                return None
+            if time.monotonic() - received <= self.query_age:
+                return data, addr
+            self.expired += 1
+
+    def exchange(self, query, addr, timeout, port=53):
+        """Send a query to a name server and wait for its response
+
+        The wait takes no CPU: the listener completes a future registered for
+        the transaction ID and address of the query. If that transaction is
+        already pending, the query gets another ID. The response is decoded by
+        the calling thread.
+
+        Args:
+            query (Message): the query
+            addr (str): IP address of the name server
+            timeout (float): seconds to wait for the response
+            port (int): port of the name server
+
+        Returns:
+            Message: the response, None if there was none within the timeout or
+                it was malformed
+        """
+        future = Future()
+        with self.waiters_lock:
+            while (query.header.ident, addr) in self.waiters:
+                query.header.ident = random_id()
+            key = (query.header.ident, addr)
+            self.waiters[key] = future
+        try:
+            if not self.send((query, addr, port)):
+                return None
+            data = future.result(timeout)
+        except TimeoutError:
+            return None
+        finally:
+            with self.waiters_lock:
+                del self.waiters[key]
+        return self.decode(data)
 
     def send(self, msg):
         """
-        :param msg: tuple of shape (msg, ip, port)
-        :return:
+        :param msg: tuple of shape (msg, ip, port), msg may be already encoded
+        :return: False if the send queue is full and the message was dropped
         """
-        self.q.put(msg)
+        try:
+            self.q.put_nowait(msg)
+        except queue.Full:
+            self.overflows += 1
+            return False
+        try:
+            self.waker.send(b"\0")
+        except OSError:
+            pass # a wakeup is pending already
+        return True
 
     def shutdown(self):
+        """Stop the thread, the socket is closed when this returns"""
         self.close = True
-        self.sock.close()
+        if not self.is_alive():
+            self.sock.close()
+            self.wakeup.close()
+            self.waker.close()
+            return
+        try:
+            self.waker.send(b"\0")
+        except OSError:
+            pass
+        if threading.current_thread() is not self:
+            self.join()
         
@@ -0,0 +1,156 @@
+#!/usr/bin/env python3
+
+"""Multi-process DNS server
+
+Because of the GIL a single server process uses at most one core. The
+supervisor forks a number of worker processes which all bind the same UDP port
+with SO_REUSEPORT, so the kernel spreads incoming queries over them, and
+restarts workers that die.
+
+Every worker has its own RecordCache by default. Optionally the supervisor
+hosts one cache in a manager process that all workers share over IPC, which
+trades a round trip per cache operation for a common cache.
+"""
+
+
+import multiprocessing
+from multiprocessing.managers import BaseManager
+import os
+import signal
+import time
+
+from dns.cache import RecordCache
+
+
+class CacheManager(BaseManager):
+    """Manager process hosting a shared RecordCache"""
+
+
+CacheManager.register("RecordCache", RecordCache, exposed=[
+    "lookup", "lookup_stale", "lookup_negative", "contains", "add_negative", "matchByLabel",
+    "add_record", "replace_records", "prefetch_done", "write_cache_file", "close"])
+
+
+class SharedCache:
+    """RecordCache interface on top of a cache in a manager process
+
+    Persistence is left to the supervisor, so write_cache_file is a no-op in
+    the workers. Refresh-ahead prefetching is not supported.
+    """
+
+    def __init__(self, proxy, stale_window=0):
+        """Initialize the shared cache
+
+        Args:
+            proxy (BaseProxy): proxy of the RecordCache in the manager
+            stale_window (int): stale window the shared cache was created with
+        """
+        self.proxy = proxy
+        self.stale_window = stale_window
+        self.journal = None
+        self.prefetcher = None
+
+    def lookup(self, dname, type_, class_):
+        return self.proxy.lookup(str(dname), type_, class_)
+
+    def lookup_stale(self, dname, type_, class_):
+        return self.proxy.lookup_stale(str(dname), type_, class_)
+
+    def lookup_negative(self, dname, type_, class_):
+        return self.proxy.lookup_negative(str(dname), type_, class_)
+
+    def contains(self, dname, type_, class_):
+        return self.proxy.contains(str(dname), type_, class_)
+
+    def add_negative(self, dname, type_, class_, rcode, soa):
+        self.proxy.add_negative(str(dname), type_, class_, rcode, soa)
+
+    def matchByLabel(self, dname, type_, class_):
+        return self.proxy.matchByLabel(str(dname), type_, class_)
+
+    def add_record(self, record):
+        self.proxy.add_record(record)
+
+    def replace_records(self, dname, type_, class_, records):
+        self.proxy.replace_records(str(dname), type_, class_, records)
+
+    def prefetch_done(self, dname, type_, class_):
+        self.proxy.prefetch_done(str(dname), type_, class_)
+
+    def write_cache_file(self):
+        pass
+
+    def close(self):
+        pass
+
+
+class Supervisor:
+    """Starts worker processes and restarts them when they die"""
+
+    def __init__(self, workers, make_server, shared_cache=None):
+        """Initialize the supervisor
+
+        Args:
+            workers (int): number of worker processes
+            make_server (callable): called in a worker with the worker number
+                and the shared cache (or None) and returns the Server to run;
+                it has to bind its port with reuse_port
+            shared_cache (dict): if given, the arguments of the RecordCache
+                created in a manager process and shared by all workers
+        """
+        self.workers = workers
+        self.make_server = make_server
+        self.shared_cache = shared_cache
+        self.context = multiprocessing.get_context("fork")
+        self.processes = {}
+        self.restarts = 0
+        self.done = False
+        self.manager = None
+        self.cache = None
+
+    def _run_worker(self, index, cache):
+        server = self.make_server(index, cache)
+        def stop(signum, frame):
+            server.shutdown()
+            os._exit(0)
+        signal.signal(signal.SIGTERM, stop)
+        signal.signal(signal.SIGINT, signal.SIG_IGN)
+        server.serve()
+
+    def _start_worker(self, index):
+        process = self.context.Process(target=self._run_worker,
+                                       args=(index, self.cache),
+                                       name="dns-worker-{}".format(index))
+        process.daemon = True
+        process.start()
+        self.processes[index] = process
+
+    def serve(self):
+        """Start the workers and watch them until shutdown"""
+        if self.shared_cache is not None:
+            self.manager = CacheManager(ctx=self.context)
+            self.manager.start()
+            proxy = self.manager.RecordCache(**self.shared_cache)
+            self.cache = SharedCache(proxy, self.shared_cache.get("stale_window", 0))
+        for i in range(self.workers):
+            self._start_worker(i)
+        while not self.done:
+            for i, process in list(self.processes.items()):
+                if not process.is_alive() and not self.done:
+                    print("worker", i, "exited with", process.exitcode, "- restarting")
+                    self.restarts += 1
+                    self._start_worker(i)
+            time.sleep(0.5)
+
+    def shutdown(self):
+        """Stop all workers and the shared cache"""
+        self.done = True
+        for process in self.processes.values():
+            if process.is_alive():
+                process.terminate()
+        for process in self.processes.values():
+            process.join(5)
+        if self.manager is not None:
+            self.cache.proxy.write_cache_file()
+            self.cache.proxy.close()
+            self.manager.shutdown()
@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+
+"""DNS over TCP
+
+Messages that do not fit into a datagram are exchanged over TCP, prefixed with
+their length (section 4.2.2 of RFC 1035). A connection may carry several
+queries, which are answered in the order they are resolved (RFC 7766).
+
+This module contains the framing, the client side used by the resolver when a
+name server truncates its response and the listener of the threaded server.
+"""
+
+
+import asyncio
+import socket
+import struct
+import threading
+
+from dns.message import Message
+
+
+UDP_SIZE = 512
+
+
+def frame(data):
+    """Prefix an encoded message with its length"""
+    return struct.pack("!H", len(data)) + data
+
+
+def recv_exactly(sock, size):
+    """Read size bytes from a socket, None if the connection is closed
+
+    A timeout is only raised if nothing was read yet. After a partial read
+    the stream is out of sync, so None is returned as for a closed one.
+    """
+    data = b""
+    while len(data) < size:
+        try:
+            chunk = sock.recv(size - len(data))
+        except socket.timeout:
+            if data:
+                return None
+            raise
+        if not chunk:
+            return None
+        data += chunk
+    return data
+
+
+def read_message(sock):
+    """Read the next length-prefixed message, None if the connection is closed
+
+    A timeout is only raised between messages, see recv_exactly.
+    """
+    length = recv_exactly(sock, 2)
+    if length is None:
+        return None
+    try:
+        return recv_exactly(sock, struct.unpack("!H", length)[0])
+    except socket.timeout:
+        return None
+
+
+def query_tcp(query, addr, timeout, port=53):
+    """Send a query over TCP and wait for the response
+
+    Args:
+        query (Message): the query
+        addr (str): IP address of the name server
+        timeout (float): seconds to wait for the connection and the response
+
+    Returns:
+        Message: the response, None if there was none
+    """
+    try:
+        with socket.create_connection((addr, port), timeout) as sock:
+            sock.sendall(frame(query.to_bytes()))
+            while True:
+                data = read_message(sock)
+                if data is None:
+                    return None
+                response = Message.from_bytes(data)
+                if response.header.ident == query.header.ident:
+                    return response
+    except (OSError, ValueError, IndexError, UnicodeDecodeError, struct.error):
+        return None
+
+
+async def query_tcp_async(query, addr, timeout, port=53):
+    """Send a query over TCP on the event loop, see query_tcp"""
+    writer = None
+    try:
+        reader, writer = await asyncio.wait_for(asyncio.open_connection(addr, port), timeout)
+        writer.write(frame(query.to_bytes()))
+        async def read():
+            while True:
+                length = await reader.readexactly(2)
+                data = await reader.readexactly(struct.unpack("!H", length)[0])
+                response = Message.from_bytes(data)
+                if response.header.ident == query.header.ident:
+                    return response
+        return await asyncio.wait_for(read(), timeout)
+    except (OSError, asyncio.TimeoutError, asyncio.IncompleteReadError,
+            ValueError, IndexError, UnicodeDecodeError, struct.error):
+        return None
+    finally:
+        if writer is not None:
+            writer.close()
+
+
+class TCPConnection:
+    """Client connection, sends responses with the interface of SocketWrapper.send
+
+    pending counts the queries being handled. The handler of a query calls
+    done() when it is finished, whether it sent a response or failed.
+    """
+
+    def __init__(self, sock):
+        self.sock = sock
+        self.lock = threading.Lock()
+        self.pending = 0
+
+    def send(self, msg):
+        """Send a response
+
+        Args:
+            msg ((Message or bytes, str, int)): message, ip and port
+        """
+        mess = msg[0]
+        data = mess if isinstance(mess, bytes) else mess.to_bytes()
+        try:
+            with self.lock:
+                self.sock.sendall(frame(data))
+        except OSError:
+            pass
+
+    def done(self):
+        """A query of the connection was handled"""
+        with self.lock:
+            self.pending -= 1
+
+
+class StreamConnection:
+    """Client connection of the asyncio engine, see TCPConnection"""
+
+    def __init__(self, writer):
+        self.writer = writer
+        self.pending = 0
+
+    def send(self, msg):
+        mess = msg[0]
+        data = mess if isinstance(mess, bytes) else mess.to_bytes()
+        if not self.writer.is_closing():
+            self.writer.write(frame(data))
+
+    def done(self):
+        self.pending -= 1
+
+
+class TCPListener(threading.Thread):
+    """Accepts TCP connections and reads the queries sent over them"""
+
+    def __init__(self, ip, port, handle, max_connections=128, idle_timeout=10,
+                 reuse_port=False):
+        """Bind the listening socket
+
+        Args:
+            ip (str): address to bind
+            port (int): port to bind
+            handle (callable): called with (query, addr, connection) for each query
+            max_connections (int): connections beyond this are closed at once
+            idle_timeout (float): seconds after which a silent connection is closed
+            reuse_port (bool): let other processes bind the same port
+        """
+        super().__init__()
+        self.daemon = True
+        self.handle = handle
+        self.max_connections = max_connections
+        self.idle_timeout = idle_timeout
+        self.connections = set()
+        self.lock = threading.Lock()
+        self.refused = 0
+        self.close = False
+        self.sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+        self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+        if reuse_port:
+            self.sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEPORT, 1)
+        self.sock.bind((ip, port))
+        self.sock.listen(socket.SOMAXCONN)
+        self.sock.settimeout(0.2)
+
+    def run(self):
+        while not self.close:
+            try:
+                conn, addr = self.sock.accept()
+            except socket.timeout:
+                continue
+            except OSError:
+                break
+            with self.lock:
+                if len(self.connections) >= self.max_connections:
+                    self.refused += 1
+                    conn.close()
+                    continue
+                self.connections.add(conn)
+            threading.Thread(target=self.serve, args=(conn, addr), daemon=True).start()
+
+    def serve(self, conn, addr):
+        """Read the pipelined queries of a connection until it is closed or idle
+
+        The connection counts as idle only while no query is being answered. A
+        timeout in the middle of a message closes it.
+        """
+        conn.settimeout(self.idle_timeout)
+        connection = TCPConnection(conn)
+        try:
+            while not self.close:
+                try:
+                    data = read_message(conn)
+                except socket.timeout:
+                    if connection.pending > 0:
+                        continue
+                    break
+                if data is None:
+                    break
+                try:
+                    query = Message.from_bytes(data)
+                except (ValueError, IndexError, UnicodeDecodeError, struct.error):
+                    break
+                if not query.header.qr:
+                    with connection.lock:
+                        connection.pending += 1
+                    self.handle(query, addr, connection)
+        except OSError:
+            pass
+        finally:
+            with self.lock:
+                self.connections.discard(conn)
+            conn.close()
+
+    def shutdown(self):
+        self.close = True
+        self.sock.close()
+        with self.lock:
+            for conn in self.connections:
+                try:
+                    conn.shutdown(socket.SHUT_RDWR)
+                except OSError:
+                    pass
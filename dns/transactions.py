@@ -0,0 +1,77 @@
+#!/usr/bin/env python3
+
+"""Outstanding queries to name servers
+
+A response is accepted only from the address its query was sent to and only
+with the transaction ID of the query. IDs are drawn at random for every
+transmission (and source ports too, if the resolver has a pool of them), so a
+spoofed response has to guess both (RFC 5452).
+
+A datagram that gets no response within the timeout of the attempt is sent
+again, with the timeout doubled each time, until the retries are used up, the
+time one name server may take is used up or the time budget of the resolution
+runs out. Limiting the time per name server leaves time to try the others when
+one does not respond.
+"""
+
+
+import random
+import time
+
+
+_random = random.SystemRandom()
+
+
+def random_id():
+    """A random transaction ID"""
+    return _random.randrange(1 << 16)
+
+
+def attempts(first, retries, deadline, limit=0):
+    """Timeouts of the attempts to get a response from a name server
+
+    Args:
+        first (float): seconds to wait for the response to the first attempt,
+            doubled for every retransmission
+        retries (int): maximum number of retransmissions
+        deadline (float): time.monotonic() after which no attempts are made,
+            the last attempt is cut off at this time
+        limit (float): seconds all attempts may take together (if > 0), the
+            deadline is moved forward to that
+
+    Yields:
+        float: seconds to wait for a response to the next attempt
+    """
+    if limit > 0:
+        deadline = min(deadline, time.monotonic() + limit)
+    timeout = first
+    for _ in range(retries + 1):
+        left = deadline - time.monotonic()
+        if left <= 0:
+            return
+        yield min(timeout, left)
+        timeout *= 2
+
+
+def random_ports(bind, count, tries=100):
+    """Bind count sockets to random unprivileged ports
+
+    Args:
+        bind (callable): called with a port number, returns the socket bound
+            to it or raises OSError if the port is in use
+        count (int): number of sockets
+        tries (int): ports tried per socket before giving up
+
+    Returns:
+        [socket]: the bound sockets
+    """
+    socks = []
+    for _ in range(count):
+        for i in range(tries):
+            try:
+                socks.append(bind(_random.randrange(1024, 1 << 16)))
+                break
+            except OSError:
+                if i == tries - 1:
+                    raise
+    return socks
@@ -9,7 +9,6 @@ zones or record sets.
 These classes are merely a suggestion, feel free to use something else.
 """
 
-import re
 from dns.resource import ResourceRecord, RecordData, Type
 
 class Catalog:
@@ -62,9 +61,9 @@ class Zone:
             with open(filename, "r") as file_:
                 for l in file_:
                     rr = l.split(";")[0]
-                    if not rr:
+                    if not rr.strip():
                         continue
-                    entries = re.split("[\\n]?[\ +]*[\\t+]*",rr)[:-1]
+                    entries = rr.split()
                     name = entries[0]
                     ttl = int(entries[1])
                     type_ = entries[2]
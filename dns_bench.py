@@ -0,0 +1,460 @@
+#!/usr/bin/env python3
+
+""" DNS benchmarks
+
+This script contains micro benchmarks for the resolver and server building
+blocks. Run `python dns_bench.py <benchmark> -h` for the options of a benchmark.
+"""
+
+
+from argparse import ArgumentParser
+import asyncio
+import json
+import multiprocessing
+import os
+import select
+import signal
+import sys
+import tempfile
+import threading
+import time
+
+from dns.cache import RecordCache
+from dns.classes import Class
+from dns.message import Message, Header, Question
+from dns.name import Name
+from dns.resource import ResourceRecord
+from dns.rtypes import Type
+from dns.socketWrapper import SocketWrapper, local_ip
+
+
+def make_record(i):
+    """Create a unique A record for benchmark number i"""
+    return ResourceRecord.from_dict(
+        {"type": "A", "name": "host{}.bench.example.".format(i), "class": "IN",
+         "ttl": 3600, "rdata": {"address": "10.{}.{}.{}".format(
+             (i >> 16) & 255, (i >> 8) & 255, i & 255)}})
+
+
+def empty_cache(ttl=3600, **kwargs):
+    """Create a RecordCache that does not touch an existing cache file"""
+    fd, path = tempfile.mkstemp()
+    os.close(fd)
+    os.remove(path)
+    return RecordCache(ttl, path, **kwargs)
+
+
+def bench_cache_lookup(args):
+    """Lookup latency of RecordCache for growing cache sizes"""
+    print("{:>10} {:>14}".format("records", "lookup (us)"))
+    rc = empty_cache()
+    filled = 0
+    for size in args.sizes:
+        while filled < size:
+            rc.add_record(make_record(filled))
+            filled += 1
+        names = ["host{}.bench.example".format((i * 7919) % size)
+                 for i in range(args.lookups)]
+        t = time.perf_counter()
+        for name in names:
+            rc.lookup(name, Type.A, Class.IN)
+        d = time.perf_counter() - t
+        print("{:>10} {:>14.2f}".format(size, d / args.lookups * 1e6))
+
+
+def bench_cache_startup(args):
+    """Time to open a cache file in JSON and binary format"""
+    print("{:>10} {:>12} {:>12} {:>14}".format("records", "json (s)", "binary (s)", "1st lookup (us)"))
+    for size in args.sizes:
+        rc = empty_cache()
+        for i in range(size):
+            rc.add_record(make_record(i))
+        dcts = rc.dump()
+        times = []
+        opened = None
+        for binary in (False, True):
+            rc.binary = binary
+            rc.write_snapshot(dcts)
+            del opened
+            t = time.perf_counter()
+            opened = RecordCache(3600, rc.cachefile)
+            times.append(time.perf_counter() - t)
+        t = time.perf_counter()
+        opened.lookup("host{}.bench.example".format(size // 2), Type.A, Class.IN)
+        d = time.perf_counter() - t
+        os.remove(rc.cachefile)
+        print("{:>10} {:>12.3f} {:>12.3f} {:>14.1f}".format(size, times[0], times[1], d * 1e6))
+
+
+def bench_cache_threads(args):
+    """Throughput of concurrent lookups and inserts for growing thread counts"""
+    print("{:>8} {:>8} {:>12}".format("shards", "threads", "ops/s"))
+    records = [make_record(i) for i in range(args.records)]
+    for shards in args.shards:
+        rc = empty_cache(shards=shards)
+        for r in records:
+            rc.add_record(r)
+        for threads in args.threads:
+            def work(n):
+                for i in range(args.ops):
+                    r = records[(i * 7919 + n) % len(records)]
+                    if i % 10:
+                        rc.lookup(r.name, Type.A, Class.IN)
+                    else:
+                        rc.add_record(r)
+            workers = [threading.Thread(target=work, args=(n,)) for n in range(threads)]
+            t = time.perf_counter()
+            for w in workers:
+                w.start()
+            for w in workers:
+                w.join()
+            d = time.perf_counter() - t
+            print("{:>8} {:>8} {:>12.0f}".format(shards, threads, threads * args.ops / d))
+
+
+class FakeUpstream(asyncio.DatagramProtocol):
+    """Authoritative server answering every A query after a delay"""
+
+    def __init__(self, delay):
+        self.delay = delay
+
+    def connection_made(self, transport):
+        self.transport = transport
+
+    def datagram_received(self, data, addr):
+        query = Message.from_bytes(data)
+        q = query.questions[0]
+        query.header.qr = 1
+        query.header.aa = 1
+        query.answers = [ResourceRecord(q.qname, Type.A, Class.IN, 60,
+                                        make_record(0).rdata)]
+        query.header.an_count = 1
+        asyncio.get_running_loop().call_later(
+            self.delay, self.transport.sendto, query.to_bytes(), addr)
+
+
+def run_upstream(delay):
+    async def serve():
+        loop = asyncio.get_running_loop()
+        await loop.create_datagram_endpoint(lambda: FakeUpstream(delay),
+                                            local_addr=(local_ip(), 53))
+        await asyncio.Event().wait()
+    asyncio.run(serve())
+
+
+def run_engine(engine, port, directory, threads, workers):
+    from dns.aioserver import AsyncServer
+    from dns.server import Server
+    from dns.supervisor import Supervisor
+    os.chdir(directory)
+    cls = AsyncServer if engine == "asyncio" else Server
+    if not workers:
+        cls(port, True, 0, journal=True, threads=threads).serve()
+        return
+    supervisor = Supervisor(workers, lambda i, cache: cls(
+        port, True, 0, journal=True, threads=threads, reuse_port=True))
+    def stop(signum, frame):
+        supervisor.shutdown()
+        sys.exit(0)
+    signal.signal(signal.SIGTERM, stop)
+    supervisor.serve()
+
+
+async def load(port, names, concurrency, timeout):
+    """Send queries for names with a fixed number in flight
+
+    Returns:
+        ([float], int, float): latencies, number of timeouts and duration
+    """
+    loop = asyncio.get_running_loop()
+    ip = local_ip()
+    latencies = []
+    timeouts = [0]
+    todo = list(enumerate(names))
+
+    class Client(asyncio.DatagramProtocol):
+        def __init__(self):
+            self.future = None
+        def datagram_received(self, data, addr):
+            if self.future is not None and not self.future.done():
+                self.future.set_result(data)
+
+    async def worker():
+        transport, client = await loop.create_datagram_endpoint(
+            Client, local_addr=(ip, 0))
+        while todo:
+            i, name = todo.pop()
+            header = Header(i & 0xffff, 0, 1, 0, 0, 0)
+            header.rd = 1
+            query = Message(header, [Question(Name(name), Type.A, Class.IN)]).to_bytes()
+            client.future = loop.create_future()
+            t = time.perf_counter()
+            transport.sendto(query, (ip, port))
+            try:
+                await asyncio.wait_for(client.future, timeout)
+                latencies.append(time.perf_counter() - t)
+            except asyncio.TimeoutError:
+                timeouts[0] += 1
+        transport.close()
+
+    t = time.perf_counter()
+    await asyncio.gather(*[worker() for _ in range(concurrency)])
+    return latencies, timeouts[0], time.perf_counter() - t
+
+
+def bench_server_load(args):
+    """QPS and tail latency of the threaded and the asyncio engine"""
+    upstream = multiprocessing.Process(target=run_upstream, args=(args.delay,), daemon=True)
+    upstream.start()
+    print("{:>9} {:>8} {:>8} {:>8} {:>10} {:>10} {:>9}".format(
+        "engine", "workers", "mode", "qps", "p50 (ms)", "p99 (ms)", "timeouts"))
+    runs = [(e, w, m) for e in args.engines for w in args.workers for m in args.modes]
+    for engine, workers, mode in runs:
+        directory = tempfile.mkdtemp()
+        # a delegation to the fake upstream, and the answers for cached mode
+        now = time.time()
+        dcts = [{"type": "NS", "name": "bench.example.", "class": "IN", "ttl": 3600,
+                 "timestamp": now, "rdata": {"nsdname": "ns.bench.example."}},
+                {"type": "A", "name": "ns.bench.example.", "class": "IN", "ttl": 3600,
+                 "timestamp": now, "rdata": {"address": local_ip()}}]
+        names = ["q{}.{}.bench.example".format(i, mode) for i in range(args.queries)]
+        if mode == "cached":
+            for i, name in enumerate(names):
+                dct = make_record(i).to_dict()
+                dct.update(name=name, timestamp=now)
+                dcts.append(dct)
+        with open(os.path.join(directory, "cache"), "w") as file_:
+            json.dump(dcts, file_)
+        server = multiprocessing.Process(target=run_engine,
+                                         args=(engine, args.port, directory, args.threads, workers))
+        server.start()
+        time.sleep(args.warmup)
+        latencies, timeouts, d = asyncio.run(
+            load(args.port, names, args.concurrency, args.timeout))
+        server.terminate()
+        server.join()
+        latencies.sort()
+        pct = lambda p: latencies[min(int(p * len(latencies)), len(latencies) - 1)] * 1e3 if latencies else float("nan")
+        print("{:>9} {:>8} {:>8} {:>8.0f} {:>10.2f} {:>10.2f} {:>9}".format(
+            engine, workers, mode, len(latencies) / d, pct(0.5), pct(0.99), timeouts))
+    upstream.terminate()
+
+
+def blast(port, packets):
+    """Send packets queries to 127.0.0.1:port as fast as possible"""
+    import socket
+    sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    queries = [Message(Header(i & 0xffff, 0, 1, 0, 0, 0),
+                       [Question(Name("q.bench.example"), Type.A, Class.IN)]).to_bytes()
+               for i in range(1024)]
+    for i in range(packets):
+        sock.sendto(queries[i & 1023], ("127.0.0.1", port))
+
+
+class BaselineSocketWrapper(SocketWrapper):
+    """SocketWrapper with the loop it had before batching
+
+    Every wakeup of select reads a single datagram and queued sends are not
+    woken up for, so they wait for the select timeout. Datagrams go through
+    the same receive() as in SocketWrapper, only the loop differs.
+    """
+
+    def listen(self):
+        if self.close:
+            return
+        try:
+            r, _, _ = select.select([self.sock], [], [], 0.2)
+        except (OSError, ValueError):
+            return
+        if r:
+            try:
+                data, addr = self.sock.recvfrom(self.bufsize)
+            except OSError:
+                return
+            self.receive(data, addr)
+
+
+def bench_socket_io(args):
+    """Datagram intake rate and echo latency of SocketWrapper"""
+    for loop in args.loops:
+        wrapper_class = BaselineSocketWrapper if loop == "baseline" else SocketWrapper
+        print("{} loop".format(loop))
+        socket_io(wrapper_class, args)
+
+
+def socket_io(wrapper_class, args):
+    import socket
+    wrapper = wrapper_class(0, "127.0.0.1")
+    port = wrapper.sock.getsockname()[1]
+    received = [0, None, None]
+    def count(data):
+        received[0] += 1
+        received[2] = time.perf_counter()
+        if received[1] is None:
+            received[1] = received[2]
+    wrapper.fast_path = count
+    wrapper.start()
+
+    sender = multiprocessing.Process(target=blast, args=(port, args.packets))
+    sender.start()
+    sender.join()
+    time.sleep(1)
+    n, first, last = received
+    pps = n / (last - first) if n > 1 else float("nan")
+    print("intake: {} of {} datagrams ({:.1f}% lost), {:.0f} datagrams/s".format(
+        n, args.packets, 100.0 * (args.packets - n) / args.packets, pps))
+
+    wrapper.shutdown()
+
+    # echo: a consumer answers every query through the send queue after
+    # working on it for a while, like a request handler
+    wrapper = wrapper_class(0, "127.0.0.1")
+    port = wrapper.sock.getsockname()[1]
+    wrapper.start()
+    done = threading.Event()
+    def echo():
+        while not done.is_set():
+            query = wrapper.next_query(0.1)
+            if query is not None:
+                data, addr = query
+                msg = wrapper.decode(data)
+                time.sleep(args.work)
+                msg.header.qr = 1
+                wrapper.send((msg, addr[0], addr[1]))
+    consumer = threading.Thread(target=echo, daemon=True)
+    consumer.start()
+    client = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+    client.settimeout(2)
+    rtts = []
+    for i in range(args.pings):
+        query = Message(Header(40000 + i, 0, 1, 0, 0, 0),
+                        [Question(Name("ping.bench.example"), Type.A, Class.IN)]).to_bytes()
+        t = time.perf_counter()
+        client.sendto(query, ("127.0.0.1", port))
+        try:
+            while client.recv(4096)[:2] != query[:2]:
+                pass
+            rtts.append(time.perf_counter() - t)
+        except socket.timeout:
+            pass
+        time.sleep(0.01)
+    done.set()
+    wrapper.shutdown()
+    rtts.sort()
+    pct = lambda p: rtts[min(int(p * len(rtts)), len(rtts) - 1)] * 1e3 if rtts else float("nan")
+    print("echo: {} of {} answered, p50 {:.2f} ms, p99 {:.2f} ms".format(
+        len(rtts), args.pings, pct(0.5), pct(0.99)))
+
+
+def bench_metrics(args):
+    """Cost of recording metrics on the query path"""
+    from dns import metrics
+    counter = metrics.Counter("bench_total", "Bench")
+    labeled = metrics.Counter("bench_labeled_total", "Bench", ("rcode",))
+    histogram = metrics.Histogram("bench_seconds", "Bench", metrics.REQUEST_DURATION.buckets)
+    ops = [("counter inc", counter.inc),
+           ("labeled inc", lambda: labeled.labels(0).inc()),
+           ("histogram observe", lambda: histogram.observe(0.003))]
+    print("{:>20} {:>10}".format("operation", "ns"))
+    for name, op in ops:
+        t = time.perf_counter()
+        for _ in range(args.ops):
+            op()
+        print("{:>20} {:>10.0f}".format(name, (time.perf_counter() - t) / args.ops * 1e9))
+
+    class Null:
+        def inc(self, n=1):
+            pass
+    rc = empty_cache()
+    for i in range(1000):
+        rc.add_record(make_record(i))
+    names = ["host{}.bench.example".format(i % 1000) for i in range(args.ops)]
+    def lookups():
+        t = time.perf_counter()
+        for name in names:
+            rc.lookup(name, Type.A, Class.IN)
+        return (time.perf_counter() - t) / len(names) * 1e6
+    with_metrics = lookups()
+    hits, metrics.CACHE_HITS = metrics.CACHE_HITS, Null()
+    without = lookups()
+    metrics.CACHE_HITS = hits
+    print("cache lookup: {:.2f} us with metrics, {:.2f} us without".format(with_metrics, without))
+
+
+def run_bench():
+    parser = ArgumentParser(description="DNS Benchmarks")
+    sub = parser.add_subparsers(dest="bench")
+    sub.required = True
+
+    p = sub.add_parser("cache-lookup", help=bench_cache_lookup.__doc__)
+    p.add_argument("--sizes", type=int, nargs="+",
+            default=[1000, 10000, 100000, 1000000],
+            help="cache sizes to measure")
+    p.add_argument("--lookups", type=int, default=100000,
+            help="lookups per cache size")
+    p.set_defaults(func=bench_cache_lookup)
+
+    p = sub.add_parser("cache-startup", help=bench_cache_startup.__doc__)
+    p.add_argument("--sizes", type=int, nargs="+",
+            default=[1000, 10000, 100000, 1000000],
+            help="cache sizes to measure")
+    p.set_defaults(func=bench_cache_startup)
+
+    p = sub.add_parser("cache-threads", help=bench_cache_threads.__doc__)
+    p.add_argument("--shards", type=int, nargs="+", default=[1, 16],
+            help="shard counts to measure")
+    p.add_argument("--threads", type=int, nargs="+", default=[1, 2, 4, 8, 16],
+            help="thread counts to measure")
+    p.add_argument("--records", type=int, default=10000,
+            help="number of cached records")
+    p.add_argument("--ops", type=int, default=50000,
+            help="operations per thread")
+    p.set_defaults(func=bench_cache_threads)
+
+    p = sub.add_parser("server-load", help=bench_server_load.__doc__)
+    p.add_argument("--engines", nargs="+", default=["threaded", "asyncio"],
+            help="server engines to measure")
+    p.add_argument("--modes", nargs="+", default=["cached", "recursive"],
+            help="answer queries from the cache or by recursion to a fake upstream")
+    p.add_argument("--queries", type=int, default=500,
+            help="number of queries per run")
+    p.add_argument("--concurrency", type=int, default=50,
+            help="number of queries in flight")
+    p.add_argument("--delay", type=float, default=0.05,
+            help="response delay of the fake upstream name server")
+    p.add_argument("--threads", type=int, default=16,
+            help="worker threads of the threaded engine")
+    p.add_argument("--workers", type=int, nargs="+", default=[0],
+            help="numbers of server processes to measure (0 for a single process)")
+    p.add_argument("--port", type=int, default=5399,
+            help="port of the server")
+    p.add_argument("--timeout", type=float, default=2,
+            help="client timeout")
+    p.add_argument("--warmup", type=float, default=1,
+            help="seconds to wait for the server to start")
+    p.set_defaults(func=bench_server_load)
+
+    p = sub.add_parser("socket-io", help=bench_socket_io.__doc__)
+    p.add_argument("--packets", type=int, default=100000,
+            help="number of datagrams sent at full speed")
+    p.add_argument("--pings", type=int, default=200,
+            help="number of echo round trips")
+    p.add_argument("--work", type=float, default=0.001,
+            help="seconds the echo consumer works on a query")
+    p.add_argument("--loops", nargs="+", default=["baseline", "batched"],
+            choices=["baseline", "batched"],
+            help="socket loops to measure, baseline reads one datagram per "
+                 "wakeup and does not wake up for sends")
+    p.set_defaults(func=bench_socket_io)
+
+    p = sub.add_parser("metrics", help=bench_metrics.__doc__)
+    p.add_argument("--ops", type=int, default=200000,
+            help="operations per measurement")
+    p.set_defaults(func=bench_metrics)
+
+    args = parser.parse_args()
+    args.func(args)
+
+
+if __name__ == "__main__":
+    run_bench()
@@ -14,7 +14,9 @@ Note: our zone file is not called zone but ourdomain.zone to keep up with specif
 
 from argparse import ArgumentParser
 
+from dns.aioserver import AsyncServer
 from dns.server import Server
+from dns.supervisor import Supervisor
 
 
 def run_server():
@@ -25,9 +27,93 @@ def run_server():
             help="TTL value of cached entries (if > 0)")
     parser.add_argument("-p", "--port", type=int, default=5353,
             help="Port which server listens on")
+    parser.add_argument("--cache-size", metavar="records", type=int, default=0,
+            help="Maximum number of cached records (if > 0), divided over the "
+                 "shards, which evict on their own")
+    parser.add_argument("--cache-bytes", metavar="bytes", type=int, default=0,
+            help="Approximate memory budget of the cache (if > 0), divided over "
+                 "the shards like --cache-size")
+    parser.add_argument("--journal", action="store_true",
+            help="Persist the cache through an append-only journal")
+    parser.add_argument("--binary-cache", action="store_true",
+            help="Write the cache file as memory-mappable binary snapshot")
+    parser.add_argument("--cache-shards", metavar="n", type=int, default=16,
+            help="Number of independently locked cache shards")
+    parser.add_argument("--prefetch-hits", metavar="hits", type=int, default=0,
+            help="Refresh cached records hit this often before they expire (if > 0)")
+    parser.add_argument("--prefetch-fraction", metavar="fraction", type=float,
+            default=0.1, help="Fraction of the TTL in which records are refreshed")
+    parser.add_argument("--serve-stale", metavar="seconds", type=int, default=0,
+            help="Keep expired records this long to answer from when resolution fails (if > 0)")
+    parser.add_argument("--stale-deadline", metavar="seconds", type=float,
+            default=1.8, help="Time to wait for a resolution before answering stale")
+    parser.add_argument("--threads", metavar="n", type=int, default=16,
+            help="Number of worker threads handling requests")
+    parser.add_argument("--queue-size", metavar="n", type=int, default=256,
+            help="Maximum number of requests waiting for a worker")
+    parser.add_argument("--engine", choices=["threaded", "asyncio"], default="threaded",
+            help="Run the server on threads or on an asyncio event loop")
+    parser.add_argument("--workers", metavar="n", type=int, default=0,
+            help="Number of server processes sharing the port (if > 0)")
+    parser.add_argument("--shared-cache", action="store_true",
+            help="Let the server processes share one cache")
+    parser.add_argument("--packet-cache", metavar="responses", type=int, default=10000,
+            help="Number of encoded responses cached for repeated queries (0 disables)")
+    parser.add_argument("--tcp-connections", metavar="n", type=int, default=128,
+            help="Maximum number of open TCP connections")
+    parser.add_argument("--tcp-idle-timeout", metavar="seconds", type=float, default=10,
+            help="Time after which an idle TCP connection is closed")
+    parser.add_argument("--edns-size", metavar="bytes", type=int, default=1232,
+            help="UDP payload size advertised with EDNS(0) (0 disables EDNS)")
+    parser.add_argument("--rate-limit", metavar="responses", type=float, default=0,
+            help="Responses per second allowed per client prefix over UDP (if > 0)")
+    parser.add_argument("--rate-slip", metavar="n", type=int, default=2,
+            help="Answer every n-th rate limited query truncated instead of dropping it")
+    parser.add_argument("--max-pending", metavar="n", type=int, default=0,
+            help="Maximum number of requests being handled (default: threads + queue size)")
+    parser.add_argument("--shed", choices=["refused", "servfail", "drop"], default="refused",
+            help="Answer to requests shed when overloaded")
+    parser.add_argument("--metrics-port", metavar="port", type=int, default=0,
+            help="Serve Prometheus metrics on localhost at this port, worker i "
+                 "uses port + i (if > 0)")
+    parser.add_argument("--source-ports", metavar="n", type=int, default=0,
+            help="Send queries to name servers from n sockets on random ports "
+                 "instead of the server port (if > 0)")
+    parser.add_argument("--prime-roots", action="store_true",
+            help="Refresh the root hints with a priming query at startup")
     args = parser.parse_args()
 
-    server = Server(args.port, args.caching, args.ttl)
+    engine = AsyncServer if args.engine == "asyncio" else Server
+    def make_server(index=None, cache=None):
+        cachefile = "cache" if index is None else "cache.{}".format(index)
+        metrics_port = args.metrics_port
+        if metrics_port > 0 and index is not None:
+            metrics_port += index
+        return engine(args.port, args.caching, args.ttl,
+                      cache_size=args.cache_size, cache_bytes=args.cache_bytes,
+                      journal=args.journal, binary_cache=args.binary_cache,
+                      cache_shards=args.cache_shards, prefetch_hits=args.prefetch_hits,
+                      prefetch_fraction=args.prefetch_fraction,
+                      serve_stale=args.serve_stale, stale_deadline=args.stale_deadline,
+                      threads=args.threads, queue_size=args.queue_size,
+                      reuse_port=index is not None, cache=cache, cachefile=cachefile,
+                      packet_cache=args.packet_cache, tcp_connections=args.tcp_connections,
+                      tcp_idle_timeout=args.tcp_idle_timeout, edns_size=args.edns_size,
+                      rate_limit=args.rate_limit, rate_slip=args.rate_slip,
+                      max_pending=args.max_pending, shed=args.shed,
+                      metrics_port=metrics_port, source_ports=args.source_ports,
+                      prime_roots=args.prime_roots)
+
+    if args.workers > 0:
+        shared_cache = None
+        if args.shared_cache:
+            shared_cache = {"ttl": args.ttl, "max_entries": args.cache_size,
+                            "max_bytes": args.cache_bytes, "journal": args.journal,
+                            "binary": args.binary_cache, "shards": args.cache_shards,
+                            "stale_window": args.serve_stale}
+        server = Supervisor(args.workers, make_server, shared_cache)
+    else:
+        server = make_server()
     try:
         server.serve()
     except KeyboardInterrupt:
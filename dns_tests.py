@@ -3,7 +3,12 @@
 """Tests for your DNS resolver and server"""
 
 
+import asyncio
+import json
+import os
+import signal
 import sys
+import tempfile
 import unittest
 from unittest import TestCase
 import unittest
@@ -16,12 +21,25 @@ import threading
 from dns.classes import Class
 from dns.message import Message, Question, Header
 from dns.name import Name
+from dns.rcodes import RCode
 from dns.rtypes import Type
+from dns.aioserver import AsyncResolver, ServerProtocol
 from dns.cache import RecordCache
+from dns import metrics
+from dns.flight import SingleFlight
+from dns.packetcache import PacketCache
+from dns.pool import WorkerPool
+from dns.ratelimit import RateLimiter
+from dns.supervisor import CacheManager, SharedCache, Supervisor
+from dns.tcp import UDP_SIZE, TCPConnection, TCPListener, frame, read_message, query_tcp
+from dns.transactions import attempts, random_ports
 from dns.resource import *
+from dns.snapshot import json_to_snapshot
+from dns.roothints import RootHints, root_hints
 from dns.zone import Catalog
 
 import time
+from unittest.mock import MagicMock, patch
 
 
 PORT = 5001
@@ -52,14 +70,22 @@ class TestCache(TestCase):
             {"type": "A", "name": "dnsIsAwesome.com", "class": "IN", "ttl": 2, "rdata": {"address": "192.123.12.23"}})
         RC.add_record(self.r1)
         RC.write_cache_file()
+        self.tmp = tempfile.TemporaryDirectory()
+
+    def tearDown(self):
+        self.tmp.cleanup()
 
     def test_files(self):
         RC = self.RC
         RC.read_cache_file()
         r = RC.lookup("dnsIsAwesome.com",Type.A, Class.IN)
         r_in = False
+        r1d = self.r1.to_dict()
+        r1d.pop("ttl", None)
         for i in r:
-            if(i.to_dict() == self.r1.to_dict()):
+            d = i.to_dict()
+            # lookups return the TTL that is left
+            if d.pop("ttl") <= self.r1.ttl and d == r1d:
                 r_in = True
         self.assertEqual(True, r_in)
 
@@ -90,6 +116,977 @@ class TestCache(TestCase):
             l.pop("ttl", None)
         self.assertNotIn(r2d,ls)
 
+    def test_ttl_override(self):
+        RC = RecordCache(100, "testCacheLimits")
+        r2 = ResourceRecord.from_dict({"type": "A", "name": "ttl.com", "class": "IN", "ttl": 2, "rdata": {"address": "192.123.12.23"}})
+        RC.add_record(r2)
+        RC.replace_records("ttl.com", Type.A, Class.IN, [r2])
+        self.assertEqual(2, r2.ttl) # the caller's record is not changed
+        self.assertLess(90, RC.lookup("ttl.com", Type.A, Class.IN)[0].ttl)
+
+    def test_index(self):
+        r2 = ResourceRecord.from_dict({"type": "A", "name": "dnsIsAwesome.com", "class": "IN", "ttl": 2, "rdata": {"address": "192.123.12.23"}})
+        self.RC.add_record(r2)
+        rs = self.RC.lookup("DNSisAWESOME.com.", Type.A, Class.IN)
+        self.assertEqual(1, len(rs))
+        self.assertEqual(0, len(self.RC.lookup("dnsIsAwesome.com", Type.A, Class.CH)))
+
+    def test_matchByLabel(self):
+        ns = ResourceRecord.from_dict({"type": "NS", "name": "awesome.com", "class": "IN", "ttl": 2, "rdata": {"nsdname": "ns.awesome.com"}})
+        self.RC.add_record(ns)
+        rs = self.RC.matchByLabel("a.b.awesome.com", Type.NS, Class.IN)
+        self.assertEqual([ns.rdata.to_dict()], [r.rdata.to_dict() for r in rs])
+
+    def test_lru(self):
+        RC = RecordCache(100, "testCacheLimits", max_entries=2)
+        for i in range(3):
+            RC.add_record(ResourceRecord.from_dict({"type": "A", "name": "lru{}.com".format(i), "class": "IN", "ttl": 2, "rdata": {"address": "192.123.12.23"}}))
+            if i == 1:
+                RC.lookup("lru0.com", Type.A, Class.IN)
+        self.assertEqual(2, len(RC))
+        self.assertTrue(RC.lookup("lru0.com", Type.A, Class.IN))
+        self.assertFalse(RC.lookup("lru1.com", Type.A, Class.IN))
+        self.assertTrue(RC.lookup("lru2.com", Type.A, Class.IN))
+
+    def test_expiry(self):
+        RC = RecordCache(0, "testCacheLimits")
+        RC.add_record(ResourceRecord.from_dict({"type": "A", "name": "short.com", "class": "IN", "ttl": 0, "rdata": {"address": "192.123.12.23"}}))
+        RC.lookup("other.com", Type.A, Class.IN)
+        self.assertEqual(0, len(RC))
+        self.assertEqual(0, RC.nbytes)
+
+    def test_journal(self):
+        file = os.path.join(self.tmp.name, "cache")
+        RC = RecordCache(100, file, journal=True)
+        RC.add_record(self.r1)
+        RC.journal.flush() # simulate a crash: no snapshot is written
+        RC2 = RecordCache(100, file)
+        self.assertFalse(RC2.lookup("dnsIsAwesome.com", Type.A, Class.IN))
+        RC2 = RecordCache(100, file, journal=True)
+        self.assertTrue(RC2.lookup("dnsIsAwesome.com", Type.A, Class.IN))
+        RC2.close()
+        self.assertEqual(0, os.path.getsize(file + ".journal"))
+        RC3 = RecordCache(100, file)
+        self.assertTrue(RC3.lookup("dnsIsAwesome.com", Type.A, Class.IN))
+        RC.close()
+
+    def test_journal_replace(self):
+        file = os.path.join(self.tmp.name, "cache")
+        RC = RecordCache(100, file, journal=True)
+        RC.add_record(self.r1)
+        r2 = ResourceRecord.from_dict({"type": "A", "name": "dnsIsAwesome.com", "class": "IN", "ttl": 60, "rdata": {"address": "192.123.12.24"}})
+        RC.replace_records("dnsIsAwesome.com", Type.A, Class.IN, [r2])
+        RC.journal.flush() # simulate a crash: no snapshot is written
+        RC2 = RecordCache(100, file, journal=True)
+        rs = RC2.lookup("dnsIsAwesome.com", Type.A, Class.IN)
+        self.assertEqual(["192.123.12.24"], [r.rdata.address for r in rs])
+        RC2.close()
+        RC.close()
+
+    def test_journal_compact(self):
+        RC = RecordCache(100, os.path.join(self.tmp.name, "cache"), journal=True)
+        dump = RC.dump
+        blocked = []
+        def slow_dump():
+            appender = threading.Thread(target=RC.journal.append, args=(None,))
+            appender.start()
+            appender.join(1)
+            blocked.append(appender.is_alive())
+            return dump()
+        with patch.object(RC, "dump", side_effect=slow_dump):
+            RC.journal.compact()
+        self.assertEqual([False], blocked) # appends do not wait for the dump
+        RC.journal.pending = []
+        RC.close()
+
+    def test_binary(self):
+        RC = RecordCache(100, "testCache", binary=True) # migrates the JSON file
+        self.assertTrue(RC.lookup("dnsIsAwesome.com", Type.A, Class.IN))
+        RC.write_cache_file()
+        RC2 = RecordCache(100, "testCache")
+        self.assertIsNotNone(RC2.snapshot)
+        self.assertEqual(0, len(RC2))
+        rs = RC2.lookup("DNSISAWESOME.com", Type.A, Class.IN)
+        self.assertEqual([self.r1.to_dict()["rdata"]], [r.rdata.to_dict() for r in rs])
+        self.assertEqual(1, len(RC2))
+        self.assertFalse(RC2.lookup("dnsIsAwesome.com", Type.NS, Class.IN))
+
+    def test_write_dirty(self):
+        RC = RecordCache(100, "testCache", binary=True)
+        with patch.object(RC, "write_snapshot", wraps=RC.write_snapshot) as write:
+            RC.write_cache_file() # migrates the JSON file
+            RC.lookup("dnsIsAwesome.com", Type.A, Class.IN)
+            RC.write_cache_file()
+            self.assertEqual(1, write.call_count)
+            RC.add_record(self.r1)
+            RC.write_cache_file()
+            self.assertEqual(2, write.call_count)
+
+    def test_snapshot_names(self):
+        dct = self.r1.to_dict()
+        dct.update(name="noDot.com", timestamp=time.time())
+        file = os.path.join(self.tmp.name, "legacy")
+        with open(file, "w") as file_:
+            json.dump([dct], file_)
+        json_to_snapshot(file, file)
+        RC = RecordCache(100, file)
+        self.assertTrue(RC.lookup("nodot.com", Type.A, Class.IN))
+
+    def test_shards(self):
+        RC = RecordCache(100, "testCacheLimits", shards=8)
+        def add(n):
+            for i in range(200):
+                RC.add_record(ResourceRecord.from_dict({"type": "A", "name": "t{}.shard{}.com".format(n, i), "class": "IN", "ttl": 60, "rdata": {"address": "192.123.12.23"}}))
+                RC.lookup("t{}.shard{}.com".format(n, i // 2), Type.A, Class.IN)
+        threads = [threading.Thread(target=add, args=(n,)) for n in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(800, len(RC))
+        self.assertTrue(RC.lookup("t3.shard199.com", Type.A, Class.IN))
+
+    def test_shard_limits(self):
+        for max_entries, shards in [(20, 16), (3, 16)]:
+            RC = RecordCache(0, "testCacheLimits", max_entries=max_entries, shards=shards)
+            self.assertEqual(max_entries, sum(shard.max_entries for shard in RC.shards))
+            for i in range(100):
+                RC.add_record(ResourceRecord.from_dict({"type": "A", "name": "limit{}.com".format(i), "class": "IN", "ttl": 60, "rdata": {"address": "192.123.12.23"}}))
+                self.assertLessEqual(len(RC), max_entries)
+
+    def test_prefetch(self):
+        RC = RecordCache(0, "testCacheLimits", prefetch_hits=2, prefetch_fraction=1.0)
+        calls = []
+        RC.prefetcher = lambda *q: calls.append(q)
+        RC.add_record(self.r1)
+        RC.lookup("dnsIsAwesome.com", Type.A, Class.IN)
+        self.assertEqual(0, len(calls))
+        RC.lookup("dnsIsAwesome.com", Type.A, Class.IN)
+        RC.lookup("dnsIsAwesome.com", Type.A, Class.IN)
+        self.assertEqual([("dnsIsAwesome.com", Type.A, Class.IN)], calls)
+        r2 = ResourceRecord.from_dict({"type": "A", "name": "dnsIsAwesome.com", "class": "IN", "ttl": 60, "rdata": {"address": "192.123.12.24"}})
+        RC.replace_records("dnsIsAwesome.com", Type.A, Class.IN, [r2])
+        self.assertEqual([r2.rdata.to_dict()],
+                         [r.rdata.to_dict() for r in RC.lookup("dnsIsAwesome.com", Type.A, Class.IN)])
+        self.assertEqual(2, len(calls)) # still popular after the refresh
+
+    def test_stale(self):
+        RC = RecordCache(0, "testCacheLimits", stale_window=60)
+        RC.add_record(ResourceRecord.from_dict({"type": "A", "name": "stale.com", "class": "IN", "ttl": 0, "rdata": {"address": "192.123.12.23"}}))
+        self.assertFalse(RC.lookup("stale.com", Type.A, Class.IN))
+        rs = RC.lookup_stale("stale.com", Type.A, Class.IN)
+        self.assertEqual(["192.123.12.23"], [r.rdata.address for r in rs])
+        self.assertEqual(30, rs[0].ttl)
+
+    def test_stale_handler(self):
+        RC = RecordCache(0, "testCacheLimits", stale_window=60)
+        RC.add_record(ResourceRecord.from_dict({"type": "A", "name": "stale.com", "class": "IN", "ttl": 0, "rdata": {"address": "192.123.12.23"}}))
+        resolver = MagicMock()
+        resolver.gethostbyname.side_effect = lambda name: time.sleep(1) or (name, [], [])
+        pool = WorkerPool(1, 4, lambda: resolver)
+        rq = RequestHandler(None, None, None, MagicMock(), True, RC, 0, 0.1, pool=pool)
+        threads = threading.active_count()
+        t = time.time()
+        hostname, aliases, ips = rq.resolve("stale.com")
+        self.assertLess(time.time() - t, 0.5)
+        self.assertEqual(["192.123.12.23"], [r.rdata.address for r in ips])
+        self.assertEqual(threads, threading.active_count())
+        pool.shutdown()
+
+    def test_stale_negative(self):
+        RC = RecordCache(0, "testCacheLimits", stale_window=60)
+        RC.add_record(ResourceRecord.from_dict({"type": "A", "name": "stale.com", "class": "IN", "ttl": 0, "rdata": {"address": "192.123.12.23"}}))
+        soa = ResourceRecord.from_dict({"type": "SOA", "name": "stale.com", "class": "IN", "ttl": 60,
+                                        "rdata": {"mname": "ns.stale.com", "rname": "admin.stale.com", "serial": 1,
+                                                  "refresh": 1, "retry": 1, "expire": 1, "minimum": 60}})
+        def nxdomain(name):
+            RC.add_negative(name, Type.A, Class.IN, RCode.NXDomain, soa)
+            return name, [], []
+        resolver = MagicMock()
+        resolver.gethostbyname.side_effect = nxdomain
+        rq = RequestHandler(None, None, None, MagicMock(), True, RC, 0, 0.1, resolver=resolver)
+        self.assertEqual([], rq.resolve("stale.com")[2]) # the name is gone
+
+    def test_delegations(self):
+        RC = RecordCache(0, "testCacheLimits")
+        for name, ttl in [("com", 60), ("awesome.com", 60), ("deep.awesome.com", 0)]:
+            RC.add_record(ResourceRecord.from_dict({"type": "NS", "name": name, "class": "IN", "ttl": ttl, "rdata": {"nsdname": "ns." + name}}))
+        self.assertEqual(["deep.awesome.com.", "awesome.com.", "com."], RC.delegations.cuts("a.deep.awesome.com.", Class.IN))
+        rs = RC.matchByLabel("a.deep.awesome.com", Type.NS, Class.IN)
+        self.assertEqual(["ns.awesome.com."], [str(r.rdata.nsdname) for r in rs])
+        self.assertEqual(["awesome.com.", "com."], RC.delegations.cuts("a.deep.awesome.com.", Class.IN))
+
+    def test_delegations_race(self):
+        RC = RecordCache(0, "testCacheLimits")
+        ns = {"type": "NS", "name": "awesome.com", "class": "IN", "ttl": 0, "rdata": {"nsdname": "ns.awesome.com"}}
+        RC.add_record(ResourceRecord.from_dict(ns))
+        lookup = RC.lookup
+        def racing_lookup(*args):
+            records = lookup(*args)
+            # another thread caches the delegation again right after the miss
+            RC.add_record(ResourceRecord.from_dict(dict(ns, ttl=60)))
+            return records
+        with patch.object(RC, "lookup", side_effect=racing_lookup):
+            RC.matchByLabel("a.awesome.com", Type.NS, Class.IN)
+        self.assertEqual(["awesome.com."], RC.delegations.cuts("a.awesome.com.", Class.IN))
+        self.assertEqual({}, RC.delegations.roots[Class.IN].children["com"].children["awesome"].children)
+
+
+class TestNegativeCache(TestCase):
+    """Negative caching tests"""
+    def setUp(self):
+        self.RC = RecordCache(100, "testCacheNegative")
+        self.soa = ResourceRecord.from_dict(
+            {"type": "SOA", "name": "awesome.com", "class": "IN", "ttl": 60,
+             "rdata": {"mname": "ns.awesome.com", "rname": "admin.awesome.com", "serial": 1,
+                       "refresh": 1, "retry": 1, "expire": 1, "minimum": 2}})
+
+    def test_negative(self):
+        self.RC.add_negative("typo.awesome.com", Type.A, Class.IN, RCode.NXDomain, self.soa)
+        rcode, soa = self.RC.lookup_negative("TYPO.awesome.com", Type.A, Class.IN)
+        self.assertEqual(RCode.NXDomain, rcode)
+        self.assertIsNone(self.RC.lookup_negative("typo.awesome.com", Type.NS, Class.IN))
+        time.sleep(2.1) # SOA minimum is lower than its TTL
+        self.assertIsNone(self.RC.lookup_negative("typo.awesome.com", Type.A, Class.IN))
+
+    def test_soa_ttl(self):
+        self.RC.add_negative("typo.awesome.com", Type.A, Class.IN, RCode.NXDomain, self.soa)
+        rcode, soa = self.RC.lookup_negative("typo.awesome.com", Type.A, Class.IN)
+        self.assertLessEqual(soa.ttl, 2) # capped at the SOA minimum
+        self.assertEqual(60, self.soa.ttl)
+
+    def test_handler(self):
+        self.RC.add_negative("typo.awesome.com", Type.A, Class.IN, RCode.NXDomain, self.soa)
+        self.RC.add_negative("empty.awesome.com", Type.A, Class.IN, RCode.NoError, self.soa)
+        for name, type_, rcode in [("typo.awesome.com", Type.MX, RCode.NXDomain),
+                                   ("empty.awesome.com", Type.A, RCode.NoError),
+                                   ("empty.awesome.com", Type.MX, None)]:
+            mess = Message(Header(1, 0, 1, 0, 0, 0), [Question(Name(name), type_, Class.IN)])
+            handler = RequestHandler(mess, ("127.0.0.1", 1), Catalog(), None, False, self.RC, resolver=MagicMock())
+            negative = handler.lookupNegative(name, type_, Class.IN)
+            self.assertEqual(rcode, negative and negative[0])
+            if negative:
+                self.assertLessEqual(negative[1].ttl, 2)
+
+    def test_resolver(self):
+        self.RC.add_record(ResourceRecord.from_dict({"type": "NS", "name": "awesome.com", "class": "IN", "ttl": 60, "rdata": {"nsdname": "ns.awesome.com"}}))
+        self.RC.add_record(ResourceRecord.from_dict({"type": "A", "name": "ns.awesome.com", "class": "IN", "ttl": 60, "rdata": {"address": "192.0.2.1"}}))
+        header = Header(0, 0, 0, 0, 1, 0)
+        header.qr = 1
+        header.rcode = RCode.NXDomain
+        response = Message(header, [], [], [self.soa])
+        sock = MagicMock()
+        sock.exchange.return_value = response
+        res = Resolver(5, True, 0, sock, self.RC)
+        self.assertEqual([], res.gethostbyname("typo.awesome.com")[2])
+        self.assertEqual(1, sock.exchange.call_count)
+        self.assertEqual([], res.gethostbyname("typo.awesome.com")[2])
+        self.assertEqual(1, sock.exchange.call_count)
+
+    def test_soa_bytes(self):
+        packet = self.soa.to_bytes(0, {})
+        soa, _ = ResourceRecord.from_bytes(packet, 0)
+        self.assertEqual(self.soa.to_dict(), soa.to_dict())
+
+
+class TestTransactions(TestCase):
+    """Retransmission and source ports of upstream queries"""
+    def test_attempts(self):
+        self.assertEqual([1, 2, 4], list(attempts(1, 2, time.monotonic() + 60)))
+        timeouts = list(attempts(1, 5, time.monotonic() + 2.5))
+        self.assertEqual([1, 2], timeouts[:2])
+        self.assertTrue(all(t <= 2.5 for t in timeouts))
+        self.assertEqual([], list(attempts(1, 2, time.monotonic())))
+
+    def test_random_ports(self):
+        used = set()
+        def bind(port):
+            if not used:
+                used.add(port)
+                raise OSError("in use")
+            return port
+        ports = random_ports(bind, 2)
+        self.assertEqual(2, len(ports))
+        self.assertTrue(all(1024 <= port < 65536 for port in ports))
+
+    def response(self):
+        header = Header(0, 0, 0, 1, 0, 0)
+        header.qr = 1
+        rr = ResourceRecord.from_dict({"type": "A", "name": "a.com", "class": "IN", "ttl": 60, "rdata": {"address": "192.0.2.2"}})
+        return Message(header, [], [rr])
+
+    def test_retransmit(self):
+        sock = MagicMock()
+        sock.exchange.side_effect = [None, None, self.response()]
+        res = Resolver(5, False, 0, sock, RecordCache(0, "testCacheRetry"), attempt_timeout=0.5,
+                       server_timeout=0)
+        query = Message(Header(1, 0, 1, 0, 0, 0), [Question(Name("a.com"), Type.A, Class.IN)])
+        self.assertIsNotNone(res.exchange(query, "192.0.2.1"))
+        self.assertEqual([0.5, 1, 2], [call[0][2] for call in sock.exchange.call_args_list])
+
+    def test_dead_server(self):
+        calls = []
+        def exchange(query, addr, timeout):
+            calls.append((addr, timeout, query.header.ident))
+            if addr == "192.0.2.1":
+                time.sleep(timeout)
+                return None
+            response = self.response()
+            response.header.ident = query.header.ident
+            return response
+        sock = MagicMock()
+        sock.exchange.side_effect = exchange
+        hints = RootHints([ResourceRecord.from_dict({"type": "A", "name": name, "class": "IN", "ttl": 60, "rdata": {"address": address}})
+                           for name, address in [("live.root.", "192.0.2.2"), ("dead.root.", "192.0.2.1")]])
+        res = Resolver(1, False, 0, sock, RecordCache(0, "testCacheRetry"), attempt_timeout=0.1,
+                       retries=5, hints=hints, server_timeout=0.3)
+        self.assertEqual(["192.0.2.2"], [rr.rdata.address for rr in res.gethostbyname("a.com")[2]])
+        dead = [timeout for addr, timeout, _ in calls if addr == "192.0.2.1"]
+        self.assertLessEqual(sum(dead), 0.31)
+        self.assertEqual("192.0.2.2", calls[-1][0])
+        self.assertEqual(len(calls), len(set(ident for _, _, ident in calls))) # new ID per transmission
+
+    def test_budget(self):
+        sock = MagicMock()
+        sock.exchange.return_value = None
+        ports = [MagicMock(), MagicMock()]
+        for port in ports:
+            port.exchange.return_value = None
+        res = Resolver(0.3, False, 0, sock, RecordCache(0, "testCacheRetry"),
+                       attempt_timeout=0.1, ports=ports)
+        query = Message(Header(1, 0, 1, 0, 0, 0), [Question(Name("a.com"), Type.A, Class.IN)])
+        deadline = time.monotonic() + 0.3
+        self.assertIsNone(res.exchange(query, "192.0.2.1", deadline))
+        self.assertEqual(0, sock.exchange.call_count)
+        self.assertEqual(3, sum(port.exchange.call_count for port in ports))
+        self.assertIsNone(res.exchange(query, "192.0.2.1", time.monotonic()))
+        self.assertEqual(3, sum(port.exchange.call_count for port in ports))
+
+
+class TestRootHints(TestCase):
+    """Root name servers shared by the resolvers"""
+    def server(self, name, address):
+        return ResourceRecord.from_dict({"type": "A", "name": name, "class": "IN", "ttl": 60, "rdata": {"address": address}})
+
+    def test_file(self):
+        hints = root_hints()
+        self.assertIs(hints, root_hints())
+        self.assertEqual(13, len(hints.servers))
+        self.assertIn("198.41.0.4", [rr.rdata.address for rr in hints.servers])
+
+    def test_no_io(self):
+        sock = MagicMock()
+        sock.exchange.return_value = None
+        res = Resolver(5, False, 0, sock, RecordCache(0, "testCacheHints"), retries=0)
+        with patch("dns.zone.open", side_effect=AssertionError("file read")):
+            res.gethostbyname("a.com")
+            res.gethostbyname("b.com")
+        self.assertEqual(26, sock.exchange.call_count)
+
+    def test_prime(self):
+        hints = RootHints([self.server("old.root.", "192.0.2.1")])
+        header = Header(0, 0, 0, 2, 0, 2)
+        header.qr = 1
+        ns = [ResourceRecord.from_dict({"type": "NS", "name": ".", "class": "IN", "ttl": 60, "rdata": {"nsdname": n}})
+              for n in ["a.root.", "b.root."]]
+        for rr in ns:
+            rr.name = Name([])
+        response = Message(header, [], ns, [], [self.server("a.root.", "192.0.2.10"),
+                                                 self.server("elsewhere.", "192.0.2.11")])
+        sock = MagicMock()
+        sock.exchange.return_value = response
+        res = Resolver(5, False, 0, sock, RecordCache(0, "testCacheHints"), hints=hints)
+        self.assertTrue(res.prime())
+        query, addr, _ = sock.exchange.call_args[0]
+        self.assertEqual("192.0.2.1", addr)
+        self.assertEqual((Type.NS, []), (query.questions[0].qtype, query.questions[0].qname.labels))
+        self.assertEqual(["192.0.2.10"], [rr.rdata.address for rr in hints.servers])
+        self.assertTrue(hints.primed)
+        response.header.rcode = RCode.ServFail
+        self.assertFalse(res.prime())
+        self.assertEqual(["192.0.2.10"], [rr.rdata.address for rr in hints.servers])
+
+
+class TestPacketCache(TestCase):
+    """Wire-format response cache tests"""
+    def response(self, name, ttl):
+        header = Header(7, 0, 1, 1, 0, 0)
+        header.qr = 1
+        header.rd = 1
+        rr = ResourceRecord.from_dict({"type": "A", "name": name, "class": "IN", "ttl": ttl, "rdata": {"address": "192.0.2.1"}})
+        return Message(header, [Question(Name(name), Type.A, Class.IN)], [rr]).to_bytes()
+
+    def query(self, ident, name, rd=1):
+        header = Header(ident, 0, 1, 0, 0, 0)
+        header.rd = rd
+        return Message(header, [Question(Name(name), Type.A, Class.IN)]).to_bytes()
+
+    def test_hit(self):
+        packets = PacketCache()
+        packets.store(self.response("www.awesome.com", 60))
+        self.assertIsNone(packets.lookup(self.query(42, "www.awesome.com", rd=0)))
+        reply = Message.from_bytes(packets.lookup(self.query(42, "WWW.Awesome.com")))
+        self.assertEqual(42, reply.header.ident)
+        self.assertEqual("WWW.Awesome.com.", str(reply.questions[0].qname))
+        self.assertEqual("192.0.2.1", reply.answers[0].rdata.address)
+        self.assertEqual(1, packets.hits)
+
+    def test_ttl(self):
+        packets = PacketCache()
+        packets.store(self.response("www.awesome.com", 2))
+        packets.store(self.response("zero.awesome.com", 0))
+        self.assertIsNone(packets.lookup(self.query(1, "zero.awesome.com")))
+        time.sleep(1.1)
+        reply = Message.from_bytes(packets.lookup(self.query(1, "www.awesome.com")))
+        self.assertEqual(1, reply.answers[0].ttl)
+        time.sleep(1)
+        self.assertIsNone(packets.lookup(self.query(1, "www.awesome.com")))
+
+    def test_cache_ttl(self):
+        RC = RecordCache(0, "testCachePacketTTL")
+        packets = PacketCache()
+        soa = ResourceRecord.from_dict(
+            {"type": "SOA", "name": "awesome.com", "class": "IN", "ttl": 3600,
+             "rdata": {"mname": "ns.awesome.com", "rname": "admin.awesome.com", "serial": 1,
+                       "refresh": 1, "retry": 1, "expire": 1, "minimum": 60}})
+        with patch("time.time", return_value=1000.0):
+            RC.add_record(ResourceRecord.from_dict({"type": "A", "name": "www.awesome.com", "class": "IN", "ttl": 2, "rdata": {"address": "192.0.2.1"}}))
+            RC.add_negative("typo.awesome.com", Type.A, Class.IN, RCode.NXDomain, soa)
+        with patch("time.time", return_value=1000.5):
+            for name in ["www.awesome.com", "typo.awesome.com"]:
+                handler = RequestHandler(Message.from_bytes(self.query(1, name)), ("127.0.0.1", 1),
+                                         Catalog(), None, True, RC, resolver=MagicMock(), packets=packets)
+                steps = handler.answer()
+                try:
+                    next(steps)
+                except StopIteration as stop:
+                    response = Message.from_bytes(handler.encode(stop.value))
+                records = response.answers + response.authorities
+                self.assertEqual([1] if name.startswith("www") else [59], [rr.ttl for rr in records])
+        with patch("time.time", return_value=1002.1):
+            self.assertIsNone(packets.lookup(self.query(1, "www.awesome.com")))
+            self.assertIsNotNone(packets.lookup(self.query(1, "typo.awesome.com")))
+        with patch("time.time", return_value=1060.0):
+            self.assertIsNone(packets.lookup(self.query(1, "typo.awesome.com")))
+
+    def test_lru(self):
+        packets = PacketCache(max_entries=2)
+        for name in ["a.awesome.com", "b.awesome.com", "c.awesome.com"]:
+            packets.store(self.response(name, 60))
+        self.assertIsNone(packets.lookup(self.query(1, "a.awesome.com")))
+        self.assertIsNotNone(packets.lookup(self.query(1, "c.awesome.com")))
+
+
+class TestSingleFlight(TestCase):
+    """Coalescing of concurrent resolutions"""
+    def test_threads(self):
+        flights = SingleFlight()
+        calls = []
+        def resolve():
+            calls.append(1)
+            time.sleep(0.2)
+            return "result"
+        results = []
+        threads = [threading.Thread(target=lambda: results.append(flights.do(("a.com.", Type.A, Class.IN), resolve)))
+                   for _ in range(10)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(["result"] * 10, results)
+        self.assertEqual(1, len(calls))
+        self.assertEqual(9, flights.coalesced)
+        self.assertEqual({}, flights.calls)
+
+    def test_resolver(self):
+        flights = SingleFlight()
+        calls = []
+        async def exchange(query, addr, timeout):
+            calls.append(addr)
+            await asyncio.sleep(0.1)
+            return None
+        protocol = MagicMock()
+        protocol.exchange = exchange
+        RC = RecordCache(0, "testCacheFlight")
+        RC.add_record(ResourceRecord.from_dict({"type": "NS", "name": "com", "class": "IN", "ttl": 60, "rdata": {"nsdname": "ns.com"}}))
+        RC.add_record(ResourceRecord.from_dict({"type": "A", "name": "ns.com", "class": "IN", "ttl": 60, "rdata": {"address": "192.0.2.1"}}))
+        res = AsyncResolver(5, True, 0, protocol, RC, flights, retries=0, hints=RootHints())
+        async def run():
+            return await asyncio.gather(*[res.gethostbyname(name) for name in ["x.com", "X.com.", "y.com"]])
+        results = asyncio.run(run())
+        self.assertEqual(["x.com", "x.com", "y.com"], [r[0] for r in results])
+        self.assertEqual(["192.0.2.1", "192.0.2.1"], calls)
+        self.assertEqual(1, flights.coalesced)
+        self.assertEqual({}, flights.tasks)
+
+
+class TestTCP(TestCase):
+    """DNS over TCP and truncation"""
+    def setUp(self):
+        def handle(query, addr, conn):
+            query.header.qr = 1
+            def reply():
+                conn.send((query, addr[0], addr[1]))
+                conn.done()
+            threading.Timer(0.1 * query.header.ident, reply).start()
+        self.listener = TCPListener("127.0.0.1", 0, handle, max_connections=1, idle_timeout=0.5)
+        self.port = self.listener.sock.getsockname()[1]
+        self.listener.start()
+
+    def tearDown(self):
+        self.listener.shutdown()
+
+    def query(self, ident):
+        return Message(Header(ident, 0, 1, 0, 0, 0), [Question(Name("a.com"), Type.A, Class.IN)])
+
+    def test_pipelining(self):
+        sock = socket.create_connection(("127.0.0.1", self.port))
+        sock.sendall(b"".join(frame(self.query(i).to_bytes()) for i in [3, 2, 1]))
+        idents = [Message.from_bytes(read_message(sock)).header.ident for _ in range(3)]
+        self.assertEqual([1, 2, 3], idents)
+        sock.settimeout(2)
+        self.assertIsNone(read_message(sock)) # closed when idle
+        sock.close()
+
+    def test_partial_frame(self):
+        client, server = socket.socketpair()
+        server.settimeout(0.1)
+        self.assertRaises(socket.timeout, read_message, server)
+        client.sendall(frame(self.query(1).to_bytes())[:5])
+        self.assertIsNone(read_message(server)) # out of sync
+        client.close()
+        server.close()
+
+    def test_limit(self):
+        first = socket.create_connection(("127.0.0.1", self.port))
+        time.sleep(0.1)
+        second = socket.create_connection(("127.0.0.1", self.port))
+        second.settimeout(1)
+        self.assertIsNone(read_message(second))
+        self.assertEqual(1, self.listener.refused)
+        first.close()
+        second.close()
+        time.sleep(0.1)
+        self.assertEqual(5, query_tcp(self.query(5), "127.0.0.1", 2, self.port).header.ident)
+
+    def test_truncation(self):
+        mess = self.query(1)
+        rrs = [ResourceRecord.from_dict({"type": "A", "name": "a.com", "class": "IN", "ttl": 60, "rdata": {"address": "192.0.2.{}".format(i)}}) for i in range(40)]
+        mess.answers += rrs
+        handler = RequestHandler(mess, ("127.0.0.1", 1), Catalog(), None, False, RecordCache(0, "testCacheTCP"), resolver=MagicMock())
+        response = Message.from_bytes(handler.encode(mess))
+        self.assertEqual(1, response.header.tc)
+        self.assertEqual([], response.answers)
+        self.assertEqual(1, len(response.questions))
+
+    def test_resolver(self):
+        truncated = self.query(1)
+        truncated.header.qr = 1
+        truncated.header.tc = 1
+        sock = MagicMock()
+        sock.exchange.return_value = truncated
+        res = Resolver(5, False, 0, sock, RecordCache(0, "testCacheTCP"))
+        full = self.query(1)
+        with patch("dns.resolver.query_tcp", return_value=full) as tcp:
+            self.assertIs(full, res.exchange(self.query(1), "192.0.2.1"))
+            self.assertEqual(1, tcp.call_count)
+
+
+class TestEDNS(TestCase):
+    """EDNS(0) OPT records"""
+    def query(self, size):
+        mess = Message(Header(1, 0, 1, 0, 0, 0), [Question(Name("a.com"), Type.A, Class.IN)])
+        if size:
+            mess.add_opt(size)
+        return mess
+
+    def test_opt(self):
+        mess = self.query(4096)
+        mess.opt().rdata.options.append((10, b"cookie"))
+        opt = Message.from_bytes(mess.to_bytes()).opt()
+        self.assertEqual(Type.OPT, opt.type_)
+        self.assertEqual(4096, opt.class_)
+        self.assertEqual([(10, b"cookie")], opt.rdata.options)
+        self.assertIsNone(self.query(0).opt())
+
+    def test_payload_size(self):
+        rrs = [ResourceRecord.from_dict({"type": "A", "name": "a.com", "class": "IN", "ttl": 60, "rdata": {"address": "192.0.2.{}".format(i)}}) for i in range(40)]
+        for size, tc in [(0, 1), (512, 1), (4096, 0)]:
+            mess = self.query(size)
+            handler = RequestHandler(mess, ("127.0.0.1", 1), Catalog(), None, False, RecordCache(0, "testCacheEDNS"),
+                                     resolver=MagicMock(), edns_size=1232)
+            cached = MagicMock()
+            cached.lookup.return_value = rrs
+            handler.cache = cached
+            response = Message.from_bytes(handler.encode(self.answer(handler)))
+            self.assertEqual(tc, response.header.tc)
+            self.assertEqual(size > 0, response.opt() is not None)
+            if size:
+                self.assertEqual(1232, response.opt().class_)
+
+    def test_disabled(self):
+        handler = RequestHandler(self.query(4096), ("127.0.0.1", 1), Catalog(), None, False, RecordCache(0, "testCacheEDNS"),
+                                 resolver=MagicMock())
+        cached = MagicMock()
+        cached.lookup.return_value = []
+        cached.lookup_negative.return_value = None
+        handler.cache = cached
+        response = Message.from_bytes(handler.encode(self.answer(handler)))
+        self.assertIsNone(response.opt())
+        self.assertEqual(UDP_SIZE, handler.max_size)
+
+    def answer(self, handler):
+        try:
+            next(handler.answer())
+        except StopIteration as stop:
+            return stop.value
+
+    def test_packet_cache(self):
+        packets = PacketCache()
+        response = self.query(1232)
+        response.header.qr = 1
+        response.answers.append(ResourceRecord.from_dict({"type": "A", "name": "a.com", "class": "IN", "ttl": 60, "rdata": {"address": "192.0.2.1"}}))
+        response.header.an_count = 1
+        packets.store(response.to_bytes())
+        self.assertIsNone(packets.lookup(self.query(0).to_bytes()))
+        reply = Message.from_bytes(packets.lookup(self.query(4096).to_bytes()))
+        self.assertEqual(60, reply.answers[0].ttl)
+        self.assertEqual(0, reply.opt().ttl)
+
+
+class TestRateLimit(TestCase):
+    """Response rate limiting"""
+    def setUp(self):
+        self.query = Message(Header(7, 0, 1, 0, 0, 0), [Question(Name("a.com"), Type.A, Class.IN)]).to_bytes()
+
+    def test_bucket(self):
+        limiter = RateLimiter(10, slip=2)
+        verdicts = [limiter.check(self.query, "192.0.2.{}".format(i % 2)) for i in range(14)]
+        self.assertEqual([True] * 10, [allowed for allowed, _ in verdicts[:10]])
+        self.assertEqual([False] * 4, [allowed for allowed, _ in verdicts[10:]])
+        self.assertEqual((2, 2), (limiter.dropped, limiter.slipped))
+        reply = Message.from_bytes([reply for _, reply in verdicts if reply][0])
+        self.assertEqual((1, 1, 7), (reply.header.qr, reply.header.tc, reply.header.ident))
+        self.assertEqual("a.com.", str(reply.questions[0].qname))
+        self.assertTrue(limiter.check(self.query, "192.0.3.1")[0]) # other prefix
+        time.sleep(0.2)
+        self.assertTrue(limiter.check(self.query, "192.0.2.1")[0]) # refilled
+
+    def test_slip_per_prefix(self):
+        limiter = RateLimiter(0.01, burst=1, slip=2)
+        ips = ["192.0.2.1", "192.0.3.1"] * 3
+        verdicts = [limiter.check(self.query, ip) for ip in ips][2:]
+        self.assertEqual([None, None, bytes, bytes], [reply and type(reply) for _, reply in verdicts])
+
+    def test_table(self):
+        limiter = RateLimiter(1000, burst=1, max_entries=2)
+        for ip in ["192.0.1.1", "192.0.2.1", "192.0.3.1"]:
+            limiter.check(self.query, ip)
+        self.assertEqual([b"\xc0\x00\x02", b"\xc0\x00\x03"], list(limiter.buckets))
+        time.sleep(0.01)
+        limiter.check(self.query, "2001:db8::1")
+        self.assertEqual(1, len(limiter.buckets))
+
+    def test_responses(self):
+        limiter = RateLimiter(1, slip=0)
+        response = bytearray(self.query)
+        response[2] |= 0x80
+        for _ in range(5):
+            self.assertEqual((True, None), limiter.check(bytes(response), "192.0.2.1"))
+
+
+class TestBackpressure(TestCase):
+    """Admission control and load shedding"""
+    def query(self, name):
+        header = Header(1, 0, 1, 0, 0, 0)
+        header.rd = 1
+        return Message(header, [Question(Name(name), Type.A, Class.IN)])
+
+    def server(self, max_pending):
+        server = Server.__new__(Server)
+        server.caching = True
+        server.cache = RecordCache(0, "testCacheBackpressure")
+        server.cache.add_record(ResourceRecord.from_dict({"type": "A", "name": "cached.com", "class": "IN", "ttl": 60, "rdata": {"address": "192.0.2.1"}}))
+        server.catalog = Catalog()
+        server.max_pending = max_pending
+        server.shed_rcode = RCode.Refused
+        server.pending = 0
+        server.shed_count = 0
+        server.lock = threading.Lock()
+        server.pool = MagicMock()
+        server.sock = MagicMock()
+        return server
+
+    def test_admission(self):
+        server = self.server(4)
+        server.admit(self.query("new.com"), ("192.0.2.9", 5353))
+        self.assertEqual(False, server.pool.submit.call_args[0][1])
+        server.pending = 3 # overloaded
+        server.admit(self.query("cached.com"), ("192.0.2.9", 5353))
+        self.assertEqual(True, server.pool.submit.call_args[0][1])
+        server.pending = 3
+        server.admit(self.query("new.com"), ("192.0.2.9", 5353))
+        self.assertEqual(2, server.pool.submit.call_count)
+        response = server.sock.send.call_args[0][0][0]
+        self.assertEqual((1, RCode.Refused), (response.header.qr, response.header.rcode))
+        server.pending = 4 # full
+        server.admit(self.query("cached.com"), ("192.0.2.9", 5353))
+        self.assertEqual(2, server.pool.submit.call_count)
+        self.assertEqual(2, server.shed_count)
+
+    def test_rejected(self):
+        server = self.server(4)
+        server.pool.submit.return_value = False
+        server.admit(self.query("new.com"), ("192.0.2.9", 5353))
+        self.assertEqual(0, server.pending)
+        self.assertEqual(1, server.shed_count)
+
+    def test_handler_error(self):
+        server = self.server(4)
+        server.pool = WorkerPool(1, 4, lambda: None)
+        server.handle = MagicMock(side_effect=RuntimeError)
+        conn = TCPConnection(MagicMock())
+        conn.pending = 1
+        server.admit(self.query("new.com"), ("192.0.2.9", 5353), conn)
+        server.pool.shutdown()
+        for w in server.pool.workers:
+            w.join()
+        self.assertEqual((0, 0), (server.pending, conn.pending))
+
+    def test_priority(self):
+        order = []
+        release = threading.Event()
+        pool = WorkerPool(1, 4, lambda: None)
+        pool.submit(lambda r: release.wait())
+        time.sleep(0.1)
+        pool.submit(lambda r: order.append("recursion"))
+        pool.submit(lambda r: order.append("cached"), urgent=True)
+        release.set()
+        pool.shutdown()
+        for w in pool.workers:
+            w.join()
+        self.assertEqual(["cached", "recursion"], order)
+
+    def test_send_queue(self):
+        sock = SocketWrapper(0, "127.0.0.1", send_queue=1)
+        self.assertTrue(sock.send((b"", "127.0.0.1", 1)))
+        self.assertFalse(sock.send((b"", "127.0.0.1", 1)))
+        self.assertEqual(1, sock.overflows)
+        sock.shutdown()
+
+
+class TestMetrics(TestCase):
+    """Instrumentation"""
+    def test_counter(self):
+        counter = metrics.Counter("test_total", "Test")
+        threads = [threading.Thread(target=lambda: [counter.inc() for _ in range(1000)]) for _ in range(4)]
+        for t in threads:
+            t.start()
+        for t in threads:
+            t.join()
+        self.assertEqual(4000, counter.value)
+        self.assertEqual({}, counter.cells.live) # folded when the threads exited
+        counter.inc()
+        self.assertEqual(4001, counter.value)
+        rcodes = metrics.Counter("test_rcodes_total", "Test", ("rcode",))
+        rcodes.labels(RCode.NoError).inc(2)
+        rcodes.labels(RCode.Refused).inc()
+        self.assertIn('test_rcodes_total{rcode="NoError"} 2', rcodes.render())
+        self.assertIn('test_rcodes_total{rcode="Refused"} 1', rcodes.render())
+
+    def test_histogram(self):
+        histogram = metrics.Histogram("test_seconds", "Test", [0.1, 1])
+        for value in [0.05, 0.1, 0.5, 3]:
+            histogram.observe(value)
+        lines = histogram.render()
+        self.assertIn('test_seconds_bucket{le="0.1"} 2', lines)
+        self.assertIn('test_seconds_bucket{le="1"} 3', lines)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 4', lines)
+        self.assertIn("test_seconds_count 4", lines)
+
+    def test_queue_depths(self):
+        server = Server.__new__(Server)
+        server.sock = SocketWrapper(0, "127.0.0.1")
+        for i in range(3):
+            server.sock.queries.put_nowait((b"", ("192.0.2.1", 53), 0))
+        server.pool = server.tcp = server.cache = server.flights = MagicMock()
+        server.packets = server.limiter = None
+        server.pending = 0
+        registered = dict(metrics.REGISTRY.metrics)
+        server.register_metrics()
+        try:
+            self.assertIn("dns_query_queue_depth 3", metrics.REGISTRY.render())
+        finally:
+            metrics.REGISTRY.metrics = registered
+            server.sock.shutdown()
+
+    def test_endpoint(self):
+        import urllib.request
+        hits = metrics.CACHE_HITS.value
+        RC = RecordCache(0, "testCacheMetrics")
+        RC.add_record(ResourceRecord.from_dict({"type": "A", "name": "a.com", "class": "IN", "ttl": 60, "rdata": {"address": "192.0.2.1"}}))
+        RC.lookup("a.com", Type.A, Class.IN)
+        self.assertEqual(hits + 1, metrics.CACHE_HITS.value)
+        server = metrics.MetricsServer(0)
+        server.start()
+        try:
+            body = urllib.request.urlopen("http://127.0.0.1:{}/metrics".format(server.port)).read().decode()
+        finally:
+            server.shutdown()
+        self.assertIn("# TYPE dns_cache_hits_total counter", body)
+        self.assertIn("dns_cache_hits_total {}".format(hits + 1), body)
+
+
+class TestAsync(TestCase):
+    """asyncio engine tests"""
+    def test_async_resolver(self):
+        RC = RecordCache(0, "testCacheAsync")
+        RC.add_record(ResourceRecord.from_dict({"type": "NS", "name": "awesome.com", "class": "IN", "ttl": 60, "rdata": {"nsdname": "ns.awesome.com"}}))
+        RC.add_record(ResourceRecord.from_dict({"type": "A", "name": "ns.awesome.com", "class": "IN", "ttl": 60, "rdata": {"address": "192.0.2.1"}}))
+        sent = []
+        class Protocol:
+            async def exchange(self, query, addr, timeout):
+                sent.append(addr)
+                await asyncio.sleep(0.01)
+                response = Message(query.header, query.questions, [ResourceRecord.from_dict(
+                    {"type": "A", "name": str(query.questions[0].qname), "class": "IN", "ttl": 60, "rdata": {"address": "192.0.2.2"}})])
+                response.header.qr = 1
+                return response
+        res = AsyncResolver(5, True, 0, Protocol(), RC)
+        async def resolve_all():
+            return await asyncio.gather(*[res.gethostbyname("h{}.awesome.com".format(i)) for i in range(50)])
+        results = asyncio.run(resolve_all())
+        self.assertEqual(50, len(sent))
+        self.assertTrue(all(ips[0].rdata.address == "192.0.2.2" for _, _, ips in results))
+
+    def test_malformed(self):
+        server = MagicMock()
+        server.limiter = server.packets = None
+        protocol = ServerProtocol(server)
+        protocol.datagram_received(b"\0\3\0\0\0\1\0\0\0\0\0\0\xc0\x0c\0\1\0\1", ("127.0.0.1", 1))
+        self.assertEqual(1, protocol.malformed)
+        self.assertFalse(server.admit.called)
+
+
+class TestSupervisor(TestCase):
+    """Multi-process server tests"""
+    def test_shared_cache(self):
+        manager = CacheManager()
+        manager.start()
+        cache = SharedCache(manager.RecordCache(ttl=0, cachefile="testCacheShared"))
+        cache.add_record(ResourceRecord.from_dict({"type": "A", "name": "shared.com", "class": "IN", "ttl": 60, "rdata": {"address": "192.0.2.7"}}))
+        rs = cache.lookup(Name("shared.com"), Type.A, Class.IN)
+        self.assertEqual(["192.0.2.7"], [r.rdata.address for r in rs])
+        manager.shutdown()
+
+    def test_restart(self):
+        server = MagicMock()
+        server.serve.side_effect = lambda: time.sleep(60)
+        supervisor = Supervisor(2, lambda index, cache: server)
+        threading.Thread(target=supervisor.serve, daemon=True).start()
+        time.sleep(0.5)
+        killed = supervisor.processes[0]
+        os.kill(killed.pid, signal.SIGKILL)
+        time.sleep(1.5)
+        try:
+            self.assertEqual(1, supervisor.restarts)
+            self.assertIsNot(killed, supervisor.processes[0])
+            self.assertTrue(all(p.is_alive() for p in supervisor.processes.values()))
+        finally:
+            supervisor.shutdown()
+
+
+class TestSocketWrapper(TestCase):
+    """Dispatch of received datagrams"""
+    def setUp(self):
+        self.wrapper = SocketWrapper(0, "127.0.0.1")
+        self.port = self.wrapper.sock.getsockname()[1]
+        self.wrapper.start()
+        self.peer = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        self.peer.bind(("127.0.0.1", 0))
+        self.peer.settimeout(2)
+
+    def tearDown(self):
+        self.wrapper.shutdown()
+        self.peer.close()
+
+    def message(self, ident, qr):
+        header = Header(ident, 0, 1, 0, 0, 0)
+        header.qr = qr
+        return Message(header, [Question(Name("a.com"), Type.A, Class.IN)])
+
+    def test_queries(self):
+        self.peer.sendto(self.message(1, 0).to_bytes(), ("127.0.0.1", self.port))
+        data, addr = self.wrapper.next_query(2)
+        self.assertEqual(1, self.wrapper.decode(data).header.ident)
+        self.assertEqual(self.peer.getsockname(), addr)
+        self.assertIsNone(self.wrapper.next_query(0.1))
+
+    def test_exchange(self):
+        def answer():
+            data, addr = self.peer.recvfrom(1024)
+            response = Message.from_bytes(data)
+            response.header.qr = 1
+            self.peer.sendto(self.message(999, 1).to_bytes(), addr) # unsolicited
+            self.peer.sendto(response.to_bytes(), addr)
+        threading.Thread(target=answer).start()
+        t = time.process_time()
+        response = self.wrapper.exchange(self.message(7, 0), "127.0.0.1", 2, self.peer.getsockname()[1])
+        self.assertEqual(7, response.header.ident)
+        self.assertIsNone(self.wrapper.exchange(self.message(8, 0), "127.0.0.1", 0.5, self.peer.getsockname()[1]))
+        self.assertLess(time.process_time() - t, 0.3) # waiting takes no CPU
+        self.assertEqual({}, self.wrapper.waiters)
+        self.assertEqual(1, self.wrapper.unmatched)
+
+    def test_expired(self):
+        self.wrapper.query_age = 0.1
+        self.peer.sendto(self.message(1, 0).to_bytes(), ("127.0.0.1", self.port))
+        time.sleep(0.3)
+        self.peer.sendto(self.message(2, 0).to_bytes(), ("127.0.0.1", self.port))
+        data, _ = self.wrapper.next_query(2)
+        self.assertEqual(2, self.wrapper.decode(data).header.ident)
+        self.assertEqual(1, self.wrapper.expired)
+
+    def test_malformed(self):
+        addr = ("127.0.0.1", self.port)
+        self.peer.sendto(b"\0\1\0", addr)
+        junk = b"\0\2\0\0\0\1\0\0\0\0\0\0\xff"
+        self.peer.sendto(junk, addr)
+        data, _ = self.wrapper.next_query(2)
+        self.assertEqual(junk, data)
+        self.assertIsNone(self.wrapper.decode(data))
+        # the question name is a compression pointer to itself
+        loop = b"\0\3\0\0\0\1\0\0\0\0\0\0\xc0\x0c\0\1\0\1"
+        self.peer.sendto(loop, addr)
+        data, _ = self.wrapper.next_query(2)
+        self.assertIsNone(self.wrapper.decode(data))
+        self.assertEqual(3, self.wrapper.malformed)
+        self.assertTrue(self.wrapper.is_alive())
+
+
+class TestPool(TestCase):
+    """Worker pool tests"""
+    def test_pool(self):
+        resolvers = []
+        pool = WorkerPool(2, 2, lambda: resolvers.append(object()) or resolvers[-1])
+        release = threading.Event()
+        seen = []
+        self.assertTrue(pool.submit(lambda r: release.wait()))
+        self.assertTrue(pool.submit(lambda r: release.wait()))
+        time.sleep(0.1)
+        self.assertEqual(2, pool.stats()["busy"])
+        self.assertTrue(pool.submit(lambda r: seen.append(r)))
+        self.assertTrue(pool.submit(lambda r: seen.append(r)))
+        self.assertFalse(pool.submit(lambda r: seen.append(r)))
+        self.assertEqual(2, pool.stats()["queue_depth"])
+        release.set()
+        time.sleep(0.1)
+        stats = pool.stats()
+        self.assertEqual((4, 1, 0), (stats["completed"], stats["rejected"], stats["busy"]))
+        self.assertTrue(all(r in resolvers for r in seen))
+        pool.shutdown()
+
+
 class TestZone(TestCase):
     def setUp(self):
         self.catalog = Catalog()
@@ -111,6 +111,11 @@ class NameTestCase(unittest.TestCase):
         with self.assertRaises(ValueError):
             Name.from_bytes(packet, 0)
 
+    def test_name_from_bytes_loop(self):
+        for packet in [b"\xc0\x00", b"\x03www\xc0\x00", b"\x03www\xc0\x06\x00"]:
+            with self.assertRaises(ValueError):
+                Name.from_bytes(packet, 0)
+
     def test_name_from_bytes4(self):
         packet = b"\x00"
         name, offset = Name.from_bytes(packet, 0)